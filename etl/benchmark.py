@@ -0,0 +1,268 @@
+"""
+Pipeline Benchmark
+
+This module benchmarks the ETL and modeling stages at fixed data scales on
+every configured database backend:
+
+- load: `etl.load_csv_shards` for every table, in foreign key order
+- fetch: `modeling.fetch_data_for_predictions`
+- train_predict: `modeling.train_and_predict`
+- populate: `modeling.populate_results_table`
+
+Datasets are generated once per scale with `data_generator` and reused. Each
+backend runs in its own process with `DATABASE_URL` pointing at it, because
+`database.engine` is created at import time. Throughput and peak memory of
+every stage are compared with a stored baseline, and the run fails when a
+stage regresses past the threshold.
+
+Every run drops and re-creates all tables of the backend it benchmarks, so
+it refuses to run against a database whose name does not contain
+"benchmark" (e.g. `BENCHMARK_POSTGRES_URL=postgresql://.../churn_benchmark`)
+unless `--i-know-this-drops-tables` is given.
+
+Usage:
+
+    python benchmark.py --scales 10k 1m --backends sqlite postgres
+    python benchmark.py --scales 10k --update-baseline
+"""
+
+import argparse
+import glob
+import json
+import os
+import subprocess
+import sys
+import time
+
+from sqlalchemy.engine import make_url
+
+SCALES = {
+    "10k": 10_000,
+    "1m": 1_000_000,
+    "10m": 10_000_000,
+}
+"""
+dict: Number of customers of each benchmark scale.
+"""
+
+BENCHMARK_DIR = os.environ.get("BENCHMARK_DIR", "benchmarks/")
+BASELINE_PATH = os.environ.get("BENCHMARK_BASELINE_PATH", "benchmarks/baseline.json")
+POSTGRES_URL = os.environ.get("BENCHMARK_POSTGRES_URL")  # Postgres backend runs only when set
+REGRESSION_THRESHOLD = float(os.environ.get("BENCHMARK_REGRESSION_THRESHOLD", 0.2))
+BENCHMARK_SEED = 0
+TABLES = ["customers", "usage", "transactions", "feedback"]
+
+DROP_TABLES_FLAG = "--i-know-this-drops-tables"
+
+def is_benchmark_database(url) -> bool:
+    """
+    Tell whether a database URL names a dedicated benchmark database.
+    """
+    database = make_url(str(url)).database or ""
+    return "benchmark" in os.path.basename(database).lower()
+
+def check_disposable(url, allow_drop: bool = False) -> None:
+    """
+    Refuse to benchmark a database whose tables must not be dropped.
+
+    Raises:
+        SystemExit: If `url` is not a benchmark database and `allow_drop` is False.
+    """
+    if not allow_drop and not is_benchmark_database(url):
+        raise SystemExit(
+            f"Refusing to drop the tables of {make_url(str(url)).render_as_string(hide_password=True)}: "
+            f"its name does not contain 'benchmark'. Use a dedicated benchmark database or pass {DROP_TABLES_FLAG}."
+        )
+
+def backend_urls(workdir: str = BENCHMARK_DIR) -> dict:
+    """
+    Database URL of every available backend.
+    """
+    urls = {"sqlite": f"sqlite:///{os.path.abspath(os.path.join(workdir, 'benchmark.db'))}"}
+    if POSTGRES_URL:
+        urls["postgres"] = POSTGRES_URL
+    return urls
+
+def ensure_dataset(scale: str, workdir: str = BENCHMARK_DIR, workers=None) -> str:
+    """
+    Generate the dataset of a scale unless it already exists.
+
+    Returns:
+        str: Folder with the shard files.
+    """
+    from datetime import date
+
+    from data_generator import generate_sharded_dataset
+
+    folder = os.path.join(workdir, "data", scale)
+    marker = os.path.join(folder, ".complete")
+    if not os.path.exists(marker):
+        start = time.perf_counter()
+        # A fixed reference date keeps the files identical from run to run
+        generate_sharded_dataset(
+            SCALES[scale], workers=workers, seed=BENCHMARK_SEED,
+            reference_date=date(2024, 1, 1), output_folder=folder,
+        )
+        open(marker, "w").close()
+        print(f"Generated {scale} dataset in {time.perf_counter() - start:.1f}s")
+    return folder
+
+def run_stages(data_folder: str, allow_drop: bool = False) -> list:
+    """
+    Run every stage once against the database of `DATABASE_URL`.
+
+    Must run in a fresh process: the pipeline modules bind to the database
+    when they are imported. All tables are dropped first; see
+    `check_disposable`.
+
+    Returns:
+        list[dict]: Per stage, the metrics of `instrumentation.StageMetrics`
+        plus "rows_per_sec".
+    """
+    from etl import load_csv_shards
+    from instrumentation import recorder, stage
+    from modeling import fetch_data_for_predictions, populate_results_table, train_and_predict
+    from database import engine
+    from models import Base
+
+    check_disposable(engine.url, allow_drop)
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+
+    with stage("load") as current:
+        shards = {table_name: glob.glob(os.path.join(data_folder, f"{table_name}.*.csv")) for table_name in TABLES}
+        current.rows_out = sum(load_csv_shards(shards).values())
+    with stage("fetch") as current:
+        data = fetch_data_for_predictions(use_cache=False)
+        current.rows_out = len(data)
+    with stage("train_predict", rows_in=len(data)) as current:
+        data = train_and_predict(data)
+        current.rows_out = len(data)
+    with stage("populate", rows_in=len(data)) as current:
+        populate_results_table(data)
+        current.rows_out = len(data)
+
+    stages = [metrics for metrics in recorder.report()["stages"]
+              if metrics["name"] in ("load", "fetch", "train_predict", "populate")]
+    for metrics in stages:
+        rows = metrics["rows_out"] or metrics["rows_in"] or 0
+        metrics["rows_per_sec"] = rows / metrics["wall_seconds"] if metrics["wall_seconds"] else 0.0
+    return stages
+
+def run_backend(backend: str, url: str, scale: str, data_folder: str, allow_drop: bool = False) -> list:
+    """
+    Run the stages in a child process bound to one backend.
+    """
+    environment = dict(os.environ, DATABASE_URL=url, FEATURE_CACHE="0")
+    output_path = os.path.join(BENCHMARK_DIR, f"result-{backend}-{scale}.json")
+    command = [sys.executable, os.path.abspath(__file__), "--run-stages", data_folder, "--output", output_path]
+    subprocess.run(command + ([DROP_TABLES_FLAG] if allow_drop else []), env=environment, check=True)
+    with open(output_path) as output_file:
+        return json.load(output_file)
+
+def compare_with_baseline(results: dict, baseline: dict, threshold: float = REGRESSION_THRESHOLD) -> list:
+    """
+    Find stages that got slower or bigger than the baseline allows.
+
+    A stage regresses when its throughput drops below `1 - threshold` times
+    the baseline, or its peak RSS grows above `1 + threshold` times it.
+
+    Args:
+        results (dict): Stage metrics keyed by backend, scale and stage name.
+        baseline (dict): Same layout, from an earlier run.
+        threshold (float): Allowed relative change.
+
+    Returns:
+        list[str]: One message per regression.
+    """
+    regressions = []
+    for backend, scales in results.items():
+        for scale, stages in scales.items():
+            for name, metrics in stages.items():
+                expected = baseline.get(backend, {}).get(scale, {}).get(name)
+                if expected is None:
+                    continue
+                label = f"{backend}/{scale}/{name}"
+                if metrics["rows_per_sec"] < expected["rows_per_sec"] * (1 - threshold):
+                    regressions.append(
+                        f"{label}: {metrics['rows_per_sec']:,.0f} rows/sec, "
+                        f"baseline {expected['rows_per_sec']:,.0f}"
+                    )
+                if expected["peak_rss_bytes"] and \
+                        metrics["peak_rss_bytes"] > expected["peak_rss_bytes"] * (1 + threshold):
+                    regressions.append(
+                        f"{label}: peak RSS {metrics['peak_rss_bytes'] / 1024 ** 2:,.0f} MiB, "
+                        f"baseline {expected['peak_rss_bytes'] / 1024 ** 2:,.0f} MiB"
+                    )
+    return regressions
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the ETL and modeling stages.")
+    parser.add_argument("--scales", nargs="+", choices=list(SCALES), default=["10k"])
+    parser.add_argument("--backends", nargs="+", default=None, help="Defaults to every configured backend")
+    parser.add_argument("--workers", type=int, default=None, help="Processes generating the datasets")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD)
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--update-baseline", action="store_true", help="Store this run as the baseline")
+    parser.add_argument(DROP_TABLES_FLAG, dest="allow_drop", action="store_true",
+                        help="Benchmark databases whose name does not contain 'benchmark' (drops all their tables)")
+    parser.add_argument("--run-stages", metavar="DATA_FOLDER", help=argparse.SUPPRESS)
+    parser.add_argument("--output", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.run_stages:
+        stages = run_stages(args.run_stages, args.allow_drop)
+        with open(args.output, "w") as output_file:
+            json.dump(stages, output_file, indent=2)
+        return 0
+
+    os.makedirs(BENCHMARK_DIR, exist_ok=True)
+    urls = backend_urls()
+    backends = args.backends or list(urls)
+    for backend in backends:
+        if backend in urls:
+            check_disposable(urls[backend], args.allow_drop)
+    results = {}
+    for scale in args.scales:
+        data_folder = ensure_dataset(scale, workers=args.workers)
+        for backend in backends:
+            if backend not in urls:
+                print(f"Skipping {backend}: not configured")
+                continue
+            stages = run_backend(backend, urls[backend], scale, data_folder, args.allow_drop)
+            results.setdefault(backend, {})[scale] = {metrics["name"]: metrics for metrics in stages}
+
+    print(f"{'backend':<10} {'scale':<6} {'stage':<14} {'seconds':>9} {'rows/sec':>14} {'peak RSS MiB':>13}")
+    for backend, scales in results.items():
+        for scale, stages in scales.items():
+            for name, metrics in stages.items():
+                print(
+                    f"{backend:<10} {scale:<6} {name:<14} {metrics['wall_seconds']:>9.2f} "
+                    f"{metrics['rows_per_sec']:>14,.0f} {metrics['peak_rss_bytes'] / 1024 ** 2:>13,.0f}"
+                )
+
+    with open(os.path.join(BENCHMARK_DIR, "latest.json"), "w") as latest_file:
+        json.dump(results, latest_file, indent=2)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    if args.update_baseline:
+        for backend, scales in results.items():
+            baseline.setdefault(backend, {}).update(scales)
+        os.makedirs(os.path.dirname(args.baseline) or ".", exist_ok=True)
+        with open(args.baseline, "w") as baseline_file:
+            json.dump(baseline, baseline_file, indent=2)
+        print(f"Baseline updated: {args.baseline}")
+        return 0
+
+    regressions = compare_with_baseline(results, baseline, args.threshold)
+    for message in regressions:
+        print(f"REGRESSION {message}")
+    if not baseline:
+        print("No baseline to compare with; run with --update-baseline to store one")
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
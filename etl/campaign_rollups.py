@@ -0,0 +1,310 @@
+"""
+Campaign Effectiveness Rollups
+
+This module keeps the churn figures of the `campaigns` table up to date
+without scanning the full prediction history. Rows of `results` and
+`predictions` are rolled up into `churn_daily_rollups`, one row per source
+table and day with the number of predictions, how many predicted churn and
+the sum of their churn probabilities. Each refresh only aggregates rows
+past the source's watermark in `rollup_watermarks` and adds them to the
+existing days with `INSERT ... ON CONFLICT DO UPDATE`, in the same
+transaction that moves the watermark. A source whose ids fell below its
+watermark was emptied or reloaded, and is rolled up again from scratch;
+`reset_sources` does the same for tables the loader empties.
+
+Campaign churn rates are then computed from the daily rollups: the rate
+"after" covers the campaign's own days, the rate "before" the same number
+of days right before it, and `churn_reduction` is their difference. Only
+campaigns whose windows contain a day that changed are updated.
+
+Refreshes only touch the rollup and campaign rows they change, so readers
+of the rollups are never blocked on PostgreSQL; the source tables are
+refreshed in parallel over the connection pool, and concurrent refreshes of
+the same source wait for each other on the watermark row lock. SQLite
+serializes writers, so run a single refresh at a time there.
+"""
+
+import datetime
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+from loguru import logger
+from sqlalchemy import Date, bindparam, case, cast, delete, func, literal, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+
+from database import engine
+from models import Campaign, ChurnDailyRollup, Prediction, Result, RollupWatermark
+
+ROLLUP_SOURCES = {
+    "results": (Result, Result.result_id, case((Result.prediction == "Churn", 1), else_=0), Result.probability),
+    "predictions": (Prediction, Prediction.prediction_id, Prediction.predicted_churn, Prediction.churn_probability),
+}
+"""
+dict: Per source table, its model, increasing id column, churn flag (0/1)
+and churn probability expressions.
+"""
+
+CAMPAIGN_ROLLUP_SOURCE = os.environ.get("CAMPAIGN_ROLLUP_SOURCE", "results")  # Source of the campaign figures
+
+def dialect_insert(connection):
+    """
+    `insert` construct with `on_conflict_do_update` for the connection's dialect.
+    """
+    if connection.dialect.name == "postgresql":
+        return postgresql.insert
+    if connection.dialect.name == "sqlite":
+        return sqlite.insert
+    raise NotImplementedError(f"Rollups are not supported on {connection.dialect.name}")
+
+def _day(connection, column):
+    """
+    Calendar day of a timestamp column.
+    """
+    # CAST(... AS DATE) keeps only the year on SQLite
+    return func.date(column) if connection.dialect.name == "sqlite" else cast(column, Date)
+
+def refresh_source(source: str, bind=None) -> list:
+    """
+    Add the rows of a source table created since the last refresh to the rollups.
+
+    Args:
+        source (str): Key of `ROLLUP_SOURCES`.
+        bind (Engine, optional): Engine to use. Defaults to `engine`.
+
+    Returns:
+        list[date]: Days whose rollup changed.
+    """
+    model, id_column, churned, probability = ROLLUP_SOURCES[source]
+    start = time.perf_counter()
+    with (bind or engine).begin() as connection:
+        insert = dialect_insert(connection)
+        connection.execute(
+            insert(RollupWatermark)
+            .values(source=source, last_id=0, updated_at=datetime.datetime.now())
+            .on_conflict_do_nothing(index_elements=["source"])
+        )
+        # Holding the watermark row makes concurrent refreshes of a source take turns
+        last_id = connection.execute(
+            select(RollupWatermark.last_id).where(RollupWatermark.source == source).with_for_update()
+        ).scalar_one()
+        upper_id = connection.execute(select(func.max(id_column))).scalar()
+        removed = []
+        if last_id and (upper_id is None or upper_id < last_id):
+            # Ids restarted below the watermark: the rolled-up rows are gone
+            logger.warning(f"{source} ids fell below the rollup watermark {last_id}; rolling it up again")
+            removed = list(connection.execute(
+                delete(ChurnDailyRollup).where(ChurnDailyRollup.source == source).returning(ChurnDailyRollup.day)
+            ).scalars())
+            last_id = 0
+            connection.execute(
+                update(RollupWatermark)
+                .where(RollupWatermark.source == source)
+                .values(last_id=0, updated_at=datetime.datetime.now())
+            )
+        if upper_id is None or upper_id <= last_id:
+            return removed
+
+        day = _day(connection, model.created_at)
+        new_rows = (
+            select(
+                literal(source).label("source"),
+                day.label("day"),
+                func.count().label("predictions"),
+                func.sum(churned).label("churned"),
+                func.sum(probability).label("probability_sum"),
+            )
+            .where(id_column > last_id, id_column <= upper_id, model.created_at.is_not(None))
+            .group_by(day)
+        )
+        upsert = insert(ChurnDailyRollup).from_select(
+            ["source", "day", "predictions", "churned", "probability_sum"], new_rows
+        )
+        upsert = upsert.on_conflict_do_update(
+            index_elements=["source", "day"],
+            set_={
+                "predictions": ChurnDailyRollup.predictions + upsert.excluded.predictions,
+                "churned": ChurnDailyRollup.churned + upsert.excluded.churned,
+                "probability_sum": ChurnDailyRollup.probability_sum + upsert.excluded.probability_sum,
+            },
+        ).returning(ChurnDailyRollup.day)
+        days = list(connection.execute(upsert).scalars())
+        days += [day for day in removed if day not in days]
+        connection.execute(
+            update(RollupWatermark)
+            .where(RollupWatermark.source == source)
+            .values(last_id=upper_id, updated_at=datetime.datetime.now())
+        )
+    logger.info(
+        f"Rolled up {source} rows {last_id + 1}..{upper_id} into {len(days)} days "
+        f"in {time.perf_counter() - start:.2f}s"
+    )
+    return days
+
+def rebuild_source(source: str, bind=None) -> list:
+    """
+    Drop the rollups of a source and aggregate its whole history again, e.g.
+    after rows were deleted from it.
+
+    Returns:
+        list[date]: Days with rollup rows after the rebuild.
+    """
+    bind = bind or engine
+    with bind.begin() as connection:
+        connection.execute(delete(ChurnDailyRollup).where(ChurnDailyRollup.source == source))
+        connection.execute(delete(RollupWatermark).where(RollupWatermark.source == source))
+    return refresh_source(source, bind)
+
+def reset_sources(connection, table_names) -> list:
+    """
+    Forget the rollups of the sources among emptied tables, inside the
+    caller's transaction, so their next refresh rolls them up from scratch.
+
+    Returns:
+        list[str]: Sources that were reset.
+    """
+    sources = [source for source in ROLLUP_SOURCES if source in set(table_names)]
+    if sources:
+        connection.execute(delete(ChurnDailyRollup).where(ChurnDailyRollup.source.in_(sources)))
+        connection.execute(delete(RollupWatermark).where(RollupWatermark.source.in_(sources)))
+    return sources
+
+def _campaign_windows(campaigns):
+    """
+    Add the first day before, the first day of and the last day of every campaign.
+    """
+    campaigns["start_day"] = pd.to_datetime(campaigns["start_date"]).dt.normalize()
+    campaigns["end_day"] = pd.to_datetime(campaigns["end_date"]).dt.normalize()
+    length = campaigns["end_day"] - campaigns["start_day"] + pd.Timedelta(days=1)
+    campaigns["before_day"] = campaigns["start_day"] - length
+    return campaigns
+
+def refresh_campaigns(changed_days=None, source: str = CAMPAIGN_ROLLUP_SOURCE, bind=None) -> int:
+    """
+    Recompute the churn figures of campaigns from the daily rollups.
+
+    Args:
+        changed_days (Iterable[date], optional): Only update campaigns whose
+            before or after window contains one of these days. All campaigns
+            are updated when not given.
+        source (str): Rollup source the figures are computed from.
+        bind (Engine, optional): Engine to use. Defaults to `engine`.
+
+    Returns:
+        int: Number of campaigns updated. Campaigns without predictions on
+        either side of their start keep their stored figures.
+    """
+    bind = bind or engine
+    with bind.connect() as connection:
+        campaigns = pd.read_sql(select(Campaign.campaign_id, Campaign.start_date, Campaign.end_date), connection)
+    if campaigns.empty:
+        return 0
+    campaigns = _campaign_windows(campaigns)
+    if changed_days is not None:
+        days = pd.to_datetime(pd.Series(list(changed_days), dtype=object))
+        if days.empty:
+            return 0
+        touched = [
+            bool(((days >= before_day) & (days <= end_day)).any())
+            for before_day, end_day in zip(campaigns["before_day"], campaigns["end_day"])
+        ]
+        campaigns = campaigns[touched]
+        if campaigns.empty:
+            return 0
+
+    with bind.connect() as connection:
+        rollups = pd.read_sql(
+            select(ChurnDailyRollup.day, ChurnDailyRollup.predictions, ChurnDailyRollup.churned)
+            .where(
+                ChurnDailyRollup.source == source,
+                ChurnDailyRollup.day >= campaigns["before_day"].min().date(),
+                ChurnDailyRollup.day <= campaigns["end_day"].max().date(),
+            ),
+            connection,
+        )
+    rollups["day"] = pd.to_datetime(rollups["day"])
+
+    def churn_rate(first_day, last_day):
+        window = rollups[(rollups["day"] >= first_day) & (rollups["day"] <= last_day)]
+        predictions = window["predictions"].sum()
+        return window["churned"].sum() / predictions if predictions else None
+
+    updates = []
+    for campaign in campaigns.itertuples():
+        before = churn_rate(campaign.before_day, campaign.start_day - pd.Timedelta(days=1))
+        after = churn_rate(campaign.start_day, campaign.end_day)
+        if before is None or after is None:
+            logger.debug(f"Campaign {campaign.campaign_id} has no predictions on one side of its start")
+            continue
+        updates.append({
+            "id": campaign.campaign_id,
+            "before": float(before),
+            "after": float(after),
+            "reduction": float(before - after),
+        })
+    if updates:
+        with bind.begin() as connection:
+            connection.execute(
+                update(Campaign.__table__)
+                .where(Campaign.__table__.c.campaign_id == bindparam("id"))
+                .values(
+                    churn_rate_before=bindparam("before"),
+                    churn_rate_after=bindparam("after"),
+                    churn_reduction=bindparam("reduction"),
+                ),
+                updates,
+            )
+    logger.info(f"Updated the churn figures of {len(updates)} campaigns")
+    return len(updates)
+
+def refresh_campaign_rollups(sources=None, bind=None) -> dict:
+    """
+    Refresh the rollups of every source, then the campaigns they affect.
+
+    Sources are refreshed in parallel, each on its own pooled connection
+    (one after the other on SQLite).
+
+    Returns:
+        dict: "days" changed per source and the number of "campaigns" updated.
+    """
+    bind = bind or engine
+    sources = list(sources or ROLLUP_SOURCES)
+    workers = 1 if bind.dialect.name == "sqlite" else len(sources)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        days = dict(zip(sources, executor.map(lambda source: refresh_source(source, bind), sources)))
+    campaigns = 0
+    if days.get(CAMPAIGN_ROLLUP_SOURCE):
+        campaigns = refresh_campaigns(days[CAMPAIGN_ROLLUP_SOURCE], bind=bind)
+    return {"days": days, "campaigns": campaigns}
+
+def daily_churn_rates(source: str = CAMPAIGN_ROLLUP_SOURCE, start=None, end=None, bind=None):
+    """
+    Daily churn rate and mean churn probability, read from the rollups.
+
+    Args:
+        source (str): Rollup source.
+        start (date, optional): First day returned.
+        end (date, optional): Last day returned.
+
+    Returns:
+        DataFrame: day, predictions, churned, churn_rate and mean_probability.
+    """
+    query = select(
+        ChurnDailyRollup.day, ChurnDailyRollup.predictions, ChurnDailyRollup.churned, ChurnDailyRollup.probability_sum,
+    ).where(ChurnDailyRollup.source == source).order_by(ChurnDailyRollup.day)
+    if start is not None:
+        query = query.where(ChurnDailyRollup.day >= start)
+    if end is not None:
+        query = query.where(ChurnDailyRollup.day <= end)
+    with (bind or engine).connect() as connection:
+        rates = pd.read_sql(query, connection)
+    rates["churn_rate"] = rates["churned"] / rates["predictions"]
+    rates["mean_probability"] = rates.pop("probability_sum") / rates["predictions"]
+    return rates
+
+if __name__ == "__main__":
+    summary = refresh_campaign_rollups()
+    for source, days in summary["days"].items():
+        logger.info(f"{source}: {len(days)} days refreshed")
+    logger.info(f"{summary['campaigns']} campaigns updated")
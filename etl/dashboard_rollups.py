@@ -0,0 +1,436 @@
+"""
+Dashboard Rollups
+
+This module keeps small pre-aggregated tables behind the churn charts of
+`docs/churn/churn_visualizations.md`, so a chart reads a few dozen rows
+instead of scanning customers, usage, transactions, feedback and results.
+
+- `dashboard_customer_state` holds, per customer, everything a chart groups
+  or filters on: age band, gender, location, mean rating band, whether the
+  latest result predicts churn, and the churn driver flags (total usage
+  below `LOW_USAGE_THRESHOLD`, a rating below `NEGATIVE_RATING_THRESHOLD`,
+  no transactions).
+- `dashboard_rollups` holds the number of customers, scored customers and
+  predicted churners per value of every dimension in `DIMENSIONS`.
+- Churn over time is served from the daily `churn_daily_rollups` of
+  `campaign_rollups` and summed up to months or years when read.
+
+A refresh only recomputes the state of customers added, or with usage,
+transactions, feedback or results, past the watermarks in
+`rollup_watermarks`. For each batch of them, the contributions of their old
+state are subtracted from the rollups and those of the new state added with
+`INSERT ... ON CONFLICT DO UPDATE`, in the same transaction that replaces
+their state rows, so a refresh that stops half-way can simply run again.
+Batches hold the `dashboard_customers` watermark row, so concurrent
+refreshes take turns. In-place edits of existing customer rows are not
+visible to the watermarks; callers pass the customers they changed (the
+incremental merges report them) and `rebuild_dashboard_rollups` recomputes
+everything. A refresh that
+finds a source's ids below its watermark, because the table was emptied or
+reloaded, rebuilds instead, and `reset_dashboard_rollups` clears the rollups
+when the loader empties a source table.
+"""
+
+import datetime
+import time
+
+import numpy as np
+import pandas as pd
+from loguru import logger
+from sqlalchemy import delete, func, select, update
+
+from campaign_rollups import CAMPAIGN_ROLLUP_SOURCE, daily_churn_rates, dialect_insert
+from database import engine
+from models import (
+    Customer,
+    DashboardCustomerState,
+    DashboardRollup,
+    Feedback,
+    Result,
+    RollupWatermark,
+    Transaction,
+    Usage,
+)
+from modeling import CUSTOMER_ID_BATCH_SIZE
+
+LOW_USAGE_THRESHOLD = 5  # Total usage frequency below this is a churn driver
+NEGATIVE_RATING_THRESHOLD = 3  # A rating below this is a churn driver
+AGE_BANDS = [(18, "18-24"), (25, "25-34"), (35, "35-44"), (45, "45-54"), (55, "55-64"), (65, "65+")]
+DRIVERS = ["low_usage", "negative_feedback", "no_transactions"]
+DIMENSIONS = ["all", "age_band", "gender", "age_gender", "location", "rating_band", "driver"]
+STATE_COLUMNS = ["age_band", "gender", "location", "rating_band", "scored", "churned", *DRIVERS]
+WATERMARK_SOURCES = {
+    "dashboard_customers": (Customer, Customer.customer_id),
+    "dashboard_usage": (Usage, Usage.usage_id),
+    "dashboard_transactions": (Transaction, Transaction.transaction_id),
+    "dashboard_feedback": (Feedback, Feedback.feedback_id),
+    "dashboard_results": (Result, Result.result_id),
+}
+"""
+dict: Model and increasing id column of every table the customer state is
+computed from, keyed by their row in `rollup_watermarks`.
+"""
+
+UNKNOWN = "Unknown"
+
+def age_bands(ages):
+    """
+    Age band label of every age; ages below the first band or missing are "Unknown".
+    """
+    ages = pd.to_numeric(pd.Series(ages), errors="coerce").to_numpy(dtype=float)
+    lower = np.array([bound for bound, _ in AGE_BANDS], dtype=float)
+    labels = np.array([UNKNOWN] + [label for _, label in AGE_BANDS], dtype=object)
+    positions = np.searchsorted(lower, np.nan_to_num(ages, nan=-1.0), side="right")
+    return labels[positions]
+
+def compute_customer_state(connection, customer_ids):
+    """
+    Dashboard state of the given customers, read from the source tables.
+
+    Returns:
+        DataFrame: customer_id and `STATE_COLUMNS`, one row per customer that
+        still exists.
+    """
+    customers = pd.read_sql(
+        select(Customer.customer_id, Customer.age, Customer.gender, Customer.location)
+        .where(Customer.customer_id.in_(customer_ids)),
+        connection,
+    )
+    usage = pd.read_sql(
+        select(Usage.customer_id, func.sum(Usage.usage_frequency).label("usage_frequency"))
+        .where(Usage.customer_id.in_(customer_ids)).group_by(Usage.customer_id),
+        connection,
+    )
+    transactions = pd.read_sql(
+        select(Transaction.customer_id, func.count().label("transaction_count"))
+        .where(Transaction.customer_id.in_(customer_ids)).group_by(Transaction.customer_id),
+        connection,
+    )
+    feedback = pd.read_sql(
+        select(Feedback.customer_id, func.avg(Feedback.rating).label("mean_rating"),
+               func.min(Feedback.rating).label("min_rating"))
+        .where(Feedback.customer_id.in_(customer_ids)).group_by(Feedback.customer_id),
+        connection,
+    )
+    latest = (
+        select(func.max(Result.result_id).label("result_id"))
+        .where(Result.customer_id.in_(customer_ids)).group_by(Result.customer_id)
+        .subquery()
+    )
+    results = pd.read_sql(
+        select(Result.customer_id, Result.prediction).join(latest, Result.result_id == latest.c.result_id),
+        connection,
+    )
+
+    state = customers
+    for frame in (usage, transactions, feedback, results):
+        state = state.merge(frame, on="customer_id", how="left")
+    usage_frequency = pd.to_numeric(state["usage_frequency"]).fillna(0)
+    mean_rating = pd.to_numeric(state["mean_rating"])
+    return pd.DataFrame({
+        "customer_id": state["customer_id"].astype(np.int64),
+        "age_band": age_bands(state["age"]),
+        "gender": state["gender"].fillna(UNKNOWN).astype(str),
+        "location": state["location"].fillna(UNKNOWN).astype(str),
+        "rating_band": np.where(mean_rating.isna(), "No rating",
+                                mean_rating.round().fillna(0).astype(int).astype(str)),
+        "scored": state["prediction"].notna().astype(int),
+        "churned": (state["prediction"] == "Churn").astype(int),
+        "low_usage": (usage_frequency < LOW_USAGE_THRESHOLD).astype(int),
+        "negative_feedback": (pd.to_numeric(state["min_rating"]) < NEGATIVE_RATING_THRESHOLD).astype(int),
+        "no_transactions": pd.to_numeric(state["transaction_count"]).fillna(0).eq(0).astype(int),
+    })
+
+def contributions(states, sign: int = 1):
+    """
+    Rollup rows contributed by a set of customer states.
+
+    Args:
+        states (DataFrame): Rows with `STATE_COLUMNS`.
+        sign (int): 1 to add the customers, -1 to remove them.
+
+    Returns:
+        DataFrame: dimension, value, customers, scored and churned, summed
+        per dimension value.
+    """
+    parts = []
+    for dimension in DIMENSIONS:
+        if dimension == "driver":
+            for driver in DRIVERS:
+                flagged = states[states[driver] == 1]
+                parts.append(pd.DataFrame({"dimension": dimension, "value": driver,
+                                           "scored": flagged["scored"], "churned": flagged["churned"]}))
+            continue
+        if dimension == "all":
+            values = "all"
+        elif dimension == "age_gender":
+            values = states["age_band"] + "|" + states["gender"]
+        else:
+            values = states[dimension]
+        parts.append(pd.DataFrame({"dimension": dimension, "value": values,
+                                   "scored": states["scored"], "churned": states["churned"]}))
+    rows = pd.concat(parts, ignore_index=True)
+    rows["customers"] = 1
+    totals = rows.groupby(["dimension", "value"], as_index=False)[["customers", "scored", "churned"]].sum()
+    totals[["customers", "scored", "churned"]] *= sign
+    return totals
+
+def _apply_batch(connection, customer_ids) -> int:
+    """
+    Move the rollups from the stored to the current state of a batch of customers.
+
+    Returns:
+        int: Number of rollup rows changed.
+    """
+    old = pd.read_sql(
+        select(DashboardCustomerState).where(DashboardCustomerState.customer_id.in_(customer_ids)),
+        connection,
+    )
+    new = compute_customer_state(connection, customer_ids)
+    delta = pd.concat([contributions(old, -1), contributions(new, 1)], ignore_index=True)
+    delta = delta.groupby(["dimension", "value"], as_index=False)[["customers", "scored", "churned"]].sum()
+    delta = delta[(delta[["customers", "scored", "churned"]] != 0).any(axis=1)]
+
+    insert = dialect_insert(connection)
+    if not delta.empty:
+        upsert = insert(DashboardRollup)
+        upsert = upsert.on_conflict_do_update(
+            index_elements=["dimension", "value"],
+            set_={
+                "customers": DashboardRollup.customers + upsert.excluded.customers,
+                "scored": DashboardRollup.scored + upsert.excluded.scored,
+                "churned": DashboardRollup.churned + upsert.excluded.churned,
+            },
+        )
+        connection.execute(upsert, delta.astype({"customers": int, "scored": int, "churned": int})
+                           .to_dict("records"))
+        connection.execute(delete(DashboardRollup).where(DashboardRollup.customers == 0))
+
+    connection.execute(delete(DashboardCustomerState).where(DashboardCustomerState.customer_id.in_(customer_ids)))
+    if not new.empty:
+        connection.execute(insert(DashboardCustomerState), new.to_dict("records"))
+    return len(delta)
+
+def dashboard_watermarks(bind=None) -> dict:
+    """
+    Current high-water marks of the tables the customer state is computed from.
+    """
+    with (bind or engine).connect() as connection:
+        return {source: connection.execute(select(func.max(column))).scalar()
+                for source, (_, column) in WATERMARK_SOURCES.items()}
+
+def _stored_watermarks(connection) -> dict:
+    rows = connection.execute(
+        select(RollupWatermark.source, RollupWatermark.last_id)
+        .where(RollupWatermark.source.in_(list(WATERMARK_SOURCES)))
+    )
+    return dict(rows.all())
+
+def dirty_customer_ids(watermarks: dict, bind=None) -> list:
+    """
+    Customers added, or with usage, transactions, feedback or results, past `watermarks`.
+    """
+    customer_ids = set()
+    with (bind or engine).connect() as connection:
+        for source, (model, column) in WATERMARK_SOURCES.items():
+            query = select(model.customer_id).distinct().where(model.customer_id.is_not(None))
+            if watermarks.get(source) is not None:
+                query = query.where(column > watermarks[source])
+            customer_ids.update(connection.execute(query).scalars())
+    return sorted(customer_ids)
+
+def refresh_dashboard_rollups(batch_size: int = CUSTOMER_ID_BATCH_SIZE, bind=None, changed_customer_ids=()) -> int:
+    """
+    Bring the dashboard rollups up to date with the source tables.
+
+    Args:
+        batch_size (int): Customers recomputed per transaction.
+        bind (Engine, optional): Engine to use. Defaults to `engine`.
+        changed_customer_ids (iterable): Customers whose rows were changed in
+            place (which the watermarks cannot see); recomputed as well.
+
+    Returns:
+        int: Number of customers whose state was recomputed.
+    """
+    bind = bind or engine
+    start = time.perf_counter()
+    # Taken first, so rows arriving during the refresh are picked up by the next one
+    watermarks = dashboard_watermarks(bind)
+    with bind.begin() as connection:
+        connection.execute(
+            dialect_insert(connection)(RollupWatermark)
+            .values([{"source": source, "last_id": 0, "updated_at": datetime.datetime.now()}
+                     for source in WATERMARK_SOURCES])
+            .on_conflict_do_nothing(index_elements=["source"])
+        )
+        stored = _stored_watermarks(connection)
+    restarted = [source for source, last_id in stored.items() if (watermarks[source] or 0) < last_id]
+    if restarted:
+        logger.warning(f"Ids of {', '.join(restarted)} fell below the dashboard watermarks; rebuilding")
+        return rebuild_dashboard_rollups(batch_size, bind)
+    customer_ids = sorted(set(dirty_customer_ids(stored, bind)).union(changed_customer_ids))
+
+    rollup_rows = 0
+    for offset in range(0, len(customer_ids), batch_size):
+        batch = customer_ids[offset:offset + batch_size]
+        with bind.begin() as connection:
+            # Holding the watermark row makes concurrent refreshes take turns
+            connection.execute(
+                select(RollupWatermark.last_id)
+                .where(RollupWatermark.source == "dashboard_customers").with_for_update()
+            ).scalar_one()
+            rollup_rows += _apply_batch(connection, batch)
+
+    with bind.begin() as connection:
+        for source, last_id in watermarks.items():
+            connection.execute(
+                update(RollupWatermark)
+                .where(RollupWatermark.source == source)
+                .values(last_id=last_id or 0, updated_at=datetime.datetime.now())
+            )
+    logger.info(
+        f"Refreshed the dashboard state of {len(customer_ids)} customers ({rollup_rows} rollup rows changed) "
+        f"in {time.perf_counter() - start:.2f}s"
+    )
+    return len(customer_ids)
+
+def rebuild_dashboard_rollups(batch_size: int = CUSTOMER_ID_BATCH_SIZE, bind=None) -> int:
+    """
+    Drop the dashboard tables and recompute every customer, e.g. after rows
+    were edited or deleted in place.
+
+    Returns:
+        int: Number of customers recomputed.
+    """
+    bind = bind or engine
+    with bind.begin() as connection:
+        connection.execute(delete(DashboardRollup))
+        connection.execute(delete(DashboardCustomerState))
+        connection.execute(delete(RollupWatermark).where(RollupWatermark.source.in_(list(WATERMARK_SOURCES))))
+    return refresh_dashboard_rollups(batch_size, bind)
+
+def reset_dashboard_rollups(connection, table_names) -> bool:
+    """
+    Clear the dashboard tables inside the caller's transaction if any of the
+    emptied tables is a source of the customer state, so the next refresh
+    recomputes every customer.
+
+    Returns:
+        bool: Whether the dashboard tables were cleared.
+    """
+    if not {model.__tablename__ for model, _ in WATERMARK_SOURCES.values()} & set(table_names):
+        return False
+    connection.execute(delete(DashboardRollup))
+    connection.execute(delete(DashboardCustomerState))
+    connection.execute(delete(RollupWatermark).where(RollupWatermark.source.in_(list(WATERMARK_SOURCES))))
+    return True
+
+def churn_by(dimension: str, bind=None):
+    """
+    Customers and predicted churn per value of a dashboard dimension.
+
+    Args:
+        dimension (str): One of `DIMENSIONS`.
+        bind (Engine, optional): Engine to read through. Defaults to `engine`.
+
+    Returns:
+        DataFrame: value, customers, scored, churned and churn_rate (churned
+        over scored customers), largest groups first.
+    """
+    if dimension not in DIMENSIONS:
+        raise ValueError(f"Unknown dashboard dimension: {dimension}")
+    query = (
+        select(DashboardRollup.value, DashboardRollup.customers, DashboardRollup.scored, DashboardRollup.churned)
+        .where(DashboardRollup.dimension == dimension)
+        .order_by(DashboardRollup.customers.desc(), DashboardRollup.value)
+    )
+    with (bind or engine).connect() as connection:
+        rollups = pd.read_sql(query, connection)
+    rollups["churn_rate"] = rollups["churned"] / rollups["scored"].where(rollups["scored"] > 0)
+    return rollups
+
+def churn_by_age_gender(bind=None):
+    """
+    Churn per age band and gender.
+
+    Returns:
+        DataFrame: age_band, gender, customers, scored, churned and churn_rate.
+    """
+    rollups = churn_by("age_gender", bind)
+    values = rollups.pop("value")
+    rollups["age_band"] = values.str.split("|").str[0]
+    rollups["gender"] = values.str.split("|").str[1]
+    return rollups[["age_band", "gender", "customers", "scored", "churned", "churn_rate"]]
+
+def churn_by_location(top: int | None = None, bind=None):
+    """
+    Churn per location, optionally only the `top` locations by customers.
+    """
+    rollups = churn_by("location", bind)
+    return rollups if top is None else rollups.head(top)
+
+def churn_drivers(bind=None):
+    """
+    Customers and churn for every churn driver of the drivers bar chart.
+    """
+    return churn_by("driver", bind)
+
+def churn_by_rating(bind=None):
+    """
+    Churn per mean feedback rating band, for the feedback chart.
+    """
+    rollups = churn_by("rating_band", bind)
+    return rollups.sort_values("value", ignore_index=True)
+
+def churn_distribution(bind=None) -> dict:
+    """
+    Predicted churners and retained customers, for the distribution pie chart.
+
+    Returns:
+        dict: "customers", "scored", "churned" and "retained" counts.
+    """
+    rollups = churn_by("all", bind)
+    if rollups.empty:
+        return {"customers": 0, "scored": 0, "churned": 0, "retained": 0}
+    row = rollups.iloc[0]
+    return {
+        "customers": int(row["customers"]),
+        "scored": int(row["scored"]),
+        "churned": int(row["churned"]),
+        "retained": int(row["scored"] - row["churned"]),
+    }
+
+def churn_over_time(grain: str = "day", start=None, end=None, source: str = CAMPAIGN_ROLLUP_SOURCE, bind=None):
+    """
+    Predicted churn per day, month or year, from the daily campaign rollups.
+
+    Args:
+        grain (str): "day", "month" or "year".
+        start (date, optional): First day included.
+        end (date, optional): Last day included.
+        source (str): Rollup source, see `campaign_rollups.ROLLUP_SOURCES`.
+
+    Returns:
+        DataFrame: period, predictions, churned and churn_rate.
+    """
+    frequencies = {"day": "D", "month": "M", "year": "Y"}
+    if grain not in frequencies:
+        raise ValueError(f"Unknown grain: {grain}")
+    daily = daily_churn_rates(source, start, end, bind)
+    daily["period"] = pd.to_datetime(daily["day"]).dt.to_period(frequencies[grain]).astype(str)
+    totals = daily.groupby("period", as_index=False)[["predictions", "churned"]].sum()
+    totals["churn_rate"] = totals["churned"] / totals["predictions"]
+    return totals
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Refresh the dashboard rollup tables.")
+    parser.add_argument("--rebuild", action="store_true", help="Recompute every customer")
+    args = parser.parse_args()
+    if args.rebuild:
+        rebuild_dashboard_rollups()
+    else:
+        refresh_dashboard_rollups()
+    print(churn_distribution())
+    print(churn_drivers().to_string(index=False))
@@ -1,11 +1,32 @@
 from faker import Faker
+import numpy as np
 import pandas as pd
 import random
-from datetime import datetime
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime
+from functools import lru_cache
 
 # Initialize Faker
 fake = Faker()
 
+# Value domains shared by the row-wise and batch generators
+GENDERS = ["Male", "Female", "Other"]
+FEATURE_NAMES = ["Feature A", "Feature B", "Feature C", "Feature D"]
+PLAN_TYPES = ["Basic", "Premium", "Enterprise"]
+PLAN_PRICES = {"Basic": 9.99, "Premium": 19.99, "Enterprise": 49.99}
+
+# Number of distinct names, cities and sentences pre-sampled for batch generation
+VOCABULARY_SIZE = 5000
+
+# Sharded generation: customers per shard and child records per customer
+SHARD_SIZE = 1_000_000
+USAGE_PER_CUSTOMER = 2.5
+TRANSACTIONS_PER_CUSTOMER = 1.5
+FEEDBACK_PER_CUSTOMER = 0.5
+SHARD_FOLDER = "data/shards/"
+
 def generate_customer(customer_id):
     """
     Generate a single customer record.
@@ -25,7 +46,7 @@ def generate_customer(customer_id):
         "customer_id": customer_id,
         "name": fake.name(),
         "age": random.randint(18, 80),
-        "gender": random.choice(["Male", "Female", "Other"]),
+        "gender": random.choice(GENDERS),
         "location": fake.city()
     }
 
@@ -48,7 +69,7 @@ def generate_usage(usage_id, customer_id):
     return {
         "usage_id": usage_id,
         "customer_id": customer_id,
-        "feature_name": random.choice(["Feature A", "Feature B", "Feature C", "Feature D"]),
+        "feature_name": random.choice(FEATURE_NAMES),
         "usage_frequency": random.randint(1, 500),
         "last_used_date": fake.date_between(start_date='-1y', end_date='today')
     }
@@ -69,10 +90,8 @@ def generate_transaction(transaction_id, customer_id):
             - amount (float): The amount paid for the plan with minor price variations.
             - plan_type (str): Type of plan purchased (Basic, Premium, Enterprise).
     """
-    plan_types = ["Basic", "Premium", "Enterprise"]
-    plan_prices = {"Basic": 9.99, "Premium": 19.99, "Enterprise": 49.99}
-    plan_type = random.choice(plan_types)
-    amount = plan_prices[plan_type] + round(random.uniform(-2.0, 2.0), 2)
+    plan_type = random.choice(PLAN_TYPES)
+    amount = PLAN_PRICES[plan_type] + round(random.uniform(-2.0, 2.0), 2)
 
     return {
         "transaction_id": transaction_id,
@@ -103,3 +122,287 @@ def generate_feedback(feedback_id, customer_id):
         "feedback_text": fake.sentence(),
         "rating": random.randint(1, 5)
     }
+
+@lru_cache(maxsize=8)
+def build_vocabulary(seed, size=VOCABULARY_SIZE):
+    """
+    Pre-sample names, cities and sentences with a seeded Faker instance.
+
+    The batch generators draw from these arrays with NumPy indexing instead of
+    calling Faker once per row.
+
+    Args:
+        seed (int): Seed for the Faker instance.
+        size (int): Number of entries sampled for each vocabulary.
+
+    Returns:
+        dict: NumPy object arrays keyed by "names", "cities" and "sentences".
+    """
+    vocabulary_faker = Faker()
+    vocabulary_faker.seed_instance(seed)
+    return {
+        "names": np.array([vocabulary_faker.name() for _ in range(size)], dtype=object),
+        "cities": np.array([vocabulary_faker.city() for _ in range(size)], dtype=object),
+        "sentences": np.array([vocabulary_faker.sentence() for _ in range(size)], dtype=object),
+    }
+
+def _random_dates(rng, n, reference_date):
+    """
+    Draw `n` dates uniformly from the year ending at `reference_date`.
+    """
+    end = np.datetime64(reference_date or date.today(), "D")
+    start = np.datetime64(pd.Timestamp(end) - pd.DateOffset(years=1), "D")
+    span = (end - start).astype(np.int64) + 1
+    return start + rng.integers(0, span, size=n)
+
+def generate_customers_batch(start_id, count, seed=0, vocabulary_seed=None):
+    """
+    Generate a block of customer records as whole columns.
+
+    Args:
+        start_id (int): First customer_id of the block; ids are consecutive.
+        count (int): Number of customers to generate.
+        seed (int): Seed for the column values.
+        vocabulary_seed (int, optional): Seed for the name/city vocabulary.
+            Defaults to `seed`.
+
+    Returns:
+        DataFrame: Columns customer_id, name, age (18-80), gender and location.
+    """
+    rng = np.random.default_rng(seed)
+    vocabulary = build_vocabulary(seed if vocabulary_seed is None else vocabulary_seed)
+    return pd.DataFrame({
+        "customer_id": np.arange(start_id, start_id + count, dtype=np.int64),
+        "name": vocabulary["names"][rng.integers(0, len(vocabulary["names"]), size=count)],
+        "age": rng.integers(18, 81, size=count),
+        "gender": np.array(GENDERS, dtype=object)[rng.integers(0, len(GENDERS), size=count)],
+        "location": vocabulary["cities"][rng.integers(0, len(vocabulary["cities"]), size=count)],
+    })
+
+def generate_usage_batch(start_id, count, customer_ids, seed=0, reference_date=None):
+    """
+    Generate a block of usage records as whole columns.
+
+    Args:
+        start_id (int): First usage_id of the block; ids are consecutive.
+        count (int): Number of usage records to generate.
+        customer_ids (tuple): Inclusive (low, high) range the customer_id
+            foreign keys are drawn from.
+        seed (int): Seed for the column values.
+        reference_date (date, optional): Last possible `last_used_date`.
+            Defaults to today.
+
+    Returns:
+        DataFrame: Columns usage_id, customer_id, feature_name,
+        usage_frequency (1-500) and last_used_date (up to 1 year ago).
+    """
+    rng = np.random.default_rng(seed)
+    low, high = customer_ids
+    return pd.DataFrame({
+        "usage_id": np.arange(start_id, start_id + count, dtype=np.int64),
+        "customer_id": rng.integers(low, high + 1, size=count),
+        "feature_name": np.array(FEATURE_NAMES, dtype=object)[rng.integers(0, len(FEATURE_NAMES), size=count)],
+        "usage_frequency": rng.integers(1, 501, size=count),
+        "last_used_date": _random_dates(rng, count, reference_date),
+    })
+
+def generate_transactions_batch(start_id, count, customer_ids, seed=0, reference_date=None):
+    """
+    Generate a block of transaction records as whole columns.
+
+    Args:
+        start_id (int): First transaction_id of the block; ids are consecutive.
+        count (int): Number of transactions to generate.
+        customer_ids (tuple): Inclusive (low, high) range the customer_id
+            foreign keys are drawn from.
+        seed (int): Seed for the column values.
+        reference_date (date, optional): Last possible `payment_date`.
+            Defaults to today.
+
+    Returns:
+        DataFrame: Columns transaction_id, customer_id, payment_date (up to
+        1 year ago), amount (plan price +/- 2.00) and plan_type.
+    """
+    rng = np.random.default_rng(seed)
+    low, high = customer_ids
+    plan_index = rng.integers(0, len(PLAN_TYPES), size=count)
+    prices = np.array([PLAN_PRICES[plan_type] for plan_type in PLAN_TYPES])
+    return pd.DataFrame({
+        "transaction_id": np.arange(start_id, start_id + count, dtype=np.int64),
+        "customer_id": rng.integers(low, high + 1, size=count),
+        "payment_date": _random_dates(rng, count, reference_date),
+        "amount": prices[plan_index] + np.round(rng.uniform(-2.0, 2.0, size=count), 2),
+        "plan_type": np.array(PLAN_TYPES, dtype=object)[plan_index],
+    })
+
+def generate_feedback_batch(start_id, count, customer_ids, seed=0, vocabulary_seed=None):
+    """
+    Generate a block of feedback records as whole columns.
+
+    Args:
+        start_id (int): First feedback_id of the block; ids are consecutive.
+        count (int): Number of feedback records to generate.
+        customer_ids (tuple): Inclusive (low, high) range the customer_id
+            foreign keys are drawn from.
+        seed (int): Seed for the column values.
+        vocabulary_seed (int, optional): Seed for the sentence vocabulary.
+            Defaults to `seed`.
+
+    Returns:
+        DataFrame: Columns feedback_id, customer_id, feedback_text and
+        rating (1-5).
+    """
+    rng = np.random.default_rng(seed)
+    vocabulary = build_vocabulary(seed if vocabulary_seed is None else vocabulary_seed)
+    low, high = customer_ids
+    return pd.DataFrame({
+        "feedback_id": np.arange(start_id, start_id + count, dtype=np.int64),
+        "customer_id": rng.integers(low, high + 1, size=count),
+        "feedback_text": vocabulary["sentences"][rng.integers(0, len(vocabulary["sentences"]), size=count)],
+        "rating": rng.integers(1, 6, size=count),
+    })
+
+def plan_shards(number_of_customers, shard_size=SHARD_SIZE):
+    """
+    Split the customer_id range into fixed-size shards.
+
+    The plan only depends on `number_of_customers` and `shard_size`, never on
+    the number of workers, so every shard and its id ranges are identical
+    however the work is scheduled.
+
+    Args:
+        number_of_customers (int): Total number of customers to generate.
+        shard_size (int): Number of customers per shard.
+
+    Returns:
+        list[dict]: One entry per shard with its index, customer_id range and
+        the start id and record count of each child table.
+    """
+    shards = []
+    next_ids = {"usage": 0, "transactions": 0, "feedback": 0}
+    ratios = {
+        "usage": USAGE_PER_CUSTOMER,
+        "transactions": TRANSACTIONS_PER_CUSTOMER,
+        "feedback": FEEDBACK_PER_CUSTOMER,
+    }
+    for index, first_customer in enumerate(range(0, number_of_customers, shard_size)):
+        customers = min(shard_size, number_of_customers - first_customer)
+        shard = {
+            "index": index,
+            "customer_ids": (first_customer, first_customer + customers - 1),
+        }
+        for table, ratio in ratios.items():
+            count = int(round(customers * ratio))
+            shard[table] = (next_ids[table], count)
+            next_ids[table] += count
+        shards.append(shard)
+    return shards
+
+def shard_seeds(seed, shard_index):
+    """
+    Derive the per-table seeds of a shard from the base seed.
+
+    Returns:
+        dict: Integer seeds keyed by table name.
+    """
+    state = np.random.SeedSequence([seed, shard_index]).generate_state(4)
+    return dict(zip(["customers", "usage", "transactions", "feedback"], (int(s) for s in state)))
+
+def generate_shard(shard, seed, reference_date, output_folder=SHARD_FOLDER):
+    """
+    Generate one shard and write each table to its own CSV file.
+
+    Child records only reference customer ids that belong to the same shard,
+    so shard files can be loaded independently of each other.
+
+    Args:
+        shard (dict): Shard description returned by `plan_shards`.
+        seed (int): Base seed of the whole dataset.
+        reference_date (date): Last possible usage and payment date.
+        output_folder (str): Folder the shard files are written to.
+
+    Returns:
+        list[str]: Paths of the written files.
+    """
+    seeds = shard_seeds(seed, shard["index"])
+    first_customer, last_customer = shard["customer_ids"]
+    tables = {
+        "customers": generate_customers_batch(
+            first_customer, last_customer - first_customer + 1,
+            seed=seeds["customers"], vocabulary_seed=seed,
+        ),
+        "usage": generate_usage_batch(
+            *shard["usage"], shard["customer_ids"],
+            seed=seeds["usage"], reference_date=reference_date,
+        ),
+        "transactions": generate_transactions_batch(
+            *shard["transactions"], shard["customer_ids"],
+            seed=seeds["transactions"], reference_date=reference_date,
+        ),
+        "feedback": generate_feedback_batch(
+            *shard["feedback"], shard["customer_ids"],
+            seed=seeds["feedback"], vocabulary_seed=seed,
+        ),
+    }
+    paths = []
+    for table, df in tables.items():
+        csv_path = os.path.join(output_folder, f"{table}.{shard['index']:05d}.csv")
+        df.to_csv(f"{csv_path}.tmp", index=False)
+        os.replace(f"{csv_path}.tmp", csv_path)
+        paths.append(csv_path)
+    return paths
+
+def generate_sharded_dataset(number_of_customers, workers=None, seed=0, shard_size=SHARD_SIZE,
+                             reference_date=None, output_folder=SHARD_FOLDER):
+    """
+    Generate a customer base and its child tables across worker processes.
+
+    Output files are byte-for-byte identical for any number of workers as long
+    as `seed`, `shard_size` and `reference_date` are the same.
+
+    Args:
+        number_of_customers (int): Total number of customers to generate.
+        workers (int, optional): Number of worker processes. Defaults to the
+            number of CPUs.
+        seed (int): Base seed; each shard derives its own seeds from it.
+        shard_size (int): Number of customers per shard.
+        reference_date (date, optional): Last possible usage and payment date.
+            Defaults to today.
+        output_folder (str): Folder the shard files are written to.
+
+    Returns:
+        list[str]: Paths of all written files, in shard order.
+    """
+    os.makedirs(output_folder, exist_ok=True)
+    reference_date = reference_date or date.today()
+    shards = plan_shards(number_of_customers, shard_size)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(
+            generate_shard,
+            shards,
+            [seed] * len(shards),
+            [reference_date] * len(shards),
+            [output_folder] * len(shards),
+        )
+        return [csv_path for paths in results for csv_path in paths]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a sharded synthetic dataset.")
+    parser.add_argument("customers", type=int, help="Total number of customers")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes")
+    parser.add_argument("--seed", type=int, default=0, help="Base seed of the dataset")
+    parser.add_argument("--shard-size", type=int, default=SHARD_SIZE, help="Customers per shard")
+    parser.add_argument("--reference-date", type=date.fromisoformat, default=None,
+                        help="Last possible usage/payment date (YYYY-MM-DD), defaults to today")
+    parser.add_argument("--output-folder", default=SHARD_FOLDER, help="Folder for the shard files")
+    args = parser.parse_args()
+
+    written = generate_sharded_dataset(
+        args.customers,
+        workers=args.workers,
+        seed=args.seed,
+        shard_size=args.shard_size,
+        reference_date=args.reference_date,
+        output_folder=args.output_folder,
+    )
+    print(f"Wrote {len(written)} shard files to {args.output_folder}")
@@ -1,70 +1,152 @@
-from sqlalchemy.orm import sessionmaker
-from database import engine
+import os
+
+from sqlalchemy import select
+from database import read_frames, SessionLocal
 from models import Customer, Usage, Transaction, Feedback
+from feature_cache import load_or_build, source_data_version
+from model_registry import register_model
+from model_search import SEARCH_CPU_BUDGET, TRAINING_MODE, train_with_search
+from feature_encoding import CategoricalEncoder
+from instrumentation import recorder, stage, write_reports
+from writeback import bulk_update_churn_predictions
 import pandas as pd
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.model_selection import train_test_split
 from sklearn.metrics import classification_report
 import joblib
 
-# Establish database session
-Session = sessionmaker(bind=engine)
-session = Session()
+# Bump when the columns built by `fetch_raw_data` change
+FEATURE_VERSION = "1"
+# Encoding of each categorical column; location holds free-form city names,
+# so it is frequency encoded instead of getting one column per city
+ENCODING_METHODS = {
+    'gender': 'onehot',
+    'plan_type': 'onehot',
+    'location': os.environ.get("LOCATION_ENCODING", "frequency"),
+}
+# Share of rows held out to evaluate the model, and the seed of that split
+TEST_SIZE = 0.3
+SPLIT_SEED = 42
+
+def split_rows(data):
+    """
+    Split the row labels of `data` into training and test rows.
+
+    The encoder and the model are both fitted on the training rows, so
+    nothing about the test rows (such as their churn rate per category)
+    reaches the model before it is evaluated.
+
+    Returns:
+        Index: Training row labels.
+        Index: Test row labels.
+    """
+    return train_test_split(data.index, test_size=TEST_SIZE, random_state=SPLIT_SEED)
+
+def fetch_raw_data(customer_ids=None):
+    """
+    Fetch and merge customer, usage and transaction data before encoding.
+
+    Args:
+        customer_ids (Iterable[int], optional): Only fetch these customers.
+
+    Returns:
+        DataFrame: Merged data, without the churn label.
+    """
+    customers_query = select(Customer.customer_id, Customer.age, Customer.gender, Customer.location)
+    usage_query = select(Usage.customer_id, Usage.usage_frequency, Usage.last_used_date)
+    transactions_query = select(Transaction.customer_id, Transaction.amount, Transaction.plan_type)
+    if customer_ids is not None:
+        customer_ids = list(customer_ids)
+        customers_query = customers_query.where(Customer.customer_id.in_(customer_ids))
+        usage_query = usage_query.where(Usage.customer_id.in_(customer_ids))
+        transactions_query = transactions_query.where(Transaction.customer_id.in_(customer_ids))
+
+    # The three tables are read at the same time over the shared pool
+    frames = read_frames({
+        'customers': customers_query,
+        'usage': usage_query,
+        'transactions': transactions_query,
+    })
+    customers_df, usage_df, transactions_df = frames['customers'], frames['usage'], frames['transactions']
+
+    # Merge customer, usage, and transaction data
+    with stage("merge", rows_in=len(customers_df) + len(usage_df) + len(transactions_df)) as current:
+        data = customers_df.merge(usage_df, on="customer_id", how="left")
+        data = data.merge(transactions_df, on="customer_id", how="left")
+        current.rows_out = len(data)
+    return data
 
-def fetch_and_prepare_data():
+def fetch_and_prepare_data(encoder=None):
     """
     Fetch and prepare data from the database for model training and predictions.
+
+    The merged data comes from the on-disk feature cache when the source tables
+    have not changed. The churn label is always read fresh, since it is
+    rewritten by `update_predictions_in_database`.
+
+    Categorical columns are encoded with a `CategoricalEncoder`, fitted here
+    on the training rows of `split_rows` unless a saved one is given, so the
+    same columns come out on every run.
+
+    Args:
+        encoder (CategoricalEncoder, optional): Fitted encoder to reuse.
     
     Returns:
         DataFrame: Prepared data for training and predictions.
+        CategoricalEncoder: The encoder used.
     """
-    customers = session.query(Customer).all()
-    customers_df = pd.DataFrame([{
-        'customer_id': c.customer_id,
-        'age': c.age,
-        'gender': c.gender,
-        'location': c.location,
-        'churn_prediction': c.churn_prediction
-    } for c in customers])
-
-    usage = session.query(Usage).all()
-    usage_df = pd.DataFrame([{
-        'customer_id': u.customer_id,
-        'usage_frequency': u.usage_frequency,
-        'last_used_date': u.last_used_date
-    } for u in usage])
-
-    transactions = session.query(Transaction).all()
-    transactions_df = pd.DataFrame([{
-        'customer_id': t.customer_id,
-        'amount': t.amount,
-        'plan_type': t.plan_type
-    } for t in transactions])
-
-    # Merge customer, usage, and transaction data
-    data = customers_df.merge(usage_df, on="customer_id", how="left")
-    data = data.merge(transactions_df, on="customer_id", how="left")
+    with stage("feature_fetch") as current:
+        data = load_or_build(
+            "training_data", FEATURE_VERSION, fetch_raw_data,
+            tables=("customers", "usage", "transactions"),
+        )
+        with SessionLocal() as session:
+            labels = pd.DataFrame(
+                session.query(Customer.customer_id, Customer.churn_prediction).all(),
+                columns=['customer_id', 'churn_prediction'],
+            )
+        current.rows_out = len(data)
+    data = data.merge(labels, on="customer_id", how="left")
 
     # Handle missing values
     data['plan_type'] = data['plan_type'].fillna('Unknown')
     data['amount'] = data['amount'].fillna(0)
     data['usage_frequency'] = data['usage_frequency'].fillna(0)
 
-    # Convert categorical variables to dummy variables
-    data = pd.get_dummies(data, columns=['gender', 'plan_type', 'location'], drop_first=True)
+    # Models take numbers, not timestamps
+    last_used_date = pd.to_datetime(data.pop('last_used_date'))
+    data['days_since_last_used'] = (pd.Timestamp.now().normalize() - last_used_date).dt.days.fillna(-1)
+
+    # Encode categorical variables with a fixed column layout
+    features = data.drop(columns=['customer_id', 'churn_prediction'])
+    if encoder is None:
+        train_index, _ = split_rows(data)
+        encoder = CategoricalEncoder(ENCODING_METHODS)
+        if 'target' in ENCODING_METHODS.values():
+            encoder.fit(features.loc[train_index], data.loc[train_index, 'churn_prediction'])
+        else:
+            encoder.fit(features.loc[train_index])
+    data = pd.concat([data[['customer_id', 'churn_prediction']], encoder.transform(features, dense=True)], axis=1)
     
-    return data
+    return data, encoder
 
-def train_model(data):
+def train_model(data, mode=TRAINING_MODE):
     """
     Train a RandomForest classifier model to predict churn.
+
+    In "search" mode the hyperparameters are chosen by a cross-validated
+    successive halving search (see `model_search.train_with_search`) and the
+    candidate comparison is written to `model_search_results.csv`, with the
+    round-by-round history in `model_search_history.csv`.
     
     Args:
         data (DataFrame): The data to train the model on.
+        mode (str): "fixed" or "search".
     
     Returns:
         model: Trained RandomForestClassifier model.
         DataFrame: Data with predicted churn and churn probability.
+        dict: Evaluation metrics on the test split, as a classification report dict.
     """
     features = [col for col in data.columns if col not in ['customer_id', 'churn_prediction']]
     target = 'churn_prediction'
@@ -72,16 +154,25 @@ def train_model(data):
     X = data[features]
     y = data[target]
 
-    # Split data into training and testing sets
-    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.3, random_state=42)
+    # Split data into training and testing sets, the same rows the encoder was fitted on
+    train_index, test_index = split_rows(data)
+    X_train, X_test, y_train, y_test = X.loc[train_index], X.loc[test_index], y.loc[train_index], y.loc[test_index]
 
     # Train the RandomForest model
-    model = RandomForestClassifier(random_state=42, n_estimators=200, max_depth=10)
-    model.fit(X_train, y_train)
+    with stage("train", rows_in=len(X_train)):
+        if mode == "search":
+            model, comparison, history = train_with_search(X_train, y_train, X_test, y_test)
+            comparison.to_csv("model_search_results.csv", index=False)
+            history.to_csv("model_search_history.csv", index=False)
+            print("Hyperparameter search results saved to model_search_results.csv.")
+        else:
+            model = RandomForestClassifier(random_state=42, n_estimators=200, max_depth=10, n_jobs=SEARCH_CPU_BUDGET)
+            model.fit(X_train, y_train)
 
     # Evaluate the model
     y_pred = model.predict(X_test)
     report = classification_report(y_test, y_pred)
+    metrics = classification_report(y_test, y_pred, output_dict=True)
     print("Model Evaluation:")
     print(report)
 
@@ -90,43 +181,60 @@ def train_model(data):
         f.write(report)
 
     # Predict churn status and churn probability for all data
-    data['predicted_churn'] = model.predict(X)
-    data['churn_probability'] = model.predict_proba(X)[:, 1]
+    with stage("predict", rows_in=len(X)) as current:
+        data['predicted_churn'] = model.predict(X)
+        data['churn_probability'] = model.predict_proba(X)[:, 1]
+        current.rows_out = len(data)
     
-    return model, data
+    return model, data, metrics
 
 def update_predictions_in_database(data):
     """
     Update the churn predictions in the database.
+
+    All rows are written with one set-based statement per batch (see
+    `writeback.bulk_update_churn_predictions`); repeated customer rows from
+    the usage/transaction merge are collapsed to one prediction per customer.
     
     Args:
         data (DataFrame): Data containing churn predictions for each customer.
     """
     try:
         print("Updating churn predictions in the database...")
-        for _, row in data.iterrows():
-            customer = session.query(Customer).filter_by(customer_id=row['customer_id']).first()
-            if customer:
-                customer.churn_prediction = int(row['predicted_churn'])
-            else:
-                print(f"Customer with ID {row['customer_id']} not found in the database.")
-        
-        session.commit()
+        with stage("write_back", rows_in=len(data)) as current:
+            current.rows_out = bulk_update_churn_predictions(data)
         print("Churn predictions successfully updated in the database.")
     except Exception as e:
-        session.rollback()
         print(f"Error updating database: {e}")
 
-def save_model(model, filename="final_model.pkl"):
+def save_model(model, filename="final_model.pkl", metrics=None, encoder=None):
     """
-    Save the trained model to a file.
+    Save the trained model to a file and register it as a new version.
+
+    The registry version records the feature schema, the version of the
+    training data and the evaluation metrics (see `model_registry`).
     
     Args:
         model: The trained model to be saved.
         filename (str): The name of the file to save the model to.
+        metrics (dict, optional): Evaluation metrics returned by `train_model`.
+        encoder (CategoricalEncoder, optional): Encoder the model was trained
+            with, saved alongside it in the registry.
+
+    Returns:
+        dict: Metadata of the registered version.
     """
     joblib.dump(model, filename)
     print(f"Model saved to {filename}.")
+    metadata = register_model(
+        model,
+        data_version=source_data_version(("customers", "usage", "transactions")),
+        metrics=metrics,
+        artifacts={"encoder": encoder} if encoder is not None else None,
+        extra_metadata={"encoding_layout": encoder.layout_version} if encoder is not None else None,
+    )
+    print(f"Model registered as version {metadata['version']}.")
+    return metadata
 
 def save_predictions_to_csv(data, filename="final_predictions.csv"):
     """
@@ -141,19 +249,23 @@ def save_predictions_to_csv(data, filename="final_predictions.csv"):
     print(f"Predictions saved to {filename}.")
 
 if __name__ == "__main__":
-    print("Fetching and preparing data...")
-    data = fetch_and_prepare_data()
+    recorder.pipeline = "training"
+    try:
+        print("Fetching and preparing data...")
+        data, encoder = fetch_and_prepare_data()
 
-    print("Training the model...")
-    model, data_with_predictions = train_model(data)
+        print("Training the model...")
+        model, data_with_predictions, metrics = train_model(data)
 
-    print("Updating predictions in the database...")
-    update_predictions_in_database(data_with_predictions)
+        print("Updating predictions in the database...")
+        update_predictions_in_database(data_with_predictions)
 
-    print("Saving the model...")
-    save_model(model)
+        print("Saving the model...")
+        save_model(model, metrics=metrics, encoder=encoder)
 
-    print("Saving predictions to a CSV file...")
-    save_predictions_to_csv(data_with_predictions)
+        print("Saving predictions to a CSV file...")
+        save_predictions_to_csv(data_with_predictions)
+    finally:
+        write_reports("reports/training_run_report.json", "reports/training_pipeline.prom")
 
     print("Model training and prediction process completed successfully!")
@@ -1,5 +1,6 @@
 from models import *  # Import all models
-from database import engine, SessionLocal
+from database import create_pooled_engine, engine, SessionLocal
+from feature_cache import bump_data_version
 from data_generator import (
     generate_customer,
     generate_usage,
@@ -7,12 +8,31 @@ from data_generator import (
     generate_feedback,
 )
 from modeling import fetch_data_for_predictions, train_and_predict, populate_results_table
+from instrumentation import stage, write_reports
+from update_schema import PARTITIONED_TABLES, ensure_monthly_partitions, is_partitioned
+from segmentation import segment_all_customers, update_segments
+from campaign_rollups import refresh_campaign_rollups
+from dashboard_rollups import rebuild_dashboard_rollups, refresh_dashboard_rollups
+from batch_scoring import score_changed_customers
+from table_swap import clear_table, describe_table, is_postgres, staging_name, swap_into_table
+from incremental import (
+    load_manifest,
+    save_manifest,
+    changed_files,
+    record_files,
+    upsert_csv_to_table,
+)
 import pandas as pd
 from loguru import logger
 import random
 import glob
+import csv
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from os import path
 import os
+import sqlalchemy as sql
 from sqlalchemy import text
 from sqlalchemy.exc import IntegrityError
 
@@ -22,33 +42,416 @@ NUMBER_OF_USAGE_RECORDS = 5000
 NUMBER_OF_TRANSACTIONS = 3000
 NUMBER_OF_FEEDBACK_RECORDS = 1000
 
+# Bulk loading settings
+COPY_BUFFER_SIZE = 1024 * 1024  # Bytes handed to each COPY read, memory stays flat
+LOAD_CHUNK_SIZE = 10_000  # Rows per executemany batch on non-Postgres engines
+LOAD_PARALLELISM = int(os.environ.get("ETL_LOAD_PARALLELISM", 3))  # Tables loaded at the same time
+LOAD_MODE = os.environ.get("ETL_LOAD_MODE", "swap")  # "swap" (staging table + rename) or "truncate"
+INCREMENTAL = os.environ.get("ETL_INCREMENTAL", "0") == "1"  # Merge changed files instead of reloading all
+SCORING_MODE = os.environ.get("ETL_SCORING_MODE", "full")  # "full" (retrain and rescore all) or "score_only"
+
 # Ensure data folder exists
 DATA_FOLDER = "data/"
 os.makedirs(DATA_FOLDER, exist_ok=True)
 
 # (Data generation code remains the same...)
 
+def copy_csv(connection, table_name: str, csv_path: str, buffer_size: int = COPY_BUFFER_SIZE) -> int:
+    """
+    Stream a CSV file into a table over an open connection.
+
+    PostgreSQL connections use `COPY ... FROM STDIN` on the underlying psycopg2
+    cursor, reading the file `buffer_size` bytes at a time. Other engines fall
+    back to chunked `executemany` INSERTs of `LOAD_CHUNK_SIZE` rows. The caller
+    owns the transaction.
+
+    Args:
+        connection (Connection): SQLAlchemy connection inside a transaction.
+        table_name (str): Name of the target table.
+        csv_path (str): Path to a CSV file whose header names the table columns.
+        buffer_size (int): Number of bytes read per COPY chunk.
+
+    Returns:
+        int: Number of rows loaded.
+    """
+    preparer = connection.dialect.identifier_preparer
+    with open(csv_path, newline="") as csv_file:
+        columns = next(csv.reader([csv_file.readline()]))
+        column_list = ", ".join(preparer.quote(column) for column in columns)
+        table = preparer.quote(table_name)
+
+        if is_postgres(connection):
+            cursor = connection.connection.cursor()
+            try:
+                cursor.copy_expert(
+                    f"COPY {table} ({column_list}) FROM STDIN WITH (FORMAT csv)",
+                    csv_file,
+                    size=buffer_size,
+                )
+                return cursor.rowcount
+            finally:
+                cursor.close()
+
+        placeholders = ", ".join(f":p{i}" for i in range(len(columns)))
+        insert = text(f"INSERT INTO {table} ({column_list}) VALUES ({placeholders})")
+        rows = 0
+        batch = []
+        for record in csv.reader(csv_file):
+            # Unquoted empty fields are NULL, as with COPY in CSV format
+            batch.append({f"p{i}": value if value != "" else None for i, value in enumerate(record)})
+            if len(batch) == LOAD_CHUNK_SIZE:
+                connection.execute(insert, batch)
+                rows += len(batch)
+                batch = []
+        if batch:
+            connection.execute(insert, batch)
+            rows += len(batch)
+        return rows
+
+def copy_csv_to_table(table_name: str, csv_path: str, buffer_size: int = COPY_BUFFER_SIZE, bind=None) -> int:
+    """
+    Bulk load a CSV file into a table in one transaction and log its throughput.
+
+    Args:
+        table_name (str): Name of the target table.
+        csv_path (str): Path to the CSV file containing data.
+        buffer_size (int): Number of bytes read per COPY chunk.
+        bind (Engine, optional): Engine to load through. Defaults to `engine`.
+
+    Returns:
+        int: Number of rows loaded.
+    """
+    bind = bind or engine
+    start = time.perf_counter()
+    with bind.begin() as connection:
+        rows = copy_csv(connection, table_name, csv_path, buffer_size)
+        bump_data_version(connection, table_name, rewrite=False)
+    elapsed = time.perf_counter() - start
+    logger.info(
+        f"Loaded {rows} rows into {table_name} in {elapsed:.2f}s "
+        f"({rows / elapsed if elapsed else 0:,.0f} rows/sec)"
+    )
+    return rows
+
+def swap_csv_into_table(table_name: str, csv_path: str, bind=None) -> int:
+    """
+    Replace the contents of a table with a CSV file, see `swap_into_table`.
+
+    Tables partitioned by month (see `update_schema`) are swapped one
+    partition at a time instead; see `_swap_csv_into_partitions`.
+
+    Args:
+        table_name (str): Name of the table to replace.
+        csv_path (str): Path to the CSV file containing data.
+        bind (Engine, optional): Engine to load through. Defaults to `engine`.
+
+    Returns:
+        int: Number of rows loaded.
+    """
+    bind = bind or engine
+    with bind.connect() as connection:
+        partitioned = is_partitioned(connection, table_name)
+    if partitioned:
+        return _swap_csv_into_partitions(table_name, csv_path, bind)
+    return swap_into_table(table_name, lambda connection, target: copy_csv(connection, target, csv_path), bind)
+
+def _csv_month_range(csv_path: str, column: str):
+    """
+    Oldest and newest value of a date column in a CSV file, or None if it has no such values.
+    """
+    with open(csv_path, newline="") as csv_file:
+        if column not in next(csv.reader([csv_file.readline()])):
+            return None
+    low = high = None
+    for chunk in pd.read_csv(csv_path, usecols=[column], chunksize=LOAD_CHUNK_SIZE * 10):
+        values = pd.to_datetime(chunk[column], errors="coerce").dropna()
+        if values.empty:
+            continue
+        low = values.min() if low is None else min(low, values.min())
+        high = values.max() if high is None else max(high, values.max())
+    return None if low is None else (low.date(), high.date())
+
+def _partition_index_names(connection, table_name: str) -> dict:
+    """
+    Name of the index of every partition, keyed by partition and parent index.
+    """
+    return {(partition, parent): name for partition, parent, name in connection.execute(text("""
+        SELECT CAST(t.relname AS text), CAST(p.relname AS text), CAST(c.relname AS text)
+        FROM pg_inherits i
+        JOIN pg_class t ON t.oid = i.inhrelid
+        JOIN pg_index x ON x.indrelid = t.oid
+        JOIN pg_class c ON c.oid = x.indexrelid
+        JOIN pg_inherits ci ON ci.inhrelid = c.oid
+        JOIN pg_class p ON p.oid = ci.inhparent
+        WHERE i.inhparent = CAST(:table AS regclass)
+    """), {"table": connection.dialect.identifier_preparer.quote(table_name)})}
+
+def _swap_csv_into_partitions(table_name: str, csv_path: str, bind) -> int:
+    """
+    Replace the contents of a partitioned table one partition at a time.
+
+    The monthly partitions the CSV needs are created first, so no row falls
+    into the default partition. The CSV is then loaded into a partitioned
+    staging table with the same bounds, carrying the live table's indexes
+    and outgoing foreign keys. Every staging partition is detached from it
+    and given a CHECK constraint matching its bounds, which lets the swap
+    attach it without scanning. The swap itself, a short transaction that
+    detaches and drops the live partitions, attaches the staged ones and
+    gives their indexes the old names, is the only time readers wait.
+
+    Returns:
+        int: Number of rows loaded.
+    """
+    start = time.perf_counter()
+    column = PARTITIONED_TABLES[table_name]
+    months = _csv_month_range(csv_path, column)
+    ensure_monthly_partitions(table_name, bind=bind, since=months and months[0], until=months and months[1])
+
+    quote = bind.dialect.identifier_preparer.quote
+    table = quote(table_name)
+    staging = quote(staging_name(table_name))
+    with bind.connect() as connection:
+        layout = describe_table(connection, table_name)
+        key = connection.execute(text(
+            "SELECT pg_get_partkeydef(CAST(:table AS regclass))"
+        ), {"table": table}).scalar()
+        partitions = connection.execute(text("""
+            SELECT CAST(c.relname AS text), pg_get_expr(c.relpartbound, c.oid)
+            FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = CAST(:table AS regclass)
+            ORDER BY pg_get_expr(c.relpartbound, c.oid) = 'DEFAULT', c.relname
+        """), {"table": table}).all()
+
+    # Build and fill the staging partitions while readers keep using the live ones
+    try:
+        with bind.begin() as connection:
+            connection.execute(text(f"DROP TABLE IF EXISTS {staging} CASCADE"))
+            connection.execute(text(
+                f"CREATE TABLE {staging} (LIKE {table} INCLUDING ALL) PARTITION BY {key}"
+            ))
+            for partition, bound in partitions:
+                connection.execute(text(
+                    f"CREATE UNLOGGED TABLE {quote(staging_name(partition))} PARTITION OF {staging} {bound}"
+                ))
+            rows = copy_csv(connection, staging_name(table_name), csv_path)
+            for constraint_name, definition in layout["outbound"]:
+                connection.execute(text(
+                    f"ALTER TABLE {staging} ADD CONSTRAINT {quote(constraint_name)} {definition}"
+                ))
+            checks = connection.execute(text("""
+                SELECT CAST(c.relname AS text), pg_get_partition_constraintdef(c.oid)
+                FROM pg_inherits i
+                JOIN pg_class c ON c.oid = i.inhrelid
+                WHERE i.inhparent = CAST(:table AS regclass)
+            """), {"table": staging}).all()
+            for partition, _ in partitions:
+                connection.execute(text(f"ALTER TABLE {staging} DETACH PARTITION {quote(staging_name(partition))}"))
+            for partition, check in checks:
+                if check:
+                    connection.execute(text(
+                        f"ALTER TABLE {quote(partition)} ADD CONSTRAINT {quote(partition + '_bound')} CHECK ({check})"
+                    ))
+                connection.execute(text(f"ALTER TABLE {quote(partition)} SET LOGGED"))
+                connection.execute(text(f"ANALYZE {quote(partition)}"))
+            connection.execute(text(f"DROP TABLE {staging}"))
+    except Exception:
+        with bind.begin() as connection:
+            connection.execute(text(f"DROP TABLE IF EXISTS {staging} CASCADE"))
+            for partition, _ in partitions:
+                connection.execute(text(f"DROP TABLE IF EXISTS {quote(staging_name(partition))}"))
+        raise
+
+    # Swap the partitions in one transaction; month partitions go first so the
+    # default one is attached last and no attach has to scan it
+    with bind.begin() as connection:
+        connection.execute(text(f"LOCK TABLE {table} IN ACCESS EXCLUSIVE MODE"))
+        index_names = _partition_index_names(connection, table_name)
+        for partition, _ in partitions:
+            connection.execute(text(f"ALTER TABLE {table} DETACH PARTITION {quote(partition)}"))
+            connection.execute(text(f"DROP TABLE {quote(partition)}"))
+        for partition, bound in partitions:
+            staged = staging_name(partition)
+            connection.execute(text(f"ALTER TABLE {quote(staged)} RENAME TO {quote(partition)}"))
+            connection.execute(text(f"ALTER TABLE {table} ATTACH PARTITION {quote(partition)} {bound}"))
+            connection.execute(text(
+                f"ALTER TABLE {quote(partition)} DROP CONSTRAINT IF EXISTS {quote(staged + '_bound')}"
+            ))
+        for key_names, index_name in _partition_index_names(connection, table_name).items():
+            if index_names.get(key_names, index_name) != index_name:
+                connection.execute(text(f"ALTER INDEX {quote(index_name)} RENAME TO {quote(index_names[key_names])}"))
+        for column_name, sequence in layout["sequences"]:
+            connection.execute(text(
+                f"SELECT setval('{sequence}', COALESCE(MAX({quote(column_name)}), 0) + 1, false) FROM {table}"
+            ))
+        bump_data_version(connection, table_name)
+
+    elapsed = time.perf_counter() - start
+    logger.info(
+        f"Swapped {rows} rows into {len(partitions)} partitions of {table_name} in {elapsed:.2f}s "
+        f"({rows / elapsed if elapsed else 0:,.0f} rows/sec)"
+    )
+    return rows
+
 # Load CSV to Database Table using SQLAlchemy
-def load_csv_to_table(table_name: str, csv_path: str) -> None:
+def load_csv_to_table(table_name: str, csv_path: str, mode: str = LOAD_MODE, bind=None) -> int | None:
     """
     Load data from a CSV file into a database table.
+
+    In "swap" mode the table is rebuilt in a staging table and renamed into
+    place (see `swap_csv_into_table`); in "truncate" mode it is emptied with
+    TRUNCATE ... CASCADE and then loaded.
+
+    Returns:
+        int | None: Number of rows loaded, or None if the load failed.
     """
-    session = SessionLocal()
+    bind = bind or engine
     try:
-        # Clear existing data
-        session.execute(text(f"TRUNCATE TABLE {table_name} RESTART IDENTITY CASCADE"))
-        session.commit()
+        if mode == "swap":
+            rows = swap_csv_into_table(table_name, csv_path, bind=bind)
+        else:
+            # Clear existing data
+            with bind.begin() as connection:
+                clear_table(connection, table_name)
 
-        # Load new data
-        df = pd.read_csv(csv_path)
-        df.to_sql(table_name, con=engine, if_exists="append", index=False)
+            # Load new data
+            rows = copy_csv_to_table(table_name, csv_path, bind=bind)
         logger.info(f"Successfully loaded data into table: {table_name}")
+        return rows
     except IntegrityError as e:
         logger.error(f"Integrity error while loading data into table {table_name}: {e}")
     except Exception as e:
         logger.error(f"Failed to load data into table {table_name}: {e}")
+    return None
+
+def _referenced_tables(table_name: str, metadata=Base.metadata) -> set:
+    """
+    Names of the tables a table points at through its foreign keys.
+    """
+    table = metadata.tables.get(table_name)
+    return {fk.column.table.name for fk in table.foreign_keys} if table is not None else set()
+
+def plan_load_order(table_names, metadata=Base.metadata) -> list:
+    """
+    Group tables into load levels from the foreign keys declared in the models.
+
+    Every table is placed in a later level than the tables it references, so
+    all tables of one level can be loaded at the same time. Tables that are
+    not part of `metadata` have no known dependencies and load in the first
+    level.
+
+    Args:
+        table_names (Iterable[str]): Tables to load.
+        metadata (MetaData): Metadata holding the table definitions.
+
+    Returns:
+        list[list[str]]: Table names grouped by level, in load order.
+
+    Raises:
+        ValueError: If the foreign keys between the tables form a cycle.
+    """
+    table_names = set(table_names)
+    pending = {
+        table_name: (_referenced_tables(table_name, metadata) & table_names) - {table_name}
+        for table_name in table_names
+    }
+
+    levels = []
+    while pending:
+        ready = sorted(name for name, parents in pending.items() if not parents)
+        if not ready:
+            raise ValueError(f"Foreign key cycle between tables: {sorted(pending)}")
+        levels.append(ready)
+        for name in ready:
+            del pending[name]
+        for parents in pending.values():
+            parents.difference_update(ready)
+    return levels
+
+def load_tables(csv_files: dict, parallelism: int = LOAD_PARALLELISM, loader=load_csv_to_table) -> dict:
+    """
+    Load CSV files into their tables level by level, in parallel within a level.
+
+    Tables are ordered with `plan_load_order`. Within a level up to
+    `parallelism` tables load at once, each on its own pooled connection.
+    A table whose parent failed to load is skipped. A timing summary is
+    logged at the end.
+
+    Args:
+        csv_files (dict): CSV path keyed by table name.
+        parallelism (int): Maximum number of tables loaded at the same time.
+        loader (Callable): Function called as `loader(table_name, csv_path, bind=...)`
+            that returns the number of rows loaded or None on failure.
+
+    Returns:
+        dict: Per-table summary with "rows", "seconds" and "status".
+    """
+    parallelism = max(1, parallelism)
+    load_engine = create_pooled_engine(engine.url, name="load", pool_size=parallelism, max_overflow=0)
+    summary = {}
+    failed = set()
+    start = time.perf_counter()
+
+    def run(table_name):
+        table_start = time.perf_counter()
+        rows = loader(table_name, csv_files[table_name], bind=load_engine)
+        return rows, time.perf_counter() - table_start
+
+    try:
+        with ThreadPoolExecutor(max_workers=parallelism) as executor:
+            for level in plan_load_order(csv_files):
+                runnable = []
+                for table_name in level:
+                    if _referenced_tables(table_name) & failed:
+                        logger.warning(f"Skipping {table_name}: a table it references failed to load")
+                        summary[table_name] = {"rows": 0, "seconds": 0.0, "status": "skipped"}
+                        failed.add(table_name)
+                    else:
+                        runnable.append(table_name)
+                for table_name, (rows, seconds) in zip(runnable, executor.map(run, runnable)):
+                    status = "ok" if rows is not None else "failed"
+                    if rows is None:
+                        failed.add(table_name)
+                    summary[table_name] = {"rows": rows or 0, "seconds": seconds, "status": status}
     finally:
-        session.close()
+        load_engine.dispose()
+
+    logger.info(f"Load summary ({time.perf_counter() - start:.2f}s total, parallelism {parallelism}):")
+    for table_name, stats in summary.items():
+        rate = stats["rows"] / stats["seconds"] if stats["seconds"] else 0
+        logger.info(
+            f"  {table_name:<15} {stats['status']:<8} {stats['rows']:>12,} rows "
+            f"{stats['seconds']:>8.2f}s {rate:>12,.0f} rows/sec"
+        )
+    return summary
+
+def load_csv_shards(shards: dict, bind=None) -> dict:
+    """
+    Load tables split across several CSV files, e.g. from
+    `data_generator.generate_sharded_dataset`, in foreign key order.
+
+    The first file of a table replaces its contents ("truncate" mode of
+    `load_csv_to_table`); the others are appended with `copy_csv_to_table`.
+
+    Args:
+        shards (dict): List of CSV paths keyed by table name.
+        bind (Engine, optional): Engine to load through. Defaults to `engine`.
+
+    Returns:
+        dict: Number of rows loaded per table.
+
+    Raises:
+        RuntimeError: If a table fails to load.
+    """
+    rows = {}
+    for level in plan_load_order(shards):
+        for table_name in level:
+            first, *rest = sorted(shards[table_name])
+            loaded = load_csv_to_table(table_name, first, mode="truncate", bind=bind)
+            if loaded is None:
+                raise RuntimeError(f"Failed to load {first}")
+            rows[table_name] = loaded + sum(copy_csv_to_table(table_name, shard, bind=bind) for shard in rest)
+    return rows
 
 # Main ETL Process
 if __name__ == "__main__":
@@ -56,12 +459,55 @@ if __name__ == "__main__":
     folder_path = f"{DATA_FOLDER}*.csv"
     files = glob.glob(folder_path)
 
-    for file_path in files:
-        table_name = path.splitext(path.basename(file_path))[0]
-        load_csv_to_table(table_name, file_path)
+    csv_files = {path.splitext(path.basename(file_path))[0]: file_path for file_path in files}
+    changed_customers = set()
+    try:
+        with stage("csv_load") as current:
+            if INCREMENTAL:
+                # Only merge files whose content changed since the last run
+                manifest = load_manifest()
+                # Customers changed by earlier merges stay pending until they were rescored
+                changed_customers.update(manifest["changed_customers"])
+                summary = load_tables(changed_files(csv_files, manifest), loader=partial(
+                    upsert_csv_to_table, watermarks=manifest["watermarks"], changed_customers=changed_customers
+                ))
+                loaded = [table_name for table_name, stats in summary.items() if stats["status"] == "ok"]
+                record_files(manifest, [csv_files[table_name] for table_name in loaded])
+                manifest["changed_customers"] = sorted(changed_customers)
+                save_manifest(manifest)
+            else:
+                summary = load_tables(csv_files)
+            current.rows_out = sum(stats["rows"] for stats in summary.values())
 
-    # Modeling part (delegated to modeling.py)
-    data_for_predictions = fetch_data_for_predictions()
-    data_with_predictions = train_and_predict(data_for_predictions)
-    populate_results_table(data_with_predictions)
+        # Modeling part (delegated to modeling.py)
+        data_with_predictions = None
+        if SCORING_MODE == "score_only":
+            # Only customers that changed are rescored; retrains when drift is detected
+            score_changed_customers(changed_customer_ids=changed_customers)
+        else:
+            with stage("feature_fetch") as current:
+                data_for_predictions = fetch_data_for_predictions()
+                current.rows_out = len(data_for_predictions)
+            data_with_predictions = train_and_predict(data_for_predictions)
+            populate_results_table(data_with_predictions)
+        with stage("campaign_rollups"):
+            refresh_campaign_rollups()
+        with stage("dashboard_rollups") as current:
+            # A full reload replaces rows in place, which watermarks cannot see
+            reloaded = not INCREMENTAL and any(stats["status"] == "ok" for stats in summary.values())
+            if reloaded:
+                current.rows_out = rebuild_dashboard_rollups()
+            else:
+                current.rows_out = refresh_dashboard_rollups(changed_customer_ids=changed_customers)
+        if changed_customers:
+            # Rescored and recomputed; no longer pending
+            manifest["changed_customers"] = []
+            save_manifest(manifest)
+        with stage("segmentation") as current:
+            if INCREMENTAL or data_with_predictions is None:
+                current.rows_out = update_segments()
+            else:
+                current.rows_out = segment_all_customers(data_with_predictions)
+    finally:
+        write_reports()
     logger.info("ETL process completed.")
@@ -0,0 +1,258 @@
+"""
+Feature Cache
+
+This module stores prepared feature frames as Parquet files under
+`FEATURE_CACHE_DIR`, keyed by the version of the source tables and the
+version of the feature code. A hit loads the file instead of querying the
+database. When the source tables only received appended rows since a cached
+entry, only the affected customers are rebuilt. Old entries are evicted
+least recently used first once the cache exceeds its size budget.
+
+The version of a table is its row count and max id plus its row in
+`data_versions`, which the loaders (`etl`, `incremental`) bump with
+`bump_data_version` in the same transaction as their writes, so in-place
+updates are seen as soon as they commit. Code that writes the source tables
+some other way must bump the version too.
+"""
+
+import datetime
+import hashlib
+import json
+import os
+import time
+
+import pandas as pd
+from loguru import logger
+from sqlalchemy import select, text
+
+from database import engine
+from models import DataVersion
+
+FEATURE_CACHE_DIR = os.environ.get("FEATURE_CACHE_DIR", "cache/features/")
+FEATURE_CACHE_MAX_BYTES = int(os.environ.get("FEATURE_CACHE_MAX_BYTES", 1024 ** 3))
+
+SOURCE_TABLES = {
+    "customers": "customer_id",
+    "usage": "usage_id",
+    "transactions": "transaction_id",
+    "feedback": "feedback_id",
+}
+"""
+dict: Primary key column of every table a feature frame can depend on.
+"""
+
+def bump_data_version(connection, table_name: str, rewrite: bool = True) -> None:
+    """
+    Record a write to a table, inside the transaction of the write.
+
+    Args:
+        connection (Connection): Connection inside the writing transaction.
+        table_name (str): Table written to.
+        rewrite (bool): False when rows were only appended, so cached
+            features can be patched instead of rebuilt.
+    """
+    connection.execute(text("""
+        INSERT INTO data_versions (table_name, version, rewrite_version, updated_at)
+        VALUES (:table_name, 1, :rewrite, :updated_at)
+        ON CONFLICT (table_name) DO UPDATE SET
+            version = data_versions.version + 1,
+            rewrite_version = data_versions.rewrite_version + excluded.rewrite_version,
+            updated_at = excluded.updated_at
+    """), {"table_name": table_name, "rewrite": int(rewrite), "updated_at": datetime.datetime.now()})
+
+def source_data_version(tables=tuple(SOURCE_TABLES), bind=None) -> dict:
+    """
+    Describe the current version of the source tables.
+
+    Args:
+        tables (Iterable[str]): Tables to describe, keys of `SOURCE_TABLES`.
+        bind (Engine, optional): Engine to query. Defaults to `engine`.
+
+    Returns:
+        dict: Per table, "rows", "max_id" and the "version",
+        "rewrite_version" and "updated_at" of its `data_versions` row. On
+        PostgreSQL also "relation" (the files of the table or of its
+        partitions, which change when it is truncated or swapped, e.g. by a
+        cascade from another table).
+    """
+    bind = bind or engine
+    version = {}
+    with bind.connect() as connection:
+        preparer = connection.dialect.identifier_preparer
+        counters = {
+            row.table_name: row
+            for row in connection.execute(
+                select(DataVersion.table_name, DataVersion.version, DataVersion.rewrite_version,
+                       DataVersion.updated_at)
+                .where(DataVersion.table_name.in_(list(tables)))
+            )
+        }
+        for table_name in tables:
+            rows, max_id = connection.execute(text(
+                f"SELECT COUNT(*), MAX({preparer.quote(SOURCE_TABLES[table_name])}) "
+                f"FROM {preparer.quote(table_name)}"
+            )).one()
+            counter = counters.get(table_name)
+            stats = {
+                "rows": rows,
+                "max_id": max_id,
+                "version": counter.version if counter else 0,
+                "rewrite_version": counter.rewrite_version if counter else 0,
+                "updated_at": counter.updated_at.isoformat() if counter else None,
+            }
+            if connection.dialect.name == "postgresql":
+                # Partitioned tables keep their data in the partitions
+                stats["relation"] = connection.execute(text("""
+                    SELECT string_agg(CAST(c.relfilenode AS text), ',' ORDER BY c.oid)
+                    FROM pg_partition_tree(CAST(:table AS regclass)) t
+                    JOIN pg_class c ON c.oid = t.relid
+                    WHERE t.isleaf
+                """), {"table": preparer.quote(table_name)}).scalar()
+            version[table_name] = stats
+    return version
+
+def cache_key(name: str, feature_version: str, data_version: dict) -> str:
+    """
+    Key of a cache entry: a short hash of the frame name, code and data versions.
+    """
+    payload = json.dumps([name, feature_version, data_version], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()[:20]
+
+def _entries(name: str, feature_version: str, cache_dir: str) -> list:
+    """
+    Metadata of the cached entries of one frame and feature version, newest first.
+    """
+    entries = []
+    if not os.path.isdir(cache_dir):
+        return entries
+    for file_name in os.listdir(cache_dir):
+        if file_name.startswith(f"{name}-") and file_name.endswith(".json"):
+            with open(os.path.join(cache_dir, file_name)) as metadata_file:
+                metadata = json.load(metadata_file)
+            if metadata["feature_version"] == feature_version:
+                entries.append(metadata)
+    return sorted(entries, key=lambda metadata: metadata["created_at"], reverse=True)
+
+def _appended_customers(previous: dict, current: dict, bind) -> set | None:
+    """
+    Customers touched by rows appended since `previous`, or None if anything
+    other than appends happened and the frame has to be rebuilt in full.
+    """
+    affected = set()
+    with bind.connect() as connection:
+        preparer = connection.dialect.identifier_preparer
+        for table_name, stats in current.items():
+            before = previous.get(table_name)
+            if before is None:
+                return None
+            if stats == before:
+                continue
+            added = stats["rows"] - before["rows"]
+            if (added <= 0 or before["max_id"] is None
+                    or stats.get("rewrite_version") != before.get("rewrite_version")
+                    or stats.get("relation") != before.get("relation")):
+                return None
+            key = preparer.quote(SOURCE_TABLES[table_name])
+            table = preparer.quote(table_name)
+            appended = connection.execute(
+                text(f"SELECT COUNT(*) FROM {table} WHERE {key} > :max_id"),
+                {"max_id": before["max_id"]},
+            ).scalar()
+            if appended != added:
+                return None
+            affected.update(connection.execute(
+                text(f"SELECT DISTINCT customer_id FROM {table} WHERE {key} > :max_id"),
+                {"max_id": before["max_id"]},
+            ).scalars())
+    return affected
+
+def evict(cache_dir: str = FEATURE_CACHE_DIR, max_bytes: int = FEATURE_CACHE_MAX_BYTES, keep=()) -> None:
+    """
+    Delete least recently used entries until the cache fits in `max_bytes`.
+
+    Args:
+        cache_dir (str): Cache folder.
+        max_bytes (int): Size budget of all Parquet files together.
+        keep (Iterable[str]): Keys that must not be evicted.
+    """
+    if not os.path.isdir(cache_dir):
+        return
+    entries = []
+    for file_name in os.listdir(cache_dir):
+        if file_name.endswith(".parquet"):
+            stat = os.stat(os.path.join(cache_dir, file_name))
+            entries.append((stat.st_mtime, stat.st_size, file_name[:-len(".parquet")]))
+    total = sum(size for _, size, _ in entries)
+    for _, size, stem in sorted(entries):
+        if total <= max_bytes:
+            break
+        if stem.rsplit("-", 1)[-1] in keep:
+            continue
+        for suffix in (".parquet", ".json"):
+            if os.path.exists(os.path.join(cache_dir, stem + suffix)):
+                os.remove(os.path.join(cache_dir, stem + suffix))
+        total -= size
+        logger.info(f"Evicted feature cache entry {stem}")
+
+def load_or_build(name: str, feature_version: str, build, tables=tuple(SOURCE_TABLES),
+                  cache_dir: str = FEATURE_CACHE_DIR, max_bytes: int = FEATURE_CACHE_MAX_BYTES, bind=None):
+    """
+    Return a cached feature frame, building or patching it when needed.
+
+    Args:
+        name (str): Name of the frame, e.g. "prediction_features".
+        feature_version (str): Version of the code that builds the frame; bump
+            it whenever the features change.
+        build (Callable): `build(customer_ids=None)` returns the frame for all
+            customers, or only for the given ones. The frame must have a
+            `customer_id` column.
+        tables (Iterable[str]): Source tables the frame depends on.
+        cache_dir (str): Cache folder.
+        max_bytes (int): Size budget of the cache.
+        bind (Engine, optional): Engine to query. Defaults to `engine`.
+
+    Returns:
+        DataFrame: The feature frame for the current data.
+    """
+    bind = bind or engine
+    start = time.perf_counter()
+    data_version = source_data_version(tables, bind)
+    key = cache_key(name, feature_version, data_version)
+    stem = os.path.join(cache_dir, f"{name}-{key}")
+
+    if os.path.exists(f"{stem}.parquet"):
+        os.utime(f"{stem}.parquet")
+        frame = pd.read_parquet(f"{stem}.parquet")
+        logger.info(f"Feature cache hit for {name} ({len(frame)} rows, {time.perf_counter() - start:.2f}s)")
+        return frame
+
+    frame = None
+    previous_entries = _entries(name, feature_version, cache_dir)
+    if previous_entries:
+        previous = previous_entries[0]
+        affected = _appended_customers(previous["data_version"], data_version, bind)
+        if affected is not None:
+            cached = pd.read_parquet(os.path.join(cache_dir, f"{name}-{previous['key']}.parquet"))
+            unchanged = cached[~cached["customer_id"].isin(affected)]
+            parts = [unchanged, build(customer_ids=sorted(affected))] if affected else [unchanged]
+            parts = [part for part in parts if not part.empty] or [cached]
+            frame = pd.concat(parts, ignore_index=True).sort_values("customer_id", kind="stable")
+            frame = frame.reset_index(drop=True)
+            logger.info(f"Feature cache patched {name}: rebuilt {len(affected)} customers")
+    if frame is None:
+        frame = build(customer_ids=None)
+        logger.info(f"Feature cache miss for {name}: rebuilt {len(frame)} rows")
+
+    os.makedirs(cache_dir, exist_ok=True)
+    frame.to_parquet(f"{stem}.parquet.tmp", index=False)
+    os.replace(f"{stem}.parquet.tmp", f"{stem}.parquet")
+    with open(f"{stem}.json", "w") as metadata_file:
+        json.dump({
+            "name": name,
+            "key": key,
+            "feature_version": feature_version,
+            "data_version": data_version,
+            "created_at": time.time(),
+        }, metadata_file, default=str)
+    evict(cache_dir, max_bytes, keep={key})
+    return frame
@@ -0,0 +1,362 @@
+"""
+Incremental Loading
+
+This module keeps a manifest of the input CSV files so unchanged files can be
+skipped, and merges the rows of changed files into their tables with
+`INSERT ... ON CONFLICT DO UPDATE` keyed on the primary key of each table.
+Append-only tables only read rows past their high-water mark: the mark
+recorded in the manifest after the last merge, or the table's current
+maximum when that is lower (e.g. the table was emptied since). Rows that
+already hold the merged values are left alone, and the customers of the rows
+that were inserted or updated are returned by the merge (`RETURNING`), so
+rows changed in place can be rescored; the ETL run keeps them in the
+manifest until they were.
+"""
+
+import csv
+import hashlib
+import io
+import json
+import os
+import time
+
+from loguru import logger
+from sqlalchemy import inspect, text
+
+from database import engine
+from feature_cache import bump_data_version
+from models import Base
+
+MANIFEST_PATH = "data/.manifest.json"
+"""
+str: Location of the manifest that records the fingerprint of every loaded file.
+"""
+
+APPEND_ONLY_TABLES = {
+    "usage": "usage_id",
+    "transactions": "transaction_id",
+    "feedback": "feedback_id",
+}
+"""
+dict: High-water mark column of each append-only table. Only rows whose value
+is above the table's watermark are merged. The ids are used rather than
+`payment_date` because generated dates are not monotonic.
+"""
+
+HASH_CHUNK_SIZE = 1024 * 1024  # Bytes read per hashing step
+UPSERT_CHUNK_SIZE = 10_000  # Rows per executemany batch on non-Postgres engines
+COPY_BUFFER_SIZE = 1024 * 1024  # Bytes handed to each COPY read
+
+def load_manifest(manifest_path: str = MANIFEST_PATH) -> dict:
+    """
+    Read the manifest, or return an empty one if it does not exist yet.
+
+    Returns:
+        dict: Manifest with "files" (fingerprints by path), "watermarks"
+        (highest id merged from the files, by table) and "changed_customers"
+        (customers whose rows merges changed and that were not rescored yet).
+    """
+    if not os.path.exists(manifest_path):
+        return {"files": {}, "watermarks": {}, "changed_customers": []}
+    with open(manifest_path) as manifest_file:
+        manifest = json.load(manifest_file)
+    manifest.setdefault("changed_customers", [])
+    return manifest
+
+def save_manifest(manifest: dict, manifest_path: str = MANIFEST_PATH) -> None:
+    """
+    Atomically write the manifest next to the data files.
+    """
+    os.makedirs(os.path.dirname(manifest_path) or ".", exist_ok=True)
+    with open(f"{manifest_path}.tmp", "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+    os.replace(f"{manifest_path}.tmp", manifest_path)
+
+def file_fingerprint(csv_path: str, previous: dict | None = None) -> dict:
+    """
+    Fingerprint a file by size, modification time and SHA-256 of its content.
+
+    The content is only hashed when size or modification time differ from
+    `previous`, so checking an untouched dataset costs one `stat` per file.
+
+    Args:
+        csv_path (str): Path of the file.
+        previous (dict, optional): Fingerprint recorded in the manifest.
+
+    Returns:
+        dict: Fingerprint with "size", "mtime_ns" and "sha256".
+    """
+    stat = os.stat(csv_path)
+    if previous and previous["size"] == stat.st_size and previous["mtime_ns"] == stat.st_mtime_ns:
+        return previous
+    digest = hashlib.sha256()
+    with open(csv_path, "rb") as data_file:
+        for chunk in iter(lambda: data_file.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": digest.hexdigest()}
+
+def changed_files(csv_files: dict, manifest: dict) -> dict:
+    """
+    Select the files whose content differs from the manifest.
+
+    Args:
+        csv_files (dict): CSV path keyed by table name.
+        manifest (dict): Manifest returned by `load_manifest`.
+
+    Returns:
+        dict: The subset of `csv_files` that has to be loaded.
+    """
+    changed = {}
+    for table_name, csv_path in csv_files.items():
+        previous = manifest["files"].get(csv_path)
+        fingerprint = file_fingerprint(csv_path, previous)
+        if previous is None or fingerprint["sha256"] != previous["sha256"]:
+            changed[table_name] = csv_path
+        else:
+            logger.info(f"Skipping unchanged file: {csv_path}")
+    return changed
+
+def record_files(manifest: dict, csv_paths) -> None:
+    """
+    Store the current fingerprint of successfully loaded files in the manifest.
+    """
+    for csv_path in csv_paths:
+        manifest["files"][csv_path] = file_fingerprint(csv_path, manifest["files"].get(csv_path))
+
+def primary_key_columns(table_name: str, connection=None) -> list:
+    """
+    Primary key column names of a table.
+
+    The key is read from the database when a connection is given, since it
+    can differ from the models: tables partitioned by month (see
+    `update_schema`) have the partition column in their key. Falls back to
+    the key declared in the models.
+    """
+    if connection is not None:
+        columns = inspect(connection).get_pk_constraint(table_name)["constrained_columns"]
+        if columns:
+            return columns
+    return [column.name for column in Base.metadata.tables[table_name].primary_key.columns]
+
+def read_watermark(connection, table_name: str, column: str):
+    """
+    Current high-water mark of an append-only table, or None if it is empty.
+    """
+    preparer = connection.dialect.identifier_preparer
+    return connection.execute(
+        text(f"SELECT MAX({preparer.quote(column)}) FROM {preparer.quote(table_name)}")
+    ).scalar()
+
+class _CsvRowStream(io.TextIOBase):
+    """
+    File-like view of an iterable of CSV records, read by COPY in chunks.
+    """
+
+    def __init__(self, records):
+        self._records = iter(records)
+        self._buffer = ""
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        out = io.StringIO()
+        writer = csv.writer(out, lineterminator="\n")
+        while size < 0 or len(self._buffer) + out.tell() < size:
+            record = next(self._records, None)
+            if record is None:
+                break
+            writer.writerow(record)
+        data = self._buffer + out.getvalue()
+        if size < 0:
+            self._buffer = ""
+            return data
+        self._buffer = data[size:]
+        return data[:size]
+
+def _returning(columns) -> str:
+    """
+    RETURNING clause reporting the customer of every merged row, if the table has one.
+    """
+    return ' RETURNING "customer_id"' if "customer_id" in columns else ""
+
+def _merge_records_postgres(connection, table_name, columns, key_columns, records) -> tuple:
+    """
+    COPY records into a temporary table and merge it with one INSERT ... SELECT.
+
+    Returns:
+        tuple: (rows inserted or updated, their customer ids)
+    """
+    preparer = connection.dialect.identifier_preparer
+    table = preparer.quote(table_name)
+    staging = preparer.quote(f"{table_name}__incoming")
+    column_list = ", ".join(preparer.quote(column) for column in columns)
+    updates = [column for column in columns if column not in key_columns]
+
+    connection.execute(text(
+        f"CREATE TEMP TABLE {staging} (LIKE {table} INCLUDING DEFAULTS) ON COMMIT DROP"
+    ))
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert(
+            f"COPY {staging} ({column_list}) FROM STDIN WITH (FORMAT csv)",
+            _CsvRowStream(records),
+            size=COPY_BUFFER_SIZE,
+        )
+    finally:
+        cursor.close()
+
+    conflict = ", ".join(preparer.quote(column) for column in key_columns)
+    if updates:
+        assignments = ", ".join(f"{preparer.quote(c)} = EXCLUDED.{preparer.quote(c)}" for c in updates)
+        current = ", ".join(f"{table}.{preparer.quote(c)}" for c in updates)
+        incoming = ", ".join(f"EXCLUDED.{preparer.quote(c)}" for c in updates)
+        # Rows that did not change are left alone instead of being rewritten
+        action = f"DO UPDATE SET {assignments} WHERE ({current}) IS DISTINCT FROM ({incoming})"
+    else:
+        action = "DO NOTHING"
+    result = connection.execute(text(
+        f"INSERT INTO {table} ({column_list}) SELECT {column_list} FROM {staging} "
+        f"ON CONFLICT ({conflict}) {action}{_returning(columns)}"
+    ))
+    if not _returning(columns):
+        return result.rowcount, set()
+    customer_ids = [customer_id for customer_id, in result]
+    return len(customer_ids), {customer_id for customer_id in customer_ids if customer_id is not None}
+
+def _merge_records_generic(connection, table_name, columns, key_columns, records) -> tuple:
+    """
+    Insert records into a temporary table in chunked executemany batches and
+    merge it with one INSERT ... SELECT (SQLite and other engines).
+
+    Returns:
+        tuple: (rows inserted or updated, their customer ids)
+    """
+    preparer = connection.dialect.identifier_preparer
+    table = preparer.quote(table_name)
+    staging = preparer.quote(f"{table_name}__incoming")
+    column_list = ", ".join(preparer.quote(column) for column in columns)
+    placeholders = ", ".join(f":p{i}" for i in range(len(columns)))
+    conflict = ", ".join(preparer.quote(column) for column in key_columns)
+    updates = [column for column in columns if column not in key_columns]
+
+    connection.execute(text(f"DROP TABLE IF EXISTS {staging}"))
+    connection.execute(text(f"CREATE TEMP TABLE {staging} AS SELECT {column_list} FROM {table} WHERE 0"))
+    insert = text(f"INSERT INTO {staging} ({column_list}) VALUES ({placeholders})")
+    batch = []
+    for record in records:
+        batch.append({f"p{i}": value if value != "" else None for i, value in enumerate(record)})
+        if len(batch) == UPSERT_CHUNK_SIZE:
+            connection.execute(insert, batch)
+            batch = []
+    if batch:
+        connection.execute(insert, batch)
+
+    if updates:
+        assignments = ", ".join(f"{preparer.quote(c)} = excluded.{preparer.quote(c)}" for c in updates)
+        current = ", ".join(f"{table}.{preparer.quote(c)}" for c in updates)
+        incoming = ", ".join(f"excluded.{preparer.quote(c)}" for c in updates)
+        # Rows that did not change are left alone instead of being rewritten
+        action = f"DO UPDATE SET {assignments} WHERE ({current}) IS NOT ({incoming})"
+    else:
+        action = "DO NOTHING"
+    # "WHERE true" keeps SQLite from reading ON CONFLICT as a join constraint
+    result = connection.execute(text(
+        f"INSERT INTO {table} ({column_list}) SELECT {column_list} FROM {staging} WHERE true "
+        f"ON CONFLICT ({conflict}) {action}{_returning(columns)}"
+    ))
+    if _returning(columns):
+        customer_ids = [customer_id for customer_id, in result]
+        rows, customer_ids = len(customer_ids), {int(c) for c in customer_ids if c is not None}
+    else:
+        rows, customer_ids = result.rowcount, set()
+    connection.execute(text(f"DROP TABLE {staging}"))
+    return rows, customer_ids
+
+def merge_watermark(connection, table_name: str, recorded=None):
+    """
+    High-water mark below which the rows of an append-only table are skipped.
+
+    The mark recorded in the manifest wins, so rows written to the table by
+    something other than the CSV merge do not hide file rows below them. The
+    current maximum is used when no mark was recorded, or when it is lower,
+    since then rows were removed from the table after the last merge.
+
+    Returns:
+        int | None: The watermark, or None to merge every row.
+    """
+    current = read_watermark(connection, table_name, APPEND_ONLY_TABLES[table_name])
+    if recorded is None or current is None:
+        return current
+    return min(recorded, current)
+
+def upsert_csv_to_table(table_name: str, csv_path: str, bind=None, watermarks: dict | None = None,
+                        changed_customers: set | None = None) -> int | None:
+    """
+    Merge the new or changed rows of a CSV file into a table.
+
+    Rows are inserted, or update the existing row with the same primary key.
+    For tables in `APPEND_ONLY_TABLES` only rows above `merge_watermark` are
+    read. The signature matches `etl.load_csv_to_table` so it can be used as
+    the loader of `etl.load_tables`.
+
+    Args:
+        table_name (str): Name of the target table.
+        csv_path (str): Path to the CSV file containing data.
+        bind (Engine, optional): Engine to load through. Defaults to `engine`.
+        watermarks (dict, optional): The manifest's "watermarks"; the highest
+            merged id of the table is stored in it after a successful merge.
+        changed_customers (set, optional): Receives the customers of the
+            rows inserted or updated, after a successful merge.
+
+    Returns:
+        int | None: Number of rows inserted or updated, or None if the merge failed.
+    """
+    bind = bind or engine
+    start = time.perf_counter()
+    try:
+        with bind.begin() as connection, open(csv_path, newline="") as csv_file:
+            key_columns = primary_key_columns(table_name, connection)
+            reader = csv.reader(csv_file)
+            columns = next(reader)
+            records = reader
+
+            watermark_column = APPEND_ONLY_TABLES.get(table_name)
+            highest = None
+            # Existing rows can only change when the merge may hit ids already in the table
+            rewrite = True
+            if watermark_column in columns:
+                watermark = merge_watermark(connection, table_name, (watermarks or {}).get(table_name))
+                rewrite = watermark != read_watermark(connection, table_name, watermark_column)
+                position = columns.index(watermark_column)
+                highest = watermark
+
+                def past_watermark(records):
+                    nonlocal highest
+                    for record in records:
+                        value = int(record[position])
+                        if watermark is None or value > watermark:
+                            highest = value if highest is None else max(highest, value)
+                            yield record
+
+                records = past_watermark(reader)
+                if watermark is not None:
+                    logger.info(f"Merging {table_name} rows with {watermark_column} > {watermark}")
+
+            if connection.dialect.name == "postgresql":
+                rows, customer_ids = _merge_records_postgres(connection, table_name, columns, key_columns, records)
+            else:
+                rows, customer_ids = _merge_records_generic(connection, table_name, columns, key_columns, records)
+            bump_data_version(connection, table_name, rewrite=rewrite)
+    except Exception as e:
+        logger.error(f"Failed to merge data into table {table_name}: {e}")
+        return None
+
+    if watermarks is not None and highest is not None:
+        # Only recorded once the merge committed
+        watermarks[table_name] = highest
+    if changed_customers is not None:
+        changed_customers.update(customer_ids)
+    elapsed = time.perf_counter() - start
+    logger.info(f"Merged {rows} new or changed rows into {table_name} in {elapsed:.2f}s")
+    return rows
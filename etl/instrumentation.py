@@ -0,0 +1,292 @@
+"""
+Pipeline Instrumentation
+
+This module measures every stage of a pipeline run: wall time, CPU time,
+peak resident memory, rows in and out, and the SQL statements and database
+round trips issued while the stage ran. SQL activity is counted by
+SQLAlchemy engine events registered on every `Engine`, so engines created
+anywhere in the pipeline are included. Resident memory is sampled every
+`RSS_SAMPLE_SECONDS` by a background thread while any stage is open, and
+each stage keeps the highest sample of its own time window.
+
+Usage:
+
+    with stage("feature_fetch") as current:
+        data = fetch_data_for_predictions()
+        current.rows_out = len(data)
+
+    write_reports()
+
+The run is written as a JSON report and as a Prometheus textfile (for the
+node exporter's textfile collector), so runs can be compared over time.
+Both include the wait and checkout times of every connection pool created
+by `database.create_pooled_engine`.
+"""
+
+import json
+import os
+import resource
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from loguru import logger
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from database import pool_metrics
+
+RUN_REPORT_PATH = os.environ.get("RUN_REPORT_PATH", "reports/run_report.json")
+RSS_SAMPLE_SECONDS = float(os.environ.get("RSS_SAMPLE_SECONDS", 0.05))  # Interval of the memory sampler
+PROMETHEUS_TEXTFILE_PATH = os.environ.get("PROMETHEUS_TEXTFILE_PATH", "reports/etl_pipeline.prom")
+
+_sql_lock = threading.Lock()
+_sql_counters = {"round_trips": 0, "statements": 0}
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _count_sql(conn, cursor, statement, parameters, context, executemany):
+    """
+    Count one round trip per cursor execution and one statement per
+    parameter set, so batched `executemany` calls show up as such.
+    """
+    statements = len(parameters) if executemany and parameters else 1
+    with _sql_lock:
+        _sql_counters["round_trips"] += 1
+        _sql_counters["statements"] += statements
+
+def sql_counters() -> dict:
+    """
+    Round trips and statements counted since the process started.
+
+    `COPY` sent through a raw DBAPI cursor bypasses the engine events and is
+    not counted.
+    """
+    with _sql_lock:
+        return dict(_sql_counters)
+
+def _rss_bytes() -> int:
+    """
+    Current RSS of this process (Linux), or its peak since start elsewhere.
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+class _RssSampler:
+    """
+    Samples the RSS of the process while stages are open and raises the
+    `peak_rss_bytes` of every open stage to each sample.
+
+    RSS is process-wide, so stages that overlap in time, e.g. on the threads
+    of `etl.load_tables` or the pipeline runner, each see the memory of the
+    others during their window.
+    """
+
+    def __init__(self, interval=RSS_SAMPLE_SECONDS):
+        self.interval = interval
+        self._open = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def _record(self, stages) -> None:
+        rss = _rss_bytes()
+        for metrics in stages:
+            metrics.peak_rss_bytes = max(metrics.peak_rss_bytes, rss)
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                if not self._open:
+                    self._thread = None
+                    return
+                self._record(self._open)
+
+    def open(self, metrics) -> None:
+        with self._lock:
+            self._record([metrics])
+            self._open.add(metrics)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="rss-sampler", daemon=True)
+                self._thread.start()
+
+    def close(self, metrics) -> None:
+        with self._lock:
+            self._record([metrics])
+            self._open.discard(metrics)
+
+_rss_sampler = _RssSampler()
+
+class StageMetrics:
+    """
+    Measurements of one stage; set `rows_in`/`rows_out` inside the stage.
+    """
+
+    def __init__(self, name, rows_in=None):
+        self.name = name
+        self.rows_in = rows_in
+        self.rows_out = None
+        self.status = "ok"
+        self.wall_seconds = 0.0
+        self.cpu_seconds = 0.0
+        self.peak_rss_bytes = 0
+        self.sql_round_trips = 0
+        self.sql_statements = 0
+
+    def as_dict(self) -> dict:
+        return {key: value for key, value in vars(self).items() if not key.startswith("_")}
+
+class RunRecorder:
+    """
+    Collects the stages of one pipeline run.
+
+    Stages may run on several threads; SQL counts and RSS are process-wide,
+    so overlapping stages each include the other's statements and memory.
+    Stages can be nested: the peak RSS of a stage covers its inner stages.
+    """
+
+    def __init__(self, pipeline="etl"):
+        self.pipeline = pipeline
+        self.run_id = uuid.uuid4().hex
+        self.started_at = time.time()
+        self.stages = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name, rows_in=None):
+        """
+        Measure the enclosed block as one stage.
+
+        Yields:
+            StageMetrics: Set `rows_out` (and `rows_in`) on it.
+        """
+        metrics = StageMetrics(name, rows_in)
+        _rss_sampler.open(metrics)
+        sql_before = sql_counters()
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            yield metrics
+        except BaseException:
+            metrics.status = "failed"
+            raise
+        finally:
+            metrics.wall_seconds = time.perf_counter() - wall_start
+            metrics.cpu_seconds = time.process_time() - cpu_start
+            _rss_sampler.close(metrics)
+            sql_after = sql_counters()
+            metrics.sql_round_trips = sql_after["round_trips"] - sql_before["round_trips"]
+            metrics.sql_statements = sql_after["statements"] - sql_before["statements"]
+            with self._lock:
+                self.stages.append(metrics)
+            logger.info(
+                f"Stage {name} {metrics.status}: {metrics.wall_seconds:.2f}s wall, "
+                f"{metrics.cpu_seconds:.2f}s CPU, peak RSS {metrics.peak_rss_bytes / 1024 ** 2:.0f} MiB, "
+                f"rows {metrics.rows_in} -> {metrics.rows_out}, "
+                f"{metrics.sql_round_trips} round trips / {metrics.sql_statements} statements"
+            )
+
+    def report(self) -> dict:
+        """
+        The run as a JSON-serializable dict.
+        """
+        with self._lock:
+            stages = [metrics.as_dict() for metrics in self.stages]
+        return {
+            "pipeline": self.pipeline,
+            "run_id": self.run_id,
+            "started_at": self.started_at,
+            "wall_seconds": time.time() - self.started_at,
+            "stages": stages,
+            "pools": pool_metrics(),
+        }
+
+    def write_json(self, path: str = RUN_REPORT_PATH) -> None:
+        """
+        Atomically write the JSON run report.
+        """
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(f"{path}.tmp", "w") as report_file:
+            json.dump(self.report(), report_file, indent=2)
+        os.replace(f"{path}.tmp", path)
+
+    def write_prometheus(self, path: str = PROMETHEUS_TEXTFILE_PATH) -> None:
+        """
+        Atomically write the run as a Prometheus textfile.
+
+        The last run of each stage wins when a stage name repeats.
+        """
+        report = self.report()
+        gauges = {
+            "wall_seconds": "Wall-clock time of the stage",
+            "cpu_seconds": "CPU time of the process during the stage",
+            "peak_rss_bytes": "Peak resident memory during the stage",
+            "rows_in": "Rows read by the stage",
+            "rows_out": "Rows produced by the stage",
+            "sql_round_trips": "Cursor executions during the stage",
+            "sql_statements": "SQL statements (parameter sets) during the stage",
+        }
+        latest = {stage["name"]: stage for stage in report["stages"]}
+
+        def labels(stage):
+            return f'pipeline="{self.pipeline}",stage="{stage["name"]}"'
+
+        lines = []
+        for field, description in gauges.items():
+            metric = f"{self.pipeline}_stage_{field}"
+            lines += [f"# HELP {metric} {description}.", f"# TYPE {metric} gauge"]
+            for stage in latest.values():
+                if stage[field] is not None:
+                    lines.append(f"{metric}{{{labels(stage)}}} {stage[field]}")
+        metric = f"{self.pipeline}_stage_success"
+        lines += [f"# HELP {metric} 1 if the stage succeeded.", f"# TYPE {metric} gauge"]
+        lines += [f"{metric}{{{labels(stage)}}} {int(stage['status'] == 'ok')}" for stage in latest.values()]
+        pool_gauges = {
+            "acquisitions": "Connections requested from the pool",
+            "timeouts": "Connection requests that timed out",
+            "wait_seconds_total": "Time spent waiting for pooled connections",
+            "wait_seconds_max": "Longest wait for a pooled connection",
+            "checkouts": "Connections returned to the pool",
+            "checkout_seconds_total": "Time connections were checked out",
+            "checkout_seconds_max": "Longest time a connection was checked out",
+            "checked_out": "Connections checked out when the report was written",
+        }
+        for field, description in pool_gauges.items():
+            metric = f"{self.pipeline}_db_pool_{field}"
+            lines += [f"# HELP {metric} {description}.", f"# TYPE {metric} gauge"]
+            for name, pool in report["pools"].items():
+                if field in pool:
+                    lines.append(f'{metric}{{pipeline="{self.pipeline}",pool="{name}"}} {pool[field]}')
+        lines += [
+            f"# HELP {self.pipeline}_run_wall_seconds Wall-clock time of the run.",
+            f"# TYPE {self.pipeline}_run_wall_seconds gauge",
+            f"{self.pipeline}_run_wall_seconds {report['wall_seconds']}",
+            f"# HELP {self.pipeline}_run_timestamp_seconds Start of the run.",
+            f"# TYPE {self.pipeline}_run_timestamp_seconds gauge",
+            f"{self.pipeline}_run_timestamp_seconds {report['started_at']}",
+        ]
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(f"{path}.tmp", "w") as textfile:
+            textfile.write("\n".join(lines) + "\n")
+        os.replace(f"{path}.tmp", path)
+
+recorder = RunRecorder()
+"""
+RunRecorder: Recorder of the current process, used by `stage` and `write_reports`.
+"""
+
+def stage(name, rows_in=None):
+    """
+    Measure a stage with the process recorder; see `RunRecorder.stage`.
+    """
+    return recorder.stage(name, rows_in)
+
+def write_reports(json_path: str = RUN_REPORT_PATH, prometheus_path: str = PROMETHEUS_TEXTFILE_PATH) -> None:
+    """
+    Write the JSON report and the Prometheus textfile of the process recorder.
+    """
+    recorder.write_json(json_path)
+    recorder.write_prometheus(prometheus_path)
+    logger.info(f"Run report written to {json_path} and {prometheus_path}")
@@ -0,0 +1,310 @@
+"""
+Model Registry
+
+This module stores every trained model as a numbered version instead of
+overwriting one file. Each version lives in its own folder under
+`MODEL_REGISTRY_DIR/<name>/vNNNN/` with:
+
+- `model.joblib`: the estimator, dumped uncompressed with joblib.
+- `forest.joblib`: for random forest and extra trees classifiers, the nodes
+  of all trees as flat NumPy arrays (see `forest_arrays`).
+- `metadata.json`: feature schema, training data version, evaluation
+  metrics, and the cold-load time and resident memory measured for the
+  artifact `load_model` reads, in a fresh process.
+
+scikit-learn trees copy their nodes into memory they own when unpickled,
+so mapping `model.joblib` shares nothing for a forest. `load_model` with an
+`mmap_mode` therefore maps `forest.joblib` instead and predicts with
+`MappedForestClassifier`, which walks the mapped arrays directly: every
+process serving the same version shares those pages through the OS page
+cache. Other estimators are loaded from `model.joblib`.
+
+A `LATEST` file in the model folder points at the newest version.
+"""
+
+import json
+import os
+import subprocess
+import sys
+import time
+
+import joblib
+import numpy as np
+import pandas as pd
+import sklearn
+from loguru import logger
+from sklearn.ensemble import ExtraTreesClassifier, RandomForestClassifier
+
+MODEL_REGISTRY_DIR = os.environ.get("MODEL_REGISTRY_DIR", "models/")
+MODEL_FILE = "model.joblib"
+FOREST_FILE = "forest.joblib"
+METADATA_FILE = "metadata.json"
+
+# Loads an artifact in a clean interpreter and reports time and memory as JSON.
+# The estimator's module is imported first so only the artifact itself is measured.
+_PROFILE_SCRIPT = """
+import importlib, json, os, sys, time
+import joblib
+if sys.argv[3]:
+    importlib.import_module(sys.argv[3])
+
+def rss():
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+before = rss()
+start = time.perf_counter()
+model = joblib.load(sys.argv[1], mmap_mode=sys.argv[2] if sys.argv[2] != "None" else None)
+seconds = time.perf_counter() - start
+print(json.dumps({"cold_load_seconds": seconds, "rss_bytes": rss(), "rss_delta_bytes": rss() - before}))
+"""
+
+def forest_arrays(model) -> dict | None:
+    """
+    Nodes of every tree of a fitted forest classifier as flat arrays.
+
+    Child indices point into the concatenated arrays, and each node keeps
+    the class distribution of its training samples, so predicting needs
+    nothing but these arrays.
+
+    Returns:
+        dict | None: "roots", "children_left", "children_right", "feature",
+        "threshold", "missing_go_to_left", "proba", "classes" and
+        "feature_names", or None for other estimators.
+    """
+    if not isinstance(model, (RandomForestClassifier, ExtraTreesClassifier)) or model.n_outputs_ != 1:
+        return None
+    trees = [estimator.tree_ for estimator in model.estimators_]
+    offsets = np.cumsum([0] + [tree.node_count for tree in trees])[:-1]
+
+    def children(tree, offset, side):
+        child = getattr(tree, side).astype(np.int64)
+        return np.where(child >= 0, child + offset, -1)
+
+    proba = np.concatenate([tree.value[:, 0, :] for tree in trees]).astype(np.float64)
+    totals = proba.sum(axis=1, keepdims=True)
+    return {
+        "roots": offsets.astype(np.int64),
+        "children_left": np.concatenate([children(tree, offset, "children_left")
+                                         for tree, offset in zip(trees, offsets)]),
+        "children_right": np.concatenate([children(tree, offset, "children_right")
+                                          for tree, offset in zip(trees, offsets)]),
+        "feature": np.concatenate([tree.feature for tree in trees]).astype(np.int64),
+        "threshold": np.concatenate([tree.threshold for tree in trees]).astype(np.float64),
+        "missing_go_to_left": np.concatenate([
+            np.asarray(getattr(tree, "missing_go_to_left", np.zeros(tree.node_count)), dtype=np.uint8)
+            for tree in trees
+        ]),
+        "proba": np.divide(proba, totals, out=np.zeros_like(proba), where=totals > 0),
+        "classes": np.asarray(model.classes_),
+        "feature_names": np.asarray(getattr(model, "feature_names_in_", []), dtype=object),
+    }
+
+class MappedForestClassifier:
+    """
+    Forest classifier predicting from the arrays of `forest_arrays`.
+
+    The arrays are only read, so they can be memory-mapped from the registry
+    and shared by every process. Predictions match the forest they were
+    exported from. It is faster than the forest on the small batches of the
+    scoring service but slower on large frames, so bulk scoring in a single
+    process should load the estimator itself with `mmap_mode=None`.
+    """
+
+    def __init__(self, arrays: dict):
+        self.arrays = arrays
+        self.classes_ = np.asarray(arrays["classes"])
+        if len(arrays["feature_names"]):
+            self.feature_names_in_ = np.asarray(arrays["feature_names"], dtype=object)
+        self.n_estimators = len(arrays["roots"])
+
+    def predict_proba(self, X):
+        """
+        Mean class distribution of the leaves each row reaches.
+        """
+        if isinstance(X, pd.DataFrame) and hasattr(self, "feature_names_in_"):
+            X = X[list(self.feature_names_in_)]
+        # Trees compare float32 features against float64 thresholds, as in scikit-learn
+        X = np.asarray(X, dtype=np.float32)
+        arrays = self.arrays
+        left, right = arrays["children_left"], arrays["children_right"]
+        roots = np.asarray(arrays["roots"])
+        # All trees are walked together, one level per step, for every (row, tree) pair
+        node = np.tile(roots, len(X))
+        sample = np.repeat(np.arange(len(X)), len(roots))
+        active = np.arange(len(node))
+        while active.size:
+            current = node[active]
+            inner = left[current] >= 0
+            active, current = active[inner], current[inner]
+            values = X[sample[active], arrays["feature"][current]]
+            go_left = np.where(np.isnan(values), arrays["missing_go_to_left"][current] == 1,
+                               values <= arrays["threshold"][current])
+            node[active] = np.where(go_left, left[current], right[current])
+        return arrays["proba"][node].reshape(len(X), len(roots), -1).mean(axis=1)
+
+    def predict(self, X):
+        return self.classes_[self.predict_proba(X).argmax(axis=1)]
+
+def _model_dir(name, registry_dir):
+    return os.path.join(registry_dir, name)
+
+def profile_artifact(path: str, mmap_mode: str | None = "r", module: str = "") -> dict:
+    """
+    Measure how long an artifact takes to load and how much memory it uses.
+
+    The artifact is loaded in a fresh Python process so the numbers are not
+    skewed by modules or pages already loaded in the caller.
+
+    Args:
+        path (str): Path of a joblib artifact.
+        mmap_mode (str, optional): Passed to `joblib.load`.
+        module (str, optional): Module of the estimator class, imported
+            before the measurement starts.
+
+    Returns:
+        dict: "cold_load_seconds", "rss_bytes" and "rss_delta_bytes", or an
+        empty dict when the measurement is not possible on this platform.
+    """
+    try:
+        output = subprocess.run(
+            [sys.executable, "-c", _PROFILE_SCRIPT, path, str(mmap_mode), module],
+            capture_output=True, text=True, check=True, timeout=600,
+        ).stdout
+        return json.loads(output.strip().splitlines()[-1])
+    except Exception as e:
+        logger.warning(f"Could not profile model artifact {path}: {e}")
+        return {}
+
+def list_versions(name: str = "churn", registry_dir: str = MODEL_REGISTRY_DIR) -> list:
+    """
+    Metadata of all registered versions of a model, oldest first.
+    """
+    model_dir = _model_dir(name, registry_dir)
+    if not os.path.isdir(model_dir):
+        return []
+    versions = []
+    for entry in sorted(os.listdir(model_dir)):
+        metadata_path = os.path.join(model_dir, entry, METADATA_FILE)
+        if entry.startswith("v") and os.path.exists(metadata_path):
+            with open(metadata_path) as metadata_file:
+                versions.append(json.load(metadata_file))
+    return versions
+
+def latest_version(name: str = "churn", registry_dir: str = MODEL_REGISTRY_DIR) -> str | None:
+    """
+    Name of the newest version of a model (e.g. "v0003"), or None.
+    """
+    pointer = os.path.join(_model_dir(name, registry_dir), "LATEST")
+    if not os.path.exists(pointer):
+        return None
+    with open(pointer) as pointer_file:
+        return pointer_file.read().strip()
+
+def register_model(model, name: str = "churn", feature_schema=None, data_version=None, metrics=None,
+                   artifacts=None, extra_metadata=None, registry_dir: str = MODEL_REGISTRY_DIR) -> dict:
+    """
+    Save a model as a new version in the registry.
+
+    Args:
+        model: Fitted estimator.
+        name (str): Model name, one folder per name.
+        feature_schema (list[str], optional): Ordered input columns. Defaults
+            to the estimator's `feature_names_in_`.
+        data_version (dict, optional): Version of the training data, e.g.
+            from `feature_cache.source_data_version`.
+        metrics (dict, optional): Evaluation metrics, e.g. a classification
+            report as a dict.
+        artifacts (dict, optional): Extra objects dumped next to the model
+            with joblib, keyed by file stem (e.g. {"encoder": encoder}).
+        extra_metadata (dict, optional): More fields stored in `metadata.json`.
+        registry_dir (str): Root folder of the registry.
+
+    Returns:
+        dict: The metadata written for the new version.
+    """
+    model_dir = _model_dir(name, registry_dir)
+    os.makedirs(model_dir, exist_ok=True)
+    existing = [entry for entry in os.listdir(model_dir) if entry.startswith("v") and entry[1:].isdigit()]
+    version = f"v{max((int(entry[1:]) for entry in existing), default=0) + 1:04d}"
+    version_dir = os.path.join(model_dir, version)
+    os.makedirs(version_dir)
+
+    model_path = os.path.join(version_dir, MODEL_FILE)
+    joblib.dump(model, model_path)
+    arrays = forest_arrays(model)
+    if arrays is not None:
+        joblib.dump(arrays, os.path.join(version_dir, FOREST_FILE))
+    for stem, artifact in (artifacts or {}).items():
+        joblib.dump(artifact, os.path.join(version_dir, f"{stem}.joblib"))
+
+    if feature_schema is None and hasattr(model, "feature_names_in_"):
+        feature_schema = [str(column) for column in model.feature_names_in_]
+    metadata = {
+        "name": name,
+        "version": version,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "estimator": type(model).__name__,
+        "sklearn_version": sklearn.__version__,
+        "feature_schema": feature_schema,
+        "data_version": data_version,
+        "metrics": metrics,
+        "artifacts": sorted(artifacts or {}),
+        "size_bytes": os.path.getsize(model_path),
+        "forest_arrays": arrays is not None,
+        "load_profile": (profile_artifact(os.path.join(version_dir, FOREST_FILE)) if arrays is not None
+                         else profile_artifact(model_path, module=type(model).__module__)),
+        **(extra_metadata or {}),
+    }
+    with open(os.path.join(version_dir, METADATA_FILE), "w") as metadata_file:
+        json.dump(metadata, metadata_file, indent=2, default=str)
+
+    pointer = os.path.join(model_dir, "LATEST")
+    with open(f"{pointer}.tmp", "w") as pointer_file:
+        pointer_file.write(version)
+    os.replace(f"{pointer}.tmp", pointer)
+    logger.info(f"Registered {name} {version} ({metadata['size_bytes']:,} bytes, load profile {metadata['load_profile']})")
+    return metadata
+
+def load_model(name: str = "churn", version: str | None = None, mmap_mode: str | None = "r",
+               registry_dir: str = MODEL_REGISTRY_DIR):
+    """
+    Load a registered model.
+
+    With an `mmap_mode`, forests saved with `forest.joblib` are returned as
+    a `MappedForestClassifier` over the memory-mapped node arrays, so worker
+    processes loading the same version share those pages through the OS
+    page cache. Other estimators are unpickled from `model.joblib`, where
+    only their plain NumPy attributes are mapped.
+
+    Args:
+        name (str): Model name.
+        version (str, optional): Version to load. Defaults to `LATEST`.
+        mmap_mode (str, optional): Passed to `joblib.load`.
+        registry_dir (str): Root folder of the registry.
+
+    Returns:
+        tuple: (model, metadata)
+
+    Raises:
+        FileNotFoundError: If the model has no registered version.
+    """
+    version = version or latest_version(name, registry_dir)
+    if version is None:
+        raise FileNotFoundError(f"No registered versions of model {name!r} in {registry_dir}")
+    version_dir = os.path.join(_model_dir(name, registry_dir), version)
+    with open(os.path.join(version_dir, METADATA_FILE)) as metadata_file:
+        metadata = json.load(metadata_file)
+    if mmap_mode is not None and metadata.get("forest_arrays"):
+        model = MappedForestClassifier(joblib.load(os.path.join(version_dir, FOREST_FILE), mmap_mode=mmap_mode))
+    else:
+        model = joblib.load(os.path.join(version_dir, MODEL_FILE), mmap_mode=mmap_mode)
+    return model, metadata
+
+def load_artifact(stem: str, name: str = "churn", version: str | None = None,
+                  registry_dir: str = MODEL_REGISTRY_DIR):
+    """
+    Load an extra artifact saved with `register_model(artifacts=...)`.
+    """
+    version = version or latest_version(name, registry_dir)
+    return joblib.load(os.path.join(_model_dir(name, registry_dir), version, f"{stem}.joblib"))
@@ -0,0 +1,229 @@
+"""
+Model Search
+
+This module tunes the churn forest with cross-validated successive halving:
+every configuration in the grid is first scored on a small sample of the
+training rows, and only the best third moves on to the next round with three
+times as many rows. Folds and candidates are fitted on a pool of worker
+processes limited by `SEARCH_CPU_BUDGET`.
+
+The configurations that reach the last round are refitted on the full
+training split and measured on the test split, giving a comparison table of
+fit time, predict latency and quality. `select_candidate` picks the most
+accurate configuration that also meets a latency target.
+"""
+
+import os
+import time
+
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from loguru import logger
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.experimental import enable_halving_search_cv  # noqa: F401
+from sklearn.metrics import accuracy_score, f1_score
+from sklearn.model_selection import HalvingGridSearchCV
+
+# "fixed" fits one forest with preset settings, "search" tunes it with this module
+TRAINING_MODE = os.environ.get("TRAINING_MODE", "fixed")
+SEARCH_CPU_BUDGET = int(os.environ.get("SEARCH_CPU_BUDGET", os.cpu_count() or 1))  # Worker processes
+SEARCH_CV_FOLDS = int(os.environ.get("SEARCH_CV_FOLDS", 5))
+SEARCH_HALVING_FACTOR = 3  # Share of candidates kept per round is 1 / factor
+TARGET_ACCURACY = float(os.environ.get("SEARCH_TARGET_ACCURACY", 0.0))
+TARGET_LATENCY_MS = float(os.environ.get("SEARCH_TARGET_LATENCY_MS", "inf"))  # Single-row p95
+LATENCY_REPEATS = 50  # Single-row predictions timed per candidate
+
+PARAM_GRID = {
+    "n_estimators": [50, 100, 200],
+    "max_depth": [5, 10, None],
+    "min_samples_leaf": [1, 5],
+    "max_features": ["sqrt", 0.5],
+}
+"""
+dict: Default hyperparameter grid of the churn forest.
+"""
+
+def search_hyperparameters(X, y, param_grid=PARAM_GRID, cv=SEARCH_CV_FOLDS,
+                           n_jobs=SEARCH_CPU_BUDGET, random_state=42):
+    """
+    Run a cross-validated successive halving search over a forest grid.
+
+    Args:
+        X (DataFrame): Training features.
+        y (Series): Training labels.
+        param_grid (dict): Hyperparameter grid of `RandomForestClassifier`.
+        cv (int): Number of stratified folds.
+        n_jobs (int): Worker processes; each fit is single-threaded so the
+            total never exceeds the budget.
+        random_state (int): Seed of the forests and the row sampling.
+
+    Returns:
+        HalvingGridSearchCV: The fitted search; the chosen model is fitted
+        by `train_with_search`.
+    """
+    start = time.perf_counter()
+    search = HalvingGridSearchCV(
+        RandomForestClassifier(random_state=random_state, n_jobs=1),
+        param_grid,
+        factor=SEARCH_HALVING_FACTOR,
+        resource="n_samples",
+        min_resources="exhaust",
+        cv=cv,
+        scoring="accuracy",
+        n_jobs=n_jobs,
+        refit=False,
+        random_state=random_state,
+    )
+    search.fit(X, y)
+    logger.info(
+        f"Searched {len(search.cv_results_['params'])} fits of {search.n_candidates_[0]} configurations "
+        f"in {search.n_iterations_} rounds ({time.perf_counter() - start:.1f}s, {n_jobs} workers); "
+        f"best CV accuracy {search.best_score_:.4f} with {search.best_params_}"
+    )
+    return search
+
+def search_history(search):
+    """
+    Every configuration scored in every round of a halving search.
+
+    Returns:
+        DataFrame: One row per configuration and round with "round",
+        "n_samples", the hyperparameters, "cv_accuracy", "fit_seconds" and
+        "predict_ms_per_1k_rows" (mean over the folds).
+    """
+    results = search.cv_results_
+    history = pd.DataFrame(list(results["params"]))
+    history.insert(0, "round", results["iter"])
+    history.insert(1, "n_samples", results["n_resources"])
+    history["cv_accuracy"] = results["mean_test_score"]
+    history["fit_seconds"] = results["mean_fit_time"]
+    # Each fold scores its validation share of the round's samples
+    validation_rows = np.asarray(results["n_resources"]) / search.n_splits_
+    history["predict_ms_per_1k_rows"] = np.asarray(results["mean_score_time"]) * 1000 * 1000 / validation_rows
+    return history.sort_values(["round", "cv_accuracy"], ascending=[True, False]).reset_index(drop=True)
+
+def finalists(search) -> list:
+    """
+    Configurations that reached the last round of a halving search.
+    """
+    results = search.cv_results_
+    last_round = results["iter"].max()
+    return [params for params, round_ in zip(results["params"], results["iter"]) if round_ == last_round]
+
+def _evaluate_candidate(params, X_train, y_train, X_test, y_test, random_state):
+    """
+    Fit one configuration on the full training split and measure it.
+    """
+    model = RandomForestClassifier(random_state=random_state, n_jobs=1, **params)
+    start = time.perf_counter()
+    model.fit(X_train, y_train)
+    fit_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    y_pred = model.predict(X_test)
+    batch_seconds = time.perf_counter() - start
+
+    single_row = X_test.iloc[:1]
+    latencies = []
+    for _ in range(LATENCY_REPEATS):
+        start = time.perf_counter()
+        model.predict_proba(single_row)
+        latencies.append(time.perf_counter() - start)
+    latencies = np.array(latencies) * 1000
+
+    return {
+        **params,
+        "fit_seconds": fit_seconds,
+        "latency_p50_ms": float(np.percentile(latencies, 50)),
+        "latency_p95_ms": float(np.percentile(latencies, 95)),
+        "batch_rows_per_sec": len(X_test) / batch_seconds if batch_seconds else float("inf"),
+        "accuracy": accuracy_score(y_test, y_pred),
+        "f1": f1_score(y_test, y_pred, average="weighted"),
+    }
+
+def compare_candidates(search, X_train, y_train, X_test, y_test, n_jobs=SEARCH_CPU_BUDGET, random_state=42):
+    """
+    Build the comparison table of the search finalists.
+
+    Every finalist is refitted on the full training split in parallel and
+    measured on the test split. Single-row latency is timed in the worker
+    with one thread, which is how the scoring service predicts.
+
+    Args:
+        search (HalvingGridSearchCV): Fitted search.
+        X_train, y_train: Full training split.
+        X_test, y_test: Held-out split.
+        n_jobs (int): Worker processes.
+        random_state (int): Seed of the forests.
+
+    Returns:
+        DataFrame: One row per finalist with "candidate" (its position in
+        `finalists(search)`), its hyperparameters, "cv_accuracy",
+        "fit_seconds", "latency_p50_ms", "latency_p95_ms",
+        "batch_rows_per_sec", "accuracy" and "f1", most accurate first.
+    """
+    candidates = finalists(search)
+    rows = Parallel(n_jobs=n_jobs)(
+        delayed(_evaluate_candidate)(params, X_train, y_train, X_test, y_test, random_state)
+        for params in candidates
+    )
+    table = pd.DataFrame(rows)
+    table.insert(0, "candidate", range(len(candidates)))
+    results = search.cv_results_
+    last_round = results["iter"].max()
+    cv_scores = {
+        repr(params): score
+        for params, score, round_ in zip(results["params"], results["mean_test_score"], results["iter"])
+        if round_ == last_round
+    }
+    table.insert(len(search.param_grid) + 1, "cv_accuracy", [cv_scores[repr(params)] for params in candidates])
+    return table.sort_values(["accuracy", "latency_p95_ms"], ascending=[False, True]).reset_index(drop=True)
+
+def select_candidate(table, min_accuracy=TARGET_ACCURACY, max_latency_ms=TARGET_LATENCY_MS):
+    """
+    Pick the most accurate candidate that meets both targets.
+
+    Args:
+        table (DataFrame): Comparison table from `compare_candidates`.
+        min_accuracy (float): Lowest acceptable test accuracy.
+        max_latency_ms (float): Highest acceptable single-row p95 latency.
+
+    Returns:
+        Series | None: The chosen row, or None if no candidate meets both targets.
+    """
+    eligible = table[(table["accuracy"] >= min_accuracy) & (table["latency_p95_ms"] <= max_latency_ms)]
+    if eligible.empty:
+        return None
+    return eligible.sort_values(["accuracy", "latency_p95_ms"], ascending=[False, True]).iloc[0]
+
+def train_with_search(X_train, y_train, X_test, y_test, param_grid=PARAM_GRID, n_jobs=SEARCH_CPU_BUDGET,
+                      min_accuracy=TARGET_ACCURACY, max_latency_ms=TARGET_LATENCY_MS, random_state=42):
+    """
+    Search, compare and fit the chosen configuration.
+
+    If no finalist meets the targets, the one with the best CV accuracy from
+    the search is used and a warning is logged.
+
+    Returns:
+        model: RandomForestClassifier fitted on the training split.
+        DataFrame: Comparison table of the finalists.
+        DataFrame: Round-by-round history of every configuration.
+    """
+    search = search_hyperparameters(X_train, y_train, param_grid, n_jobs=n_jobs, random_state=random_state)
+    table = compare_candidates(search, X_train, y_train, X_test, y_test, n_jobs, random_state)
+    logger.info(f"Candidate comparison:\n{table.to_string(index=False)}")
+
+    chosen = select_candidate(table, min_accuracy, max_latency_ms)
+    if chosen is None:
+        logger.warning(
+            f"No candidate reaches accuracy >= {min_accuracy} with p95 latency <= {max_latency_ms} ms; "
+            f"using the best CV configuration"
+        )
+        params = search.best_params_
+    else:
+        params = finalists(search)[int(chosen["candidate"])]
+    model = RandomForestClassifier(random_state=random_state, n_jobs=1, **params)
+    model.fit(X_train, y_train)
+    logger.info(f"Selected configuration {params}")
+    return model, table, search_history(search)
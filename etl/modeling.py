@@ -1,79 +1,295 @@
-from database import SessionLocal
-from models import Result, Customer, Usage, Transaction
+from database import engine
+from models import Customer, Usage, Transaction
+from feature_cache import load_or_build
+from writeback import bulk_insert_results
+from model_search import SEARCH_CPU_BUDGET, TRAINING_MODE, train_with_search
+from instrumentation import stage
+from text_features import AGGREGATE_COLUMNS, TEXT_WORKERS, build_text_features, join_text_features
+import os
 import pandas as pd
+from sqlalchemy import Float, cast, func, select
 from loguru import logger
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.model_selection import train_test_split
 from sklearn.metrics import classification_report
 
-# Fetch Combined Data for Predictions
-def fetch_data_for_predictions():
+# Rows fetched per round trip from the server-side cursor
+FEATURE_CHUNK_SIZE = 50_000
+# Customer ids per IN (...) list when only some customers are rebuilt
+CUSTOMER_ID_BATCH_SIZE = 10_000
+# Bump when the features built by `build_feature_frame` change
+FEATURE_VERSION = "2"
+FEATURE_CACHE_ENABLED = os.environ.get("FEATURE_CACHE", "1") == "1"
+# Registry name of the model trained by `train_churn_model`
+MODEL_NAME = os.environ.get("ETL_MODEL_NAME", "etl_churn")
+
+def customer_features_query(customer_ids=None, after_customer_id=None):
     """
-    Fetch and combine data from the database for training and prediction purposes.
+    Build the aggregated per-customer feature query.
+
+    Usage and transactions are grouped by customer_id in SQL and outer joined
+    to customers, so the result has exactly one row per customer.
+
+    Args:
+        customer_ids (Iterable[int], optional): Restrict the query to these customers.
+        after_customer_id (int, optional): Only customers with a larger id,
+            used to resume a scan where it stopped.
+
+    Returns:
+        Select: SQLAlchemy select ordered by customer_id.
     """
-    session = SessionLocal()
-    try:
-        customers = session.query(Customer).all()
-        usage = session.query(Usage).all()
-        transactions = session.query(Transaction).all()
+    usage = select(
+        Usage.customer_id,
+        func.count(Usage.usage_id).label("usage_count"),
+        func.sum(Usage.usage_frequency).label("usage_frequency"),
+        cast(func.avg(Usage.usage_frequency), Float).label("usage_frequency_mean"),
+        func.max(Usage.last_used_date).label("last_used_date"),
+    ).group_by(Usage.customer_id)
+    transactions = select(
+        Transaction.customer_id,
+        func.count(Transaction.transaction_id).label("transaction_count"),
+        func.sum(Transaction.amount).label("amount"),
+        cast(func.avg(Transaction.amount), Float).label("amount_mean"),
+        func.max(Transaction.payment_date).label("last_payment_date"),
+    ).group_by(Transaction.customer_id)
+    customers = select(Customer.customer_id, Customer.age, Customer.gender, Customer.location)
+
+    if customer_ids is not None:
+        customer_ids = list(customer_ids)
+        usage = usage.where(Usage.customer_id.in_(customer_ids))
+        transactions = transactions.where(Transaction.customer_id.in_(customer_ids))
+        customers = customers.where(Customer.customer_id.in_(customer_ids))
+    if after_customer_id is not None:
+        usage = usage.where(Usage.customer_id > after_customer_id)
+        transactions = transactions.where(Transaction.customer_id > after_customer_id)
+        customers = customers.where(Customer.customer_id > after_customer_id)
 
-        customers_df = pd.DataFrame(
-            [{"customer_id": c.customer_id, "age": c.age, "location": c.location} for c in customers]
+    usage = usage.subquery()
+    transactions = transactions.subquery()
+    customers = customers.subquery()
+    return (
+        select(
+            customers.c.customer_id,
+            customers.c.age,
+            customers.c.gender,
+            customers.c.location,
+            func.coalesce(usage.c.usage_count, 0).label("usage_count"),
+            func.coalesce(usage.c.usage_frequency, 0).label("usage_frequency"),
+            func.coalesce(usage.c.usage_frequency_mean, 0).label("usage_frequency_mean"),
+            usage.c.last_used_date,
+            func.coalesce(transactions.c.transaction_count, 0).label("transaction_count"),
+            func.coalesce(transactions.c.amount, 0).label("amount"),
+            func.coalesce(transactions.c.amount_mean, 0).label("amount_mean"),
+            transactions.c.last_payment_date,
         )
-        usage_df = pd.DataFrame(
-            [{"customer_id": u.customer_id, "usage_frequency": u.usage_frequency} for u in usage]
+        .outerjoin(usage, usage.c.customer_id == customers.c.customer_id)
+        .outerjoin(transactions, transactions.c.customer_id == customers.c.customer_id)
+        .order_by(customers.c.customer_id)
+    )
+
+def add_recency_features(frame, reference_date=None):
+    """
+    Add days since the last usage and the last payment (NaN when there is none).
+
+    Args:
+        frame (DataFrame): Features with `last_used_date` and `last_payment_date`.
+        reference_date (Timestamp, optional): Date recency is measured from.
+            Defaults to now.
+
+    Returns:
+        DataFrame: The same frame with `days_since_last_used` and
+        `days_since_last_payment` columns.
+    """
+    reference_date = pd.Timestamp(reference_date or pd.Timestamp.now()).normalize()
+    for column, days in (("last_used_date", "days_since_last_used"),
+                         ("last_payment_date", "days_since_last_payment")):
+        frame[column] = pd.to_datetime(frame[column])
+        frame[days] = (reference_date - frame[column]).dt.days
+    return frame
+
+def iter_feature_chunks(chunksize=FEATURE_CHUNK_SIZE, customer_ids=None, reference_date=None, with_recency=True,
+                        after_customer_id=None):
+    """
+    Stream per-customer features from a server-side cursor in chunks.
+
+    Only plain columns are selected, nothing is hydrated into ORM objects.
+
+    Args:
+        chunksize (int): Rows fetched per round trip and returned per chunk.
+        customer_ids (Iterable[int], optional): Restrict the features to these customers.
+        reference_date (Timestamp, optional): Date recency is measured from.
+            Defaults to now.
+        with_recency (bool): Add the columns of `add_recency_features`.
+        after_customer_id (int, optional): Start after this customer id.
+
+    Yields:
+        DataFrame: Up to `chunksize` customers, one row each.
+    """
+    with engine.connect() as connection:
+        result = connection.execution_options(stream_results=True, yield_per=chunksize).execute(
+            customer_features_query(customer_ids, after_customer_id)
         )
-        transactions_df = pd.DataFrame(
-            [{"customer_id": t.customer_id, "amount": t.amount} for t in transactions]
+        columns = [str(column) for column in result.keys()]
+        for partition in result.partitions():
+            chunk = pd.DataFrame(partition, columns=columns)
+            yield add_recency_features(chunk, reference_date) if with_recency else chunk
+
+def add_text_features(frame, customer_ids=None):
+    """
+    Join the feedback aggregates of `text_features` (`AGGREGATE_COLUMNS`) to a feature frame.
+
+    Customers without feedback get 0 in every aggregate column, as the model
+    and the scoring service need numbers.
+
+    Args:
+        frame (DataFrame): One row per customer, with customer_id.
+        customer_ids (list[int], optional): The customers of the frame, read
+            in batches of `CUSTOMER_ID_BATCH_SIZE`. Every customer's feedback
+            is read when not given.
+
+    Returns:
+        DataFrame: The frame with `AGGREGATE_COLUMNS` added.
+    """
+    if customer_ids is None:
+        aggregates = build_text_features(workers=TEXT_WORKERS)
+    else:
+        aggregates = pd.concat([
+            build_text_features(workers=TEXT_WORKERS, customer_ids=customer_ids[start:start + CUSTOMER_ID_BATCH_SIZE])
+            for start in range(0, len(customer_ids), CUSTOMER_ID_BATCH_SIZE)
+        ] or [build_text_features(workers=1, customer_ids=[])], ignore_index=True)
+    joined = join_text_features(frame, aggregates)
+    joined[AGGREGATE_COLUMNS] = joined[AGGREGATE_COLUMNS].fillna(0)
+    return joined
+
+def build_feature_frame(customer_ids=None):
+    """
+    Build the per-customer feature frame without recency columns.
+
+    The columns of `customer_features_query` are joined with the feedback
+    aggregates of `add_text_features`.
+
+    This is the builder cached by `feature_cache.load_or_build`; recency is
+    added after loading so cached entries do not go stale from one day to the
+    next.
+
+    Args:
+        customer_ids (Iterable[int], optional): Only build these customers,
+            queried in batches of `CUSTOMER_ID_BATCH_SIZE`.
+
+    Returns:
+        DataFrame: One row per customer.
+    """
+    if customer_ids is None:
+        chunks = list(iter_feature_chunks(with_recency=False))
+    else:
+        customer_ids = list(customer_ids)
+        chunks = [
+            chunk
+            for start in range(0, len(customer_ids), CUSTOMER_ID_BATCH_SIZE)
+            for chunk in iter_feature_chunks(
+                customer_ids=customer_ids[start:start + CUSTOMER_ID_BATCH_SIZE], with_recency=False
+            )
+        ]
+    if not chunks:
+        return pd.DataFrame(columns=[
+            *(str(column) for column in customer_features_query().selected_columns.keys()), *AGGREGATE_COLUMNS,
+        ])
+    return add_text_features(pd.concat(chunks, ignore_index=True), customer_ids)
+
+# Fetch Combined Data for Predictions
+def fetch_data_for_predictions(use_cache=FEATURE_CACHE_ENABLED):
+    """
+    Fetch one row of aggregated features per customer for training and prediction.
+
+    `usage_frequency` and `amount` hold each customer's total usage and total
+    amount paid; see `customer_features_query` for the other columns and
+    `add_text_features` for the feedback aggregates. With
+    `use_cache` the frame comes from the on-disk feature cache when the source
+    tables have not changed.
+    """
+    if use_cache:
+        data = load_or_build(
+            "prediction_features", FEATURE_VERSION, build_feature_frame,
+            tables=("customers", "usage", "transactions", "feedback"),
         )
+    else:
+        data = build_feature_frame()
+    return add_recency_features(data)
 
-        data = customers_df.merge(usage_df, on="customer_id", how="left")
-        data = data.merge(transactions_df, on="customer_id", how="left")
-        return data
-    finally:
-        session.close()
+# Columns the churn model is trained on
+MODEL_FEATURES = ["age", "usage_frequency", "amount", *AGGREGATE_COLUMNS]
 
-# Train Model and Predict
-def train_and_predict(data):
+def churn_labels(data):
     """
-    Train a machine learning model and predict churn probabilities.
+    Churn label of every customer: total usage below 5.
+    """
+    return (data["usage_frequency"] < 5).astype(int)
+
+def train_churn_model(data, mode=TRAINING_MODE):
     """
-    data["churn"] = (data["usage_frequency"] < 5).astype(int)
-    features = ["age", "usage_frequency", "amount"]
-    X = data[features].fillna(0)
-    y = data["churn"]
+    Train the churn classifier on a feature frame and log its test report.
+
+    In "search" mode the hyperparameters are chosen with
+    `model_search.train_with_search`, as in `data_science_model.train_model`.
+    The frame is not modified.
+
+    Args:
+        data (DataFrame): Feature frame with `MODEL_FEATURES`.
+        mode (str): "fixed" or "search".
+
+    Returns:
+        RandomForestClassifier: The fitted model.
+    """
+    X = data[MODEL_FEATURES].fillna(0)
+    y = churn_labels(data)
 
     X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.3, random_state=42)
 
-    model = RandomForestClassifier(random_state=42)
-    model.fit(X_train, y_train)
+    with stage("train", rows_in=len(X_train)):
+        if mode == "search":
+            model, comparison, history = train_with_search(X_train, y_train, X_test, y_test)
+            comparison.to_csv("model_search_results.csv", index=False)
+            history.to_csv("model_search_history.csv", index=False)
+            logger.info("Hyperparameter search results saved to model_search_results.csv")
+        else:
+            model = RandomForestClassifier(random_state=42, n_jobs=SEARCH_CPU_BUDGET)
+            model.fit(X_train, y_train)
     y_pred = model.predict(X_test)
 
     logger.info("Model Classification Report:")
     logger.info(classification_report(y_test, y_pred))
+    return model
 
-    data["predicted_churn"] = model.predict(X)
-    data["churn_probability"] = model.predict_proba(X)[:, 1]
+def score_customers(model, data):
+    """
+    Add `predicted_churn` and `churn_probability` to a feature frame, in place.
+    """
+    X = data[MODEL_FEATURES].fillna(0)
+    with stage("predict", rows_in=len(X)) as current:
+        data["predicted_churn"] = model.predict(X)
+        data["churn_probability"] = model.predict_proba(X)[:, 1]
+        current.rows_out = len(data)
     return data
 
+# Train Model and Predict
+def train_and_predict(data):
+    """
+    Train a machine learning model and predict churn probabilities.
+    """
+    data["churn"] = churn_labels(data)
+    model = train_churn_model(data)
+    return score_customers(model, data)
+
 # Populate Results Table
 def populate_results_table(data):
     """
     Populate the results table with prediction data.
+
+    Rows are appended in bulk (see `writeback.bulk_insert_results`), one per customer.
     """
-    session = SessionLocal()
     try:
-        for _, row in data.iterrows():
-            result = Result(
-                customer_id=row["customer_id"],
-                prediction="Churn" if row["predicted_churn"] == 1 else "No Churn",
-                probability=row["churn_probability"],
-                created_at=pd.Timestamp.now(),
-            )
-            session.add(result)
-        session.commit()
+        with stage("write_back", rows_in=len(data)) as current:
+            current.rows_out = bulk_insert_results(data)
         logger.info("Results table populated.")
     except Exception as e:
         logger.error(f"Error populating results table: {e}")
-    finally:
-        session.close()
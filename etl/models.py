@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, Float, DateTime
+from sqlalchemy import Column, Integer, String, ForeignKey, Float, DateTime, Date
 from sqlalchemy.orm import relationship
 from database import Base, engine
 from sqlalchemy.sql import func
@@ -28,7 +28,7 @@ class Usage(Base):
     usage_frequency = Column(Integer)  # Tracks how often a feature is used
     payment_date = Column(DateTime, default=datetime.datetime.utcnow)
     last_used_date = Column(DateTime, default=datetime.datetime.utcnow)
-    customer_id = Column(Integer, ForeignKey('customers.customer_id'))
+    customer_id = Column(Integer, ForeignKey('customers.customer_id'), index=True)
     customer = relationship("Customer", back_populates="usage")
 
 # Transaction Model
@@ -37,9 +37,9 @@ class Transaction(Base):
     transaction_id = Column(Integer, primary_key=True)
     amount = Column(Float)  # Amount paid in this transaction
     plan_type = Column(String)  # Type of plan (Basic, Premium, etc.)
-    payment_date = Column(DateTime, default=datetime.datetime.utcnow)
+    payment_date = Column(DateTime, default=datetime.datetime.utcnow, index=True)
     last_used_date = Column(DateTime, default=datetime.datetime.utcnow)
-    customer_id = Column(Integer, ForeignKey('customers.customer_id'))
+    customer_id = Column(Integer, ForeignKey('customers.customer_id'), index=True)
     customer = relationship("Customer", back_populates="transactions")
 
 # Feedback Model
@@ -48,17 +48,17 @@ class Feedback(Base):
     feedback_id = Column(Integer, primary_key=True)
     feedback_text = Column(String)  # Customer feedback text
     rating = Column(Integer)  # Rating given by the customer (1-5)
-    customer_id = Column(Integer, ForeignKey('customers.customer_id'))
+    customer_id = Column(Integer, ForeignKey('customers.customer_id'), index=True)
     customer = relationship("Customer", back_populates="feedback")
 
 # Results Model
 class Result(Base):
     __tablename__ = 'results'
     result_id = Column(Integer, primary_key=True, autoincrement=True)
-    customer_id = Column(Integer, ForeignKey('customers.customer_id'), nullable=False)
+    customer_id = Column(Integer, ForeignKey('customers.customer_id'), nullable=False, index=True)
     prediction = Column(String, nullable=False)  # Churn prediction result
     probability = Column(Float, nullable=False)  # Probability of the prediction 
-    created_at = Column(DateTime, default=func.now(), nullable=False)
+    created_at = Column(DateTime, default=func.now(), nullable=False, index=True)
     customer = relationship("Customer", back_populates="results")
 
 # Campaigns Model
@@ -76,22 +76,69 @@ class Campaign(Base):
 class Prediction(Base):
     __tablename__ = 'predictions'
     prediction_id = Column(Integer, primary_key=True, autoincrement=True)
-    customer_id = Column(Integer, ForeignKey('customers.customer_id'), nullable=False)
+    customer_id = Column(Integer, ForeignKey('customers.customer_id'), nullable=False, index=True)
     predicted_churn = Column(Integer, nullable=False)
     churn_probability = Column(Float, nullable=False)
-    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow, index=True)
     customer = relationship("Customer", back_populates="predictions")
 
 # Segment Model
 class Segment(Base):
     __tablename__ = 'segments'
     segment_id = Column(Integer, primary_key=True, autoincrement=True)
-    customer_id = Column(Integer, ForeignKey('customers.customer_id'), nullable=False)
+    customer_id = Column(Integer, ForeignKey('customers.customer_id'), nullable=False, index=True)
     segment_label = Column(String, nullable=False)
     engagement_score = Column(Float, nullable=False)
     spending_score = Column(Float, nullable=False)
     customer = relationship("Customer", back_populates="segments")
 
+# Daily churn rollup of the results or predictions table, kept up to date by campaign_rollups.py
+class ChurnDailyRollup(Base):
+    __tablename__ = 'churn_daily_rollups'
+    source = Column(String, primary_key=True)  # Table the rows were rolled up from
+    day = Column(Date, primary_key=True)
+    predictions = Column(Integer, nullable=False)  # Rows created that day
+    churned = Column(Integer, nullable=False)  # Rows predicting churn
+    probability_sum = Column(Float, nullable=False)  # Sum of the churn probabilities
+
+# Last row of each source table included in the rollups
+class RollupWatermark(Base):
+    __tablename__ = 'rollup_watermarks'
+    source = Column(String, primary_key=True)
+    last_id = Column(Integer, nullable=False)
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow, nullable=False)
+
+# Write counters of the source tables, bumped by the loaders in the same transaction as their writes
+class DataVersion(Base):
+    __tablename__ = 'data_versions'
+    table_name = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False)  # Bumped by every load or merge
+    rewrite_version = Column(Integer, nullable=False)  # Bumped by writes that may change or remove existing rows
+    updated_at = Column(DateTime, nullable=False)
+
+# Dashboard inputs of every customer, kept up to date by dashboard_rollups.py
+class DashboardCustomerState(Base):
+    __tablename__ = 'dashboard_customer_state'
+    customer_id = Column(Integer, primary_key=True)
+    age_band = Column(String, nullable=False)
+    gender = Column(String, nullable=False)
+    location = Column(String, nullable=False)
+    rating_band = Column(String, nullable=False)  # Mean feedback rating, rounded
+    scored = Column(Integer, nullable=False)  # 1 if the customer has a result
+    churned = Column(Integer, nullable=False)  # 1 if the latest result predicts churn
+    low_usage = Column(Integer, nullable=False)
+    negative_feedback = Column(Integer, nullable=False)
+    no_transactions = Column(Integer, nullable=False)
+
+# Customer and churn counts per dashboard dimension value, kept up to date by dashboard_rollups.py
+class DashboardRollup(Base):
+    __tablename__ = 'dashboard_rollups'
+    dimension = Column(String, primary_key=True)  # e.g. "gender", "location", "driver"
+    value = Column(String, primary_key=True)
+    customers = Column(Integer, nullable=False)
+    scored = Column(Integer, nullable=False)
+    churned = Column(Integer, nullable=False)
+
 # Create all tables
 if __name__ == "__main__":
     Base.metadata.create_all(engine)
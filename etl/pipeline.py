@@ -0,0 +1,507 @@
+"""
+Pipeline Runner
+
+This module runs the pipeline as a graph of nodes instead of a fixed
+sequence. Each node declares typed inputs, which are outputs of other nodes,
+the run parameters it reads and its typed outputs:
+
+    generate -> load -> features -> train -> score -> write_back
+                               \\-> segments   \\-> register
+
+Before a node runs, its inputs are fingerprinted: a hash of the node's name
+and version, the parameters it reads, the fingerprints of the nodes
+producing its inputs and, for nodes reading the database, the version of the
+tables they read (`feature_cache.source_data_version`). When outputs with
+that fingerprint are cached on disk they are loaded instead of running the
+node, so an unchanged pipeline finishes without doing any work, and a
+change only reruns the nodes downstream of it.
+
+Nodes that exist for their effect on the database or the registry are only
+reused while that effect is still there, since an unchanged fingerprint
+does not mean it is, e.g. after `benchmark.run_stages` dropped the tables:
+`load` while the live tables hold the loaded row counts, `write_back` while
+`results` holds the rows it wrote, `register` while its model version
+exists and `segments` while `segments` holds the rows it wrote.
+
+Nodes whose inputs are ready run in parallel on a thread pool. The status of
+every node is saved after each run; with `resume`, nodes that succeeded in
+the previous run are reused even when they are not cached, so a failed run
+continues from the node that failed.
+
+Usage:
+
+    python pipeline.py --customers 100000
+    python pipeline.py --customers 100000 --resume
+    python pipeline.py --customers 100000 --force train
+"""
+
+import glob
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import date
+
+import joblib
+import pandas as pd
+from loguru import logger
+
+from instrumentation import stage
+
+PIPELINE_CACHE_DIR = os.environ.get("PIPELINE_CACHE_DIR", "cache/pipeline/")
+PIPELINE_WORKERS = int(os.environ.get("PIPELINE_WORKERS", 4))  # Nodes run at the same time
+PIPELINE_CACHE_KEEP = 3  # Cached fingerprints kept per node
+
+class Node:
+    """
+    One step of a pipeline.
+
+    The function is called with its inputs and parameters as keyword
+    arguments and returns its output, or a dict keyed by output name when
+    the node has several.
+
+    Args:
+        name (str): Unique node name.
+        func (Callable): The step.
+        inputs (dict): Type of every input, keyed by the output name of the
+            node producing it.
+        outputs (dict): Type of every output, keyed by output name.
+        params (Iterable[str]): Run parameters passed to `func`.
+        fingerprint (Callable, optional): Called with no arguments; returns
+            a JSON-serializable description of state outside the pipeline the
+            node reads, such as database tables.
+        validate (Callable, optional): Called with cached outputs; returns
+            False when they can no longer be used, e.g. files were deleted.
+        version (str): Bump when the node's code changes its outputs.
+        cache (bool): Reuse outputs from earlier runs. Uncached nodes still
+            store their outputs, so `resume` can skip them.
+    """
+
+    def __init__(self, name, func, inputs=None, outputs=None, params=(), fingerprint=None, validate=None,
+                 version="1", cache=True):
+        self.name = name
+        self.func = func
+        self.inputs = dict(inputs or {})
+        self.outputs = dict(outputs or {})
+        self.params = tuple(params)
+        self.fingerprint = fingerprint
+        self.validate = validate
+        self.version = version
+        self.cache = cache
+
+def _check_types(node, kind, values, types):
+    for name, expected in types.items():
+        if not isinstance(values[name], expected):
+            raise TypeError(
+                f"{kind} {name!r} of node {node.name!r} is {type(values[name]).__name__}, "
+                f"expected {expected.__name__}"
+            )
+
+class Pipeline:
+    """
+    A graph of `Node` objects, connected by matching output and input names.
+
+    Args:
+        nodes (Iterable[Node]): The nodes, in any order.
+        name (str): Name of the pipeline; its cache and run state live in
+            `cache_dir/name/`.
+        cache_dir (str): Root folder of node outputs and run states.
+
+    Raises:
+        ValueError: If names repeat, an input has no producer or the graph
+            has a cycle.
+    """
+
+    def __init__(self, nodes, name="churn", cache_dir=PIPELINE_CACHE_DIR):
+        self.nodes = {}
+        self.producers = {}
+        for node in nodes:
+            if node.name in self.nodes:
+                raise ValueError(f"Duplicate node name: {node.name}")
+            self.nodes[node.name] = node
+            for output in node.outputs:
+                if output in self.producers:
+                    raise ValueError(f"Output {output!r} is produced by {self.producers[output]} and {node.name}")
+                self.producers[output] = node.name
+        for node in self.nodes.values():
+            missing = [name for name in node.inputs if name not in self.producers]
+            if missing:
+                raise ValueError(f"Inputs of node {node.name} have no producer: {missing}")
+        self.name = name
+        self.folder = os.path.join(cache_dir, name)
+        self.order = self._topological_order()
+
+    def dependencies(self, node_name) -> set:
+        """
+        Nodes producing the inputs of a node.
+        """
+        return {self.producers[name] for name in self.nodes[node_name].inputs}
+
+    def _topological_order(self) -> list:
+        pending = {name: self.dependencies(name) for name in self.nodes}
+        order = []
+        while pending:
+            ready = sorted(name for name, dependencies in pending.items() if not dependencies)
+            if not ready:
+                raise ValueError(f"Cycle between nodes: {sorted(pending)}")
+            order += ready
+            for name in ready:
+                del pending[name]
+            for dependencies in pending.values():
+                dependencies.difference_update(ready)
+        return order
+
+    def upstream(self, node_names) -> set:
+        """
+        The given nodes and every node they depend on, directly or not.
+        """
+        needed = set()
+        stack = list(node_names)
+        while stack:
+            name = stack.pop()
+            if name not in needed:
+                needed.add(name)
+                stack += self.dependencies(name)
+        return needed
+
+    def _state_path(self) -> str:
+        return os.path.join(self.folder, "run_state.json")
+
+    def load_state(self) -> dict:
+        """
+        Node statuses of the previous run, or an empty state.
+        """
+        if not os.path.exists(self._state_path()):
+            return {"nodes": {}}
+        with open(self._state_path()) as state_file:
+            return json.load(state_file)
+
+    def _save_state(self, state) -> None:
+        os.makedirs(self.folder, exist_ok=True)
+        with open(f"{self._state_path()}.tmp", "w") as state_file:
+            json.dump(state, state_file, indent=2, default=str)
+        os.replace(f"{self._state_path()}.tmp", self._state_path())
+
+    def _output_path(self, node_name, fingerprint) -> str:
+        return os.path.join(self.folder, node_name, f"{fingerprint}.joblib")
+
+    def _store(self, node_name, fingerprint, outputs) -> None:
+        path = self._output_path(node_name, fingerprint)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        joblib.dump(outputs, f"{path}.tmp")
+        os.replace(f"{path}.tmp", path)
+        # Keep only the most recent fingerprints of the node
+        entries = sorted(glob.glob(os.path.join(os.path.dirname(path), "*.joblib")), key=os.path.getmtime)
+        for old_path in entries[:-PIPELINE_CACHE_KEEP]:
+            os.remove(old_path)
+
+    def fingerprint(self, node_name, params, fingerprints) -> str:
+        """
+        Fingerprint of a node's inputs, given the fingerprints of its dependencies.
+        """
+        node = self.nodes[node_name]
+        description = {
+            "node": node.name,
+            "version": node.version,
+            "params": {name: params[name] for name in node.params},
+            "inputs": {name: fingerprints[self.producers[name]] for name in sorted(node.inputs)},
+            "external": node.fingerprint() if node.fingerprint else None,
+        }
+        return hashlib.sha256(json.dumps(description, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+    def _reusable(self, node, fingerprint, force, resume, previous) -> dict | None:
+        """
+        Stored outputs of a node that can stand in for running it, if any.
+        """
+        path = self._output_path(node.name, fingerprint)
+        if node.name in force or not os.path.exists(path):
+            return None
+        last = previous["nodes"].get(node.name, {})
+        resumable = resume and last.get("status") == "ok" and last.get("fingerprint") == fingerprint
+        if not (node.cache or resumable):
+            return None
+        outputs = joblib.load(path)
+        if node.validate is not None and not node.validate(**outputs):
+            logger.info(f"Cached outputs of {node.name} are no longer valid")
+            return None
+        return outputs
+
+    def _run_node(self, node, values, params, fingerprint, force, resume, previous):
+        """
+        Reuse or compute the outputs of one node.
+
+        Returns:
+            tuple: (outputs, cached)
+        """
+        outputs = self._reusable(node, fingerprint, force, resume, previous)
+        if outputs is not None:
+            return outputs, True
+        inputs = {name: values[name] for name in node.inputs}
+        _check_types(node, "Input", inputs, node.inputs)
+        with stage(node.name):
+            result = node.func(**inputs, **{name: params[name] for name in node.params})
+        outputs = {next(iter(node.outputs)): result} if len(node.outputs) == 1 else result
+        missing = set(node.outputs) - set(outputs)
+        if missing:
+            raise ValueError(f"Node {node.name} did not return {sorted(missing)}")
+        _check_types(node, "Output", outputs, node.outputs)
+        self._store(node.name, fingerprint, outputs)
+        return outputs, False
+
+    def run(self, params=None, targets=None, force=(), resume=False, max_workers=PIPELINE_WORKERS) -> dict:
+        """
+        Run the pipeline, reusing cached outputs where the inputs did not change.
+
+        Args:
+            params (dict, optional): Run parameters read by the nodes.
+            targets (Iterable[str], optional): Only run these nodes and what
+                they depend on. Defaults to every node.
+            force (Iterable[str]): Nodes to run even when cached.
+            resume (bool): Also reuse uncached nodes that succeeded in the
+                previous run with the same fingerprint.
+            max_workers (int): Nodes run at the same time.
+
+        Returns:
+            dict: Every output produced or reused, keyed by output name.
+
+        Raises:
+            Exception: The error of the first node that failed, after the
+            run state is saved.
+        """
+        params = dict(params or {})
+        missing = {name for node in self.nodes.values() for name in node.params} - set(params)
+        if missing:
+            raise ValueError(f"Missing pipeline parameters: {sorted(missing)}")
+        force = set(force)
+        selected = self.upstream(targets) if targets else set(self.nodes)
+        previous = self.load_state()
+        state = {"started_at": time.time(), "params": params, "status": "running", "nodes": {}}
+        values, fingerprints, done = {}, {}, set()
+        lock = threading.Lock()
+        failure = None
+        start = time.perf_counter()
+
+        def execute(node_name, fingerprint):
+            node_start = time.perf_counter()
+            outputs, cached = self._run_node(
+                self.nodes[node_name], values, params, fingerprint, force, resume, previous,
+            )
+            return outputs, cached, time.perf_counter() - node_start
+
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            running = {}
+            while True:
+                if failure is None:
+                    for node_name in self.order:
+                        if node_name not in selected or node_name in done or node_name in running.values():
+                            continue
+                        if not self.dependencies(node_name) <= done:
+                            continue
+                        fingerprint = self.fingerprint(node_name, params, fingerprints)
+                        with lock:
+                            fingerprints[node_name] = fingerprint
+                            state["nodes"][node_name] = {"status": "running", "fingerprint": fingerprint}
+                        running[executor.submit(execute, node_name, fingerprint)] = node_name
+                if not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    node_name = running.pop(future)
+                    node_state = state["nodes"][node_name]
+                    try:
+                        outputs, cached, seconds = future.result()
+                    except Exception as e:
+                        logger.error(f"Node {node_name} failed: {e}")
+                        node_state.update(status="failed", error=repr(e))
+                        failure = failure or e
+                        continue
+                    values.update(outputs)
+                    done.add(node_name)
+                    node_state.update(status="ok", cached=cached, seconds=seconds)
+                    logger.info(f"Node {node_name} {'reused from cache' if cached else 'ran'} in {seconds:.2f}s")
+                self._save_state(state)
+
+        for node_name in selected - set(state["nodes"]):
+            state["nodes"][node_name] = {"status": "skipped"}
+        state["status"] = "failed" if failure else "ok"
+        state["wall_seconds"] = time.perf_counter() - start
+        self._save_state(state)
+        if failure is not None:
+            raise failure
+        reused = sum(1 for node_state in state["nodes"].values() if node_state.get("cached"))
+        logger.info(f"Pipeline {self.name} finished in {state['wall_seconds']:.2f}s, {reused} nodes reused")
+        return values
+
+def _generate(customers, seed, reference_date, data_folder):
+    from data_generator import generate_sharded_dataset
+
+    # The files do not depend on the number of worker processes
+    written = generate_sharded_dataset(
+        customers, seed=seed,
+        reference_date=date.fromisoformat(reference_date), output_folder=data_folder,
+    )
+    csv_files = {}
+    for csv_path in written:
+        csv_files.setdefault(os.path.basename(csv_path).split(".")[0], []).append(csv_path)
+    return csv_files
+
+def _files_exist(csv_files):
+    return all(os.path.exists(csv_path) for paths in csv_files.values() for csv_path in paths)
+
+def _load(csv_files):
+    from etl import load_csv_shards
+
+    return load_csv_shards(csv_files)
+
+def _tables_loaded(loaded_rows):
+    from sqlalchemy import func, select, table
+
+    from database import engine
+
+    with engine.connect() as connection:
+        return all(
+            connection.execute(select(func.count()).select_from(table(table_name))).scalar() == rows
+            for table_name, rows in loaded_rows.items()
+        )
+
+def _source_version():
+    from feature_cache import source_data_version
+
+    return source_data_version(("customers", "usage", "transactions", "feedback"))
+
+def _features_version():
+    # Recency columns are measured from today
+    return {"tables": _source_version(), "day": date.today().isoformat()}
+
+def _features(loaded_rows):
+    from modeling import fetch_data_for_predictions
+
+    return fetch_data_for_predictions()
+
+def _training_mode():
+    from model_search import TRAINING_MODE
+
+    return {"training_mode": TRAINING_MODE}
+
+def _train(features):
+    from modeling import train_churn_model
+
+    return train_churn_model(features)
+
+def _score(model, features):
+    from modeling import score_customers
+
+    # The feature frame is shared with other nodes and the cache
+    return score_customers(model, features.copy())
+
+def _write_back(predictions):
+    from writeback import bulk_insert_results
+
+    # The timestamp tells the rows of this write apart from those of other runs
+    created_at = pd.Timestamp.now().floor("s")
+    return {
+        "results_written": bulk_insert_results(predictions, created_at=created_at),
+        "results_created_at": created_at.isoformat(),
+    }
+
+def _results_written(results_written, results_created_at):
+    from sqlalchemy import func, select
+
+    from database import engine
+    from models import Result
+
+    created_at = pd.Timestamp(results_created_at).to_pydatetime()
+    with engine.connect() as connection:
+        return connection.execute(
+            select(func.count()).select_from(Result).where(Result.created_at == created_at)
+        ).scalar() == results_written
+
+def _register(model, predictions):
+    from batch_scoring import drift_reference
+    from model_registry import register_model
+    from modeling import MODEL_NAME
+
+    # Score-only runs check drift against this reference instead of retraining
+    return register_model(
+        model, name=MODEL_NAME, data_version=_source_version(),
+        extra_metadata={"drift_reference": drift_reference(predictions, predictions["predicted_churn"])},
+    )["version"]
+
+def _model_registered(model_version):
+    from model_registry import list_versions
+    from modeling import MODEL_NAME
+
+    return any(metadata["version"] == model_version for metadata in list_versions(MODEL_NAME))
+
+def _segments(features):
+    from segmentation import segment_all_customers
+
+    return segment_all_customers(features)
+
+def _segments_written(segments_written):
+    from sqlalchemy import func, select
+
+    from database import engine
+    from models import Segment
+
+    with engine.connect() as connection:
+        return connection.execute(select(func.count()).select_from(Segment)).scalar() == segments_written
+
+def build_churn_pipeline(cache_dir=PIPELINE_CACHE_DIR) -> Pipeline:
+    """
+    The generate -> load -> features -> train -> score -> write-back pipeline.
+
+    Parameters: customers, seed, reference_date (ISO date) and data_folder.
+    Database nodes import the pipeline modules when they
+    run, so building the graph does not connect to the database.
+    """
+    return Pipeline([
+        Node("generate", _generate, outputs={"csv_files": dict},
+             params=("customers", "seed", "reference_date", "data_folder"), validate=_files_exist),
+        Node("load", _load, inputs={"csv_files": dict}, outputs={"loaded_rows": dict}, validate=_tables_loaded),
+        Node("features", _features, inputs={"loaded_rows": dict}, outputs={"features": pd.DataFrame},
+             fingerprint=_features_version),
+        Node("train", _train, inputs={"features": pd.DataFrame}, outputs={"model": object},
+             fingerprint=_training_mode),
+        Node("score", _score, inputs={"model": object, "features": pd.DataFrame},
+             outputs={"predictions": pd.DataFrame}),
+        Node("write_back", _write_back, inputs={"predictions": pd.DataFrame},
+             outputs={"results_written": int, "results_created_at": str}, validate=_results_written),
+        Node("register", _register, inputs={"model": object, "predictions": pd.DataFrame},
+             outputs={"model_version": str},
+             validate=_model_registered),
+        Node("segments", _segments, inputs={"features": pd.DataFrame}, outputs={"segments_written": int},
+             validate=_segments_written),
+    ], name="churn", cache_dir=cache_dir)
+
+if __name__ == "__main__":
+    import argparse
+
+    from instrumentation import recorder, write_reports
+
+    parser = argparse.ArgumentParser(description="Run the churn pipeline, reusing unchanged steps.")
+    parser.add_argument("--customers", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--reference-date", default=date.today().isoformat(), help="YYYY-MM-DD")
+    parser.add_argument("--data-folder", default="data/pipeline/")
+    parser.add_argument("--targets", nargs="+", default=None, help="Only run these nodes and their dependencies")
+    parser.add_argument("--force", nargs="+", default=[], help="Run these nodes even when cached")
+    parser.add_argument("--resume", action="store_true", help="Continue the previous run from the node that failed")
+    parser.add_argument("--workers", type=int, default=PIPELINE_WORKERS)
+    args = parser.parse_args()
+
+    recorder.pipeline = "pipeline"
+    try:
+        build_churn_pipeline().run(
+            params={
+                "customers": args.customers,
+                "seed": args.seed,
+                "reference_date": args.reference_date,
+                "data_folder": args.data_folder,
+            },
+            targets=args.targets, force=args.force, resume=args.resume, max_workers=args.workers,
+        )
+    finally:
+        write_reports("reports/pipeline_run_report.json", "reports/pipeline.prom")
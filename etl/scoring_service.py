@@ -0,0 +1,420 @@
+"""
+Churn Scoring Service
+
+This module serves churn scores over local HTTP on the port exposed by the
+ETL container (3000). The latest version in the model registry is loaded
+once at startup, memory-mapped so several service processes share its
+arrays; without a registered version the file written by
+`data_science_model.save_model` is used. Concurrent requests are combined into micro-batches
+so each batch is scored with a single vectorized `predict_proba` call.
+Records are validated when they are submitted, so a malformed request is
+rejected with a 400 on its own; if scoring a batch still fails, its
+requests are scored one by one and only the failing ones get an error.
+
+Endpoints:
+    POST /score    One customer object, a list of them, or {"customers": [...]}.
+    GET  /metrics  Latency percentiles, throughput and batching statistics.
+    GET  /health   Service status.
+
+Run it inside the ETL container with `python scoring_service.py`.
+"""
+
+import json
+import os
+import queue
+import threading
+import time
+import urllib.request
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import joblib
+import numpy as np
+import pandas as pd
+from loguru import logger
+
+from model_registry import latest_version, load_artifact, load_model
+
+MODEL_PATH = os.environ.get("MODEL_PATH", "final_model.pkl")
+MODEL_NAME = os.environ.get("MODEL_NAME", "churn")  # Registry model served when registered
+SCORING_HOST = os.environ.get("SCORING_HOST", "0.0.0.0")
+SCORING_PORT = int(os.environ.get("SCORING_PORT", 3000))
+MAX_BATCH_SIZE = int(os.environ.get("SCORING_MAX_BATCH_SIZE", 1024))  # Rows per predict_proba call
+MAX_BATCH_WAIT_MS = float(os.environ.get("SCORING_MAX_BATCH_WAIT_MS", 5))  # Time a batch waits to fill up
+LATENCY_WINDOW = 10_000  # Most recent request latencies kept for percentiles
+
+def prepare_features(records, feature_names, encoder=None):
+    """
+    Turn raw customer records into the column layout the model was trained on.
+
+    With the `CategoricalEncoder` saved with the model, categorical fields are
+    encoded exactly as at training time. Without one they are one-hot encoded
+    the way `pd.get_dummies` does. The frame is then aligned to
+    `feature_names`; unknown columns are dropped.
+
+    Records must have passed `validate_records`, so only one-hot columns of
+    categories a record does not have are filled with 0.
+
+    Args:
+        records (list[dict]): Customer records, raw or already encoded.
+        feature_names (Iterable[str]): Columns the model expects, in order.
+        encoder (CategoricalEncoder, optional): Fitted encoder of the model.
+
+    Returns:
+        DataFrame: One row per record with exactly `feature_names` as columns.
+    """
+    frame = pd.DataFrame.from_records(records)
+    if encoder is not None:
+        frame = frame.reindex(columns=encoder.passthrough_ + list(encoder.methods))
+        frame = pd.DataFrame(encoder.transform_sparse(frame).toarray(), columns=encoder.feature_names_)
+    else:
+        categorical = [column for column in frame.columns if frame[column].dtype == object]
+        if categorical:
+            frame = pd.get_dummies(frame, columns=categorical)
+    return frame.reindex(columns=list(feature_names), fill_value=0)
+
+def _is_number(value) -> bool:
+    try:
+        return not np.isnan(float(value))
+    except (TypeError, ValueError):
+        return False
+
+def validate_records(records, feature_names, encoder=None) -> None:
+    """
+    Check that every record has the fields the model needs.
+
+    With an encoder, its passthrough columns must be numbers and its
+    categorical columns present. Without one, every model column must be a
+    number in the record, or a one-hot column `<field>_<category>` of a
+    string field of the record.
+
+    Args:
+        records (list[dict]): Customer records of one request.
+        feature_names (Iterable[str]): Columns the model expects.
+        encoder (CategoricalEncoder, optional): Fitted encoder of the model.
+
+    Raises:
+        ValueError: Describing the first invalid record.
+    """
+    if not isinstance(records, list) or not records:
+        raise ValueError("Expected a customer object or a non-empty list of them")
+    for position, record in enumerate(records):
+        if not isinstance(record, dict):
+            raise ValueError(f"Record {position} is not an object")
+        if encoder is not None:
+            numeric = [column for column in encoder.passthrough_ if not _is_number(record.get(column))]
+            missing = [column for column in encoder.methods if record.get(column) is None]
+        else:
+            categorical = [field for field, value in record.items() if isinstance(value, str)]
+            numeric, missing = [], []
+            for column in feature_names:
+                if column in record:
+                    if isinstance(record[column], str) or not _is_number(record[column]):
+                        numeric.append(column)
+                elif not any(column.startswith(f"{field}_") for field in categorical):
+                    missing.append(column)
+        if numeric or missing:
+            problems = [f"missing field(s) {missing}"] if missing else []
+            problems += [f"non-numeric field(s) {numeric}"] if numeric else []
+            raise ValueError(f"Record {position}: {', '.join(problems)}")
+
+class MicroBatcher:
+    """
+    Collect scoring requests from many threads and score them in batches.
+
+    A batch is closed when it holds `max_batch_size` rows or its first request
+    has waited `max_wait_ms`, whichever comes first.
+    """
+
+    def __init__(self, model, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_BATCH_WAIT_MS, encoder=None):
+        self.model = model
+        self.encoder = encoder
+        self.feature_names = list(getattr(model, "feature_names_in_", []))
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+        self._lock = threading.Lock()
+        self._started = time.perf_counter()
+        self._requests = 0
+        self._rows = 0
+        self._batches = 0
+        self._closed = False
+        self._worker = threading.Thread(target=self._run, name="micro-batcher", daemon=True)
+        self._worker.start()
+
+    def submit(self, records) -> Future:
+        """
+        Validate records and queue them for scoring.
+
+        Returns:
+            Future: Resolves to a list of (predicted_churn, churn_probability) tuples.
+
+        Raises:
+            ValueError: If a record lacks a field the model needs.
+        """
+        validate_records(records, self.feature_names, self.encoder)
+        future = Future()
+        self._queue.put((records, future, time.perf_counter()))
+        return future
+
+    def score(self, records, timeout=None) -> list:
+        """
+        Score records and wait for the result.
+        """
+        return self.submit(records).result(timeout)
+
+    def _next_batch(self):
+        """
+        Block for the first request, then gather more until the batch is full or due.
+        """
+        batch = [self._queue.get()]
+        if batch[0][0] is None:
+            return batch
+        rows = len(batch[0][0])
+        deadline = time.perf_counter() + self.max_wait
+        while rows < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item[0] is None:
+                # Shut down after this batch
+                self._queue.put(item)
+                break
+            batch.append(item)
+            rows += len(item[0])
+        return batch
+
+    def _predict(self, records):
+        """
+        Predicted class and churn probability of every record.
+        """
+        features = prepare_features(records, self.feature_names, self.encoder)
+        probabilities = self.model.predict_proba(features)
+        classes = list(self.model.classes_)
+        churn = probabilities[:, classes.index(1)] if 1 in classes else np.zeros(len(records))
+        predicted = np.asarray(classes)[probabilities.argmax(axis=1)]
+        return [(int(label), float(probability)) for label, probability in zip(predicted, churn)]
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch[0][0] is None:
+                return
+            records = [record for request, _, _ in batch for record in request]
+            results = []
+            try:
+                scores = self._predict(records)
+                offset = 0
+                for request, _, _ in batch:
+                    results.append(scores[offset:offset + len(request)])
+                    offset += len(request)
+            except Exception as e:
+                # Score the requests one by one so a bad one only fails its own future
+                logger.warning(f"Batch of {len(batch)} requests failed ({e}); scoring them separately")
+                results = []
+                for request, _, _ in batch:
+                    try:
+                        results.append(self._predict(request))
+                    except Exception as request_error:
+                        results.append(request_error)
+
+            finished = time.perf_counter()
+            with self._lock:
+                self._batches += 1
+                for (request, future, submitted), result in zip(batch, results):
+                    if isinstance(result, Exception):
+                        future.set_exception(result)
+                        continue
+                    future.set_result(result)
+                    self._latencies.append(finished - submitted)
+                    self._requests += 1
+                    self._rows += len(request)
+
+    def stats(self) -> dict:
+        """
+        Latency percentiles over the last `LATENCY_WINDOW` requests and totals.
+        """
+        with self._lock:
+            latencies = np.array(self._latencies) * 1000
+            elapsed = time.perf_counter() - self._started
+            return {
+                "requests": self._requests,
+                "rows": self._rows,
+                "batches": self._batches,
+                "mean_batch_rows": self._rows / self._batches if self._batches else 0.0,
+                "p50_ms": float(np.percentile(latencies, 50)) if len(latencies) else None,
+                "p99_ms": float(np.percentile(latencies, 99)) if len(latencies) else None,
+                "requests_per_sec": self._requests / elapsed if elapsed else 0.0,
+                "rows_per_sec": self._rows / elapsed if elapsed else 0.0,
+                "uptime_sec": elapsed,
+            }
+
+    def close(self):
+        """
+        Stop the batching thread after the queued requests are scored.
+        """
+        if not self._closed:
+            self._closed = True
+            self._queue.put((None, None, None))
+            self._worker.join()
+
+class ScoringRequestHandler(BaseHTTPRequestHandler):
+    """
+    HTTP front end of the `MicroBatcher` attached to the server.
+    """
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            self._send_json(200, self.server.batcher.stats())
+        elif self.path == "/health":
+            self._send_json(200, {"status": "ok", "model": self.server.model_source})
+        else:
+            self._send_json(404, {"error": f"Unknown path: {self.path}"})
+
+    def do_POST(self):
+        if self.path != "/score":
+            self._send_json(404, {"error": f"Unknown path: {self.path}"})
+            return
+        try:
+            payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            if isinstance(payload, dict):
+                payload = payload.get("customers", [payload])
+            future = self.server.batcher.submit(payload)
+        except ValueError as e:
+            self._send_json(400, {"error": str(e)})
+            return
+        try:
+            scores = future.result()
+        except Exception as e:
+            logger.error(f"Scoring failed: {e}")
+            self._send_json(500, {"error": str(e)})
+            return
+        self._send_json(200, {"scores": [
+            {
+                "customer_id": record.get("customer_id"),
+                "predicted_churn": predicted,
+                "churn_probability": probability,
+            }
+            for record, (predicted, probability) in zip(payload, scores)
+        ]})
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} - {format % args}")
+
+class ScoringServer(ThreadingHTTPServer):
+    """
+    Threading HTTP server with a listen backlog sized for bursts of clients.
+    """
+
+    daemon_threads = True
+    request_queue_size = 1024
+
+def load_serving_model(model_name=MODEL_NAME, model_path=MODEL_PATH):
+    """
+    Load the model to serve: the latest registered version of `model_name`,
+    memory-mapped, or the file at `model_path` if nothing is registered.
+
+    Returns:
+        tuple: (model, encoder saved with it or None, description of where
+        it was loaded from)
+    """
+    start = time.perf_counter()
+    encoder = None
+    if latest_version(model_name) is not None:
+        model, metadata = load_model(model_name, mmap_mode="r")
+        if "encoder" in metadata.get("artifacts", []):
+            encoder = load_artifact("encoder", model_name, metadata["version"])
+        source = f"{model_name} {metadata['version']}"
+    else:
+        model = joblib.load(model_path)
+        source = model_path
+    logger.info(f"Loaded model {source} in {time.perf_counter() - start:.2f}s")
+    return model, encoder, source
+
+def create_server(model=None, model_path=MODEL_PATH, host=SCORING_HOST, port=SCORING_PORT):
+    """
+    Build the scoring HTTP server, loading the model once.
+
+    Args:
+        model (optional): Fitted classifier; loaded with `load_serving_model`
+            when omitted.
+        model_path (str): Path of the model written by `save_model`, used when
+            the registry has no version.
+        host (str): Interface to bind.
+        port (int): Port to bind; 0 picks a free port.
+
+    Returns:
+        ScoringServer: Server with a `batcher` attribute.
+    """
+    encoder, source = None, "in-memory model"
+    if model is None:
+        model, encoder, source = load_serving_model(model_path=model_path)
+    server = ScoringServer((host, port), ScoringRequestHandler)
+    server.model_source = source
+    server.batcher = MicroBatcher(model, encoder=encoder)
+    return server
+
+def serve_in_background(model=None, model_path=MODEL_PATH, host="127.0.0.1", port=0):
+    """
+    Start a scoring server on a background thread, e.g. for offline tests.
+
+    Returns:
+        ScoringServer: The running server; call `shutdown()` and
+        `batcher.close()` to stop it.
+    """
+    server = create_server(model, model_path, host, port)
+    threading.Thread(target=server.serve_forever, name="scoring-server", daemon=True).start()
+    return server
+
+class ScoringClient:
+    """
+    Minimal client for the scoring service using only the standard library.
+    """
+
+    def __init__(self, base_url=f"http://127.0.0.1:{SCORING_PORT}", timeout=10):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+
+    def _request(self, path, payload=None):
+        data = json.dumps(payload).encode() if payload is not None else None
+        request = urllib.request.Request(
+            f"{self.base_url}{path}", data=data, headers={"Content-Type": "application/json"}
+        )
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return json.loads(response.read())
+
+    def score(self, customers) -> list:
+        """
+        Score one customer record or a list of them.
+        """
+        if isinstance(customers, dict):
+            customers = [customers]
+        return self._request("/score", {"customers": customers})["scores"]
+
+    def metrics(self) -> dict:
+        return self._request("/metrics")
+
+    def health(self) -> dict:
+        return self._request("/health")
+
+if __name__ == "__main__":
+    scoring_server = create_server()
+    logger.info(f"Scoring service listening on {SCORING_HOST}:{SCORING_PORT}")
+    try:
+        scoring_server.serve_forever()
+    finally:
+        scoring_server.batcher.close()
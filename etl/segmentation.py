@@ -0,0 +1,272 @@
+"""
+Customer Segmentation
+
+This module fills the `segments` table. Every customer gets two scores,
+computed with vectorized column arithmetic on the per-customer aggregates of
+`modeling.iter_feature_chunks`:
+
+- engagement: `log1p(total usage frequency)`, halved for every
+  `ENGAGEMENT_HALF_LIFE_DAYS` since the customer last used the product
+- spending: `log1p(total amount paid)`
+
+The standardized scores are clustered with `MiniBatchKMeans`, fitted on at
+most `SEGMENT_FIT_SAMPLE` customers, and each cluster is labelled by the
+quadrant of its centre (e.g. "High Engagement / Low Spending", numbered when
+several clusters share a quadrant). Only the customer id and the two scores
+are kept per customer, so memory stays small next to the feature chunks
+streamed from the database.
+
+The fitted model is saved with the usage and transaction high-water marks.
+`update_segments` then reassigns only customers with usage or transactions
+past those marks, or without a segment yet, against the saved cluster
+centres; other customers keep their scores until the next full run.
+
+Usage:
+
+    python segmentation.py            # reassign changed customers
+    python segmentation.py --full     # refit and rewrite every customer
+"""
+
+import os
+import time
+
+import joblib
+import numpy as np
+import pandas as pd
+from loguru import logger
+from sklearn.cluster import MiniBatchKMeans
+from sklearn.preprocessing import StandardScaler
+from sqlalchemy import select, union
+
+from database import engine
+from incremental import APPEND_ONLY_TABLES, read_watermark
+from instrumentation import stage
+from models import Customer, Segment, Transaction, Usage
+from modeling import CUSTOMER_ID_BATCH_SIZE, FEATURE_CHUNK_SIZE, iter_feature_chunks
+from writeback import replace_segments
+
+SEGMENTATION_STATE_PATH = os.environ.get("SEGMENTATION_STATE_PATH", "checkpoints/segmentation.joblib")
+N_SEGMENTS = int(os.environ.get("N_SEGMENTS", 4))
+ENGAGEMENT_HALF_LIFE_DAYS = 30.0
+SEGMENT_FIT_SAMPLE = 1_000_000  # Customers the clusters are fitted on
+SEGMENT_BATCH_SIZE = 4096  # Mini-batch size of the clustering
+SCORE_COLUMNS = ["engagement_score", "spending_score"]
+ACTIVITY_TABLES = ("usage", "transactions")
+
+def compute_scores(features):
+    """
+    Engagement and spending scores of every customer in a feature frame.
+
+    Args:
+        features (DataFrame): Rows of `modeling.iter_feature_chunks`, with
+            customer_id, usage_frequency, days_since_last_used and amount.
+
+    Returns:
+        DataFrame: customer_id, engagement_score and spending_score.
+    """
+    usage = np.log1p(pd.to_numeric(features["usage_frequency"]).fillna(0).clip(lower=0).to_numpy(dtype=float))
+    days = pd.to_numeric(features["days_since_last_used"]).to_numpy(dtype=float)
+    # Customers who never used the product have no engagement left
+    decay = np.where(np.isnan(days), 0.0, 0.5 ** (np.clip(days, 0, None) / ENGAGEMENT_HALF_LIFE_DAYS))
+    spending = np.log1p(pd.to_numeric(features["amount"]).fillna(0).clip(lower=0).to_numpy(dtype=float))
+    return pd.DataFrame({
+        "customer_id": features["customer_id"].to_numpy(dtype=np.int64),
+        "engagement_score": (usage * decay).astype(np.float32),
+        "spending_score": spending.astype(np.float32),
+    })
+
+def stream_scores(customer_ids=None, chunksize=FEATURE_CHUNK_SIZE, reference_date=None):
+    """
+    Scores of all customers, or of `customer_ids`, from the feature stream.
+
+    Returns:
+        DataFrame: Same columns as `compute_scores`.
+    """
+    if customer_ids is None:
+        batches = [None]
+    else:
+        customer_ids = list(customer_ids)
+        batches = [customer_ids[start:start + CUSTOMER_ID_BATCH_SIZE]
+                   for start in range(0, len(customer_ids), CUSTOMER_ID_BATCH_SIZE)]
+    parts = [
+        compute_scores(chunk)
+        for batch in batches
+        for chunk in iter_feature_chunks(chunksize, customer_ids=batch, reference_date=reference_date)
+    ]
+    if not parts:
+        return pd.DataFrame({"customer_id": np.empty(0, np.int64),
+                             **{column: np.empty(0, np.float32) for column in SCORE_COLUMNS}})
+    return pd.concat(parts, ignore_index=True)
+
+def quadrant_labels(scaler, kmeans) -> dict:
+    """
+    Label of every cluster from the side of the mean its centre lies on.
+
+    Clusters sharing a quadrant are numbered by the sum of their centre's
+    scores, lowest first (e.g. "Low Engagement / Low Spending 2"), so no two
+    clusters are merged under one label.
+
+    Returns:
+        dict: Segment label keyed by cluster number.
+    """
+    quadrants = {}
+    for cluster, (engagement, spending) in enumerate(kmeans.cluster_centers_):
+        quadrant = (
+            f"{'High' if engagement >= 0 else 'Low'} Engagement / "
+            f"{'High' if spending >= 0 else 'Low'} Spending"
+        )
+        quadrants.setdefault(quadrant, []).append(cluster)
+    labels = {}
+    for quadrant, clusters in quadrants.items():
+        if len(clusters) == 1:
+            labels[clusters[0]] = quadrant
+            continue
+        clusters.sort(key=lambda cluster: kmeans.cluster_centers_[cluster].sum())
+        for number, cluster in enumerate(clusters, start=1):
+            labels[cluster] = f"{quadrant} {number}"
+    return labels
+
+def fit_segments(scores, n_segments=N_SEGMENTS, random_state=0) -> dict:
+    """
+    Fit the scaler and the clusters on the scores of all customers.
+
+    Returns:
+        dict: The segmentation model, with "scaler", "kmeans" and "labels".
+    """
+    values = scores[SCORE_COLUMNS].to_numpy()
+    scaler = StandardScaler().fit(values)
+    if len(values) > SEGMENT_FIT_SAMPLE:
+        sample = np.random.default_rng(random_state).choice(len(values), SEGMENT_FIT_SAMPLE, replace=False)
+        values = values[sample]
+    kmeans = MiniBatchKMeans(
+        n_clusters=n_segments, batch_size=SEGMENT_BATCH_SIZE, n_init=3, random_state=random_state,
+    ).fit(scaler.transform(values))
+    return {"scaler": scaler, "kmeans": kmeans, "labels": quadrant_labels(scaler, kmeans)}
+
+def assign_segments(scores, model: dict):
+    """
+    Segment rows for the `segments` table.
+
+    Returns:
+        DataFrame: customer_id, segment_label, engagement_score and spending_score.
+    """
+    clusters = model["kmeans"].predict(model["scaler"].transform(scores[SCORE_COLUMNS].to_numpy()))
+    labels = np.array([model["labels"][cluster] for cluster in range(len(model["labels"]))], dtype=object)
+    return pd.DataFrame({
+        "customer_id": scores["customer_id"].to_numpy(),
+        "segment_label": labels[clusters],
+        "engagement_score": scores["engagement_score"].astype(float).to_numpy(),
+        "spending_score": scores["spending_score"].astype(float).to_numpy(),
+    })
+
+def activity_watermarks(bind=None) -> dict:
+    """
+    Current high-water marks of the usage and transactions tables.
+    """
+    with (bind or engine).connect() as connection:
+        return {table_name: read_watermark(connection, table_name, APPEND_ONLY_TABLES[table_name])
+                for table_name in ACTIVITY_TABLES}
+
+def changed_customer_ids(watermarks: dict, bind=None) -> list:
+    """
+    Customers with usage or transactions past `watermarks`, or without a segment.
+    """
+    queries = [
+        select(Customer.customer_id)
+        .outerjoin(Segment, Segment.customer_id == Customer.customer_id)
+        .where(Segment.customer_id.is_(None))
+    ]
+    for model, column, table_name in ((Usage, Usage.usage_id, "usage"),
+                                      (Transaction, Transaction.transaction_id, "transactions")):
+        query = select(model.customer_id)
+        if watermarks.get(table_name) is not None:
+            query = query.where(column > watermarks[table_name])
+        queries.append(query)
+    with (bind or engine).connect() as connection:
+        return sorted(connection.execute(union(*queries)).scalars())
+
+def save_state(state: dict, state_path: str = SEGMENTATION_STATE_PATH) -> None:
+    """
+    Atomically write the segmentation model and watermarks.
+    """
+    os.makedirs(os.path.dirname(state_path) or ".", exist_ok=True)
+    joblib.dump(state, f"{state_path}.tmp")
+    os.replace(f"{state_path}.tmp", state_path)
+
+def load_state(state_path: str = SEGMENTATION_STATE_PATH) -> dict | None:
+    """
+    Read the segmentation state, or None if segmentation never ran.
+    """
+    if not os.path.exists(state_path):
+        return None
+    return joblib.load(state_path)
+
+def segment_all_customers(features=None, n_segments=N_SEGMENTS, state_path: str = SEGMENTATION_STATE_PATH) -> int:
+    """
+    Refit the segmentation and rewrite the segment of every customer.
+
+    Args:
+        features (DataFrame, optional): Features of all customers, e.g. from
+            `modeling.fetch_data_for_predictions`; streamed when not given.
+        n_segments (int): Number of clusters.
+        state_path (str): Where the model and watermarks are saved.
+
+    Returns:
+        int: Number of customers written.
+    """
+    start = time.perf_counter()
+    # Taken first, so activity arriving during the run is picked up by the next update
+    watermarks = activity_watermarks()
+    with stage("segment_scores") as current:
+        scores = stream_scores() if features is None else compute_scores(features)
+        current.rows_out = len(scores)
+    if scores.empty:
+        logger.warning("No customers to segment")
+        return 0
+    with stage("segment_fit", rows_in=len(scores)):
+        model = fit_segments(scores, n_segments)
+    with stage("segment_write", rows_in=len(scores)) as current:
+        current.rows_out = replace_segments(assign_segments(scores, model), full=True)
+    save_state({**model, "watermarks": watermarks}, state_path)
+    logger.info(f"Segmented {len(scores)} customers in {time.perf_counter() - start:.2f}s")
+    return len(scores)
+
+def update_segments(state_path: str = SEGMENTATION_STATE_PATH) -> int:
+    """
+    Reassign only customers whose activity changed since the last run.
+
+    Falls back to `segment_all_customers` when there is no saved state.
+
+    Returns:
+        int: Number of customers written.
+    """
+    state = load_state(state_path)
+    if state is None:
+        logger.info("No segmentation state; segmenting every customer")
+        return segment_all_customers(state_path=state_path)
+    start = time.perf_counter()
+    watermarks = activity_watermarks()
+    customer_ids = changed_customer_ids(state["watermarks"])
+    if not customer_ids:
+        logger.info("No customer activity since the last segmentation")
+        return 0
+    with stage("segment_scores", rows_in=len(customer_ids)) as current:
+        scores = stream_scores(customer_ids)
+        current.rows_out = len(scores)
+    with stage("segment_write", rows_in=len(scores)) as current:
+        current.rows_out = replace_segments(assign_segments(scores, state))
+    save_state({**state, "watermarks": watermarks}, state_path)
+    logger.info(f"Reassigned {len(scores)} changed customers in {time.perf_counter() - start:.2f}s")
+    return len(scores)
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Assign customers to segments.")
+    parser.add_argument("--full", action="store_true", help="Refit the clusters and rewrite every customer")
+    parser.add_argument("--segments", type=int, default=N_SEGMENTS)
+    args = parser.parse_args()
+    if args.full:
+        segment_all_customers(n_segments=args.segments)
+    else:
+        update_segments()
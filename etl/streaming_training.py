@@ -0,0 +1,240 @@
+"""
+Out-of-Core Training
+
+This module trains a churn classifier without ever holding the whole feature
+table in memory. Per-customer feature chunks are streamed from the
+server-side cursor of `modeling.iter_feature_chunks` (the query behind
+`fetch_data_for_predictions`) into estimators that learn with `partial_fit`:
+a `StandardScaler` for the numeric columns and an `SGDClassifier`.
+
+Categorical columns are one-hot encoded against a vocabulary fixed before
+training starts, so every chunk gets the same sparse columns. Progress is
+checkpointed every few chunks together with the last customer id seen; an
+interrupted run resumes after that customer. Memory is bounded by the chunk
+size, not by the number of customers.
+"""
+
+import os
+import resource
+import time
+
+import joblib
+import numpy as np
+import pandas as pd
+from loguru import logger
+from scipy import sparse
+from sklearn.linear_model import SGDClassifier
+from sklearn.preprocessing import OneHotEncoder, StandardScaler
+from sqlalchemy import distinct, select
+
+from database import engine
+from models import Customer
+from modeling import FEATURE_CHUNK_SIZE, iter_feature_chunks
+
+CHECKPOINT_PATH = os.environ.get("STREAMING_CHECKPOINT_PATH", "checkpoints/streaming_model.joblib")
+CHECKPOINT_EVERY = 10  # Chunks between checkpoints
+NUMERIC_FEATURES = [
+    "age",
+    "usage_frequency",
+    "usage_count",
+    "usage_frequency_mean",
+    "amount",
+    "transaction_count",
+    "amount_mean",
+    "days_since_last_used",
+    "days_since_last_payment",
+]
+CATEGORICAL_FEATURES = ["gender", "location"]
+
+def churn_label(chunk):
+    """
+    Churn label used by `modeling.train_and_predict`: total usage below 5.
+    """
+    return (chunk["usage_frequency"] < 5).astype(int)
+
+def category_vocabulary(bind=None) -> dict:
+    """
+    Distinct values of every categorical feature, read once before training.
+
+    Only the distinct values are fetched, so the result is as small as the
+    vocabulary whatever the number of customers.
+
+    Returns:
+        dict: Sorted list of categories keyed by column name.
+    """
+    vocabulary = {}
+    with (bind or engine).connect() as connection:
+        for column in CATEGORICAL_FEATURES:
+            values = connection.execute(
+                select(distinct(getattr(Customer, column))).where(getattr(Customer, column).is_not(None))
+            ).scalars()
+            vocabulary[column] = sorted(values)
+    return vocabulary
+
+class StreamingChurnModel:
+    """
+    Scaler, fixed-vocabulary encoder and classifier trained chunk by chunk.
+
+    Args:
+        vocabulary (dict): Categories per column, from `category_vocabulary`.
+            Values outside it are encoded as all zeros.
+        classifier (optional): Estimator with `partial_fit` and
+            `predict_proba`. Defaults to a logistic `SGDClassifier`.
+    """
+
+    classes = np.array([0, 1])
+
+    def __init__(self, vocabulary, classifier=None):
+        self.vocabulary = vocabulary
+        self.scaler = StandardScaler()
+        self.encoder = OneHotEncoder(
+            categories=[vocabulary[column] for column in CATEGORICAL_FEATURES],
+            handle_unknown="ignore",
+        )
+        # The categories are given, fitting only sets up the output layout
+        self.encoder.fit(pd.DataFrame({
+            column: vocabulary[column][:1] or [""] for column in CATEGORICAL_FEATURES
+        }))
+        self.classifier = classifier or SGDClassifier(loss="log_loss", random_state=42)
+        self.fitted = False
+
+    @property
+    def feature_names(self) -> list:
+        return NUMERIC_FEATURES + list(self.encoder.get_feature_names_out(CATEGORICAL_FEATURES))
+
+    def transform(self, chunk):
+        """
+        Encode a feature chunk as a sparse matrix with a fixed column layout.
+        """
+        numeric = chunk[NUMERIC_FEATURES].astype(float).fillna(0).to_numpy()
+        categorical = self.encoder.transform(chunk[CATEGORICAL_FEATURES].astype(object))
+        return sparse.hstack([sparse.csr_matrix(self.scaler.transform(numeric)), categorical], format="csr")
+
+    def partial_fit(self, chunk, y):
+        """
+        Update the scaler and the classifier with one chunk.
+        """
+        self.scaler.partial_fit(chunk[NUMERIC_FEATURES].astype(float).fillna(0).to_numpy())
+        self.classifier.partial_fit(self.transform(chunk), y, classes=self.classes)
+        self.fitted = True
+        return self
+
+    def predict_proba(self, chunk):
+        return self.classifier.predict_proba(self.transform(chunk))
+
+    def predict(self, chunk):
+        return self.classifier.predict(self.transform(chunk))
+
+def _peak_rss_bytes() -> int:
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def save_checkpoint(state: dict, checkpoint_path: str = CHECKPOINT_PATH) -> None:
+    """
+    Atomically write the training state.
+    """
+    os.makedirs(os.path.dirname(checkpoint_path) or ".", exist_ok=True)
+    joblib.dump(state, f"{checkpoint_path}.tmp")
+    os.replace(f"{checkpoint_path}.tmp", checkpoint_path)
+
+def load_checkpoint(checkpoint_path: str = CHECKPOINT_PATH) -> dict | None:
+    """
+    Read the training state, or None if there is no checkpoint.
+    """
+    if not os.path.exists(checkpoint_path):
+        return None
+    return joblib.load(checkpoint_path)
+
+def train_streaming(epochs: int = 1, chunksize: int = FEATURE_CHUNK_SIZE, checkpoint_path: str = CHECKPOINT_PATH,
+                    resume: bool = True, classifier=None) -> StreamingChurnModel:
+    """
+    Train a `StreamingChurnModel` over the feature stream.
+
+    Each chunk is first scored with the model trained so far (progressive
+    validation, so no rows have to be held out in memory) and then learned.
+    The state is checkpointed every `CHECKPOINT_EVERY` chunks and at the end
+    of every epoch.
+
+    Args:
+        epochs (int): Passes over all customers.
+        chunksize (int): Customers per chunk.
+        checkpoint_path (str): Where the training state is saved.
+        resume (bool): Continue from an existing checkpoint instead of
+            starting over.
+        classifier (optional): Estimator with `partial_fit`; see `StreamingChurnModel`.
+
+    Returns:
+        StreamingChurnModel: The trained model.
+    """
+    state = load_checkpoint(checkpoint_path) if resume else None
+    if state is None or state["epoch"] >= epochs:
+        state = {
+            "model": StreamingChurnModel(category_vocabulary(), classifier),
+            "reference_date": pd.Timestamp.now().normalize(),
+            "epoch": 0,
+            "last_customer_id": None,
+            "rows": 0,
+            "correct": 0,
+            "scored": 0,
+        }
+    else:
+        logger.info(
+            f"Resuming streaming training at epoch {state['epoch'] + 1}, "
+            f"after customer {state['last_customer_id']}"
+        )
+    model = state["model"]
+    start = time.perf_counter()
+
+    while state["epoch"] < epochs:
+        chunks = iter_feature_chunks(
+            chunksize, reference_date=state["reference_date"], after_customer_id=state["last_customer_id"]
+        )
+        for index, chunk in enumerate(chunks, start=1):
+            y = churn_label(chunk).to_numpy()
+            if model.fitted:
+                state["correct"] += int((model.predict(chunk) == y).sum())
+                state["scored"] += len(y)
+            model.partial_fit(chunk, y)
+            state["rows"] += len(chunk)
+            state["last_customer_id"] = int(chunk["customer_id"].iloc[-1])
+            if index % CHECKPOINT_EVERY == 0:
+                save_checkpoint(state, checkpoint_path)
+                logger.info(
+                    f"Epoch {state['epoch'] + 1}: {state['rows']} rows, "
+                    f"peak RSS {_peak_rss_bytes() / 1024 ** 2:.0f} MiB"
+                )
+        state["epoch"] += 1
+        state["last_customer_id"] = None
+        save_checkpoint(state, checkpoint_path)
+
+    elapsed = time.perf_counter() - start
+    accuracy = state["correct"] / state["scored"] if state["scored"] else float("nan")
+    logger.info(
+        f"Streaming training finished: {state['rows']} rows in {elapsed:.2f}s, "
+        f"progressive accuracy {accuracy:.4f}, peak RSS {_peak_rss_bytes() / 1024 ** 2:.0f} MiB"
+    )
+    return model
+
+def iter_predictions(model: StreamingChurnModel, chunksize: int = FEATURE_CHUNK_SIZE, reference_date=None):
+    """
+    Score every customer chunk by chunk.
+
+    Yields:
+        DataFrame: customer_id, predicted_churn and churn_probability for one
+        chunk, ready for `writeback.bulk_insert_results`.
+    """
+    for chunk in iter_feature_chunks(chunksize, reference_date=reference_date):
+        probabilities = model.predict_proba(chunk)[:, 1]
+        yield pd.DataFrame({
+            "customer_id": chunk["customer_id"].to_numpy(),
+            "predicted_churn": (probabilities > 0.5).astype(int),
+            "churn_probability": probabilities,
+        })
+
+if __name__ == "__main__":
+    from writeback import bulk_insert_results
+
+    trained = train_streaming(epochs=int(os.environ.get("STREAMING_EPOCHS", 1)))
+    created_at = pd.Timestamp.now()
+    for predictions in iter_predictions(trained):
+        bulk_insert_results(predictions, created_at=created_at)
@@ -0,0 +1,226 @@
+"""
+Table Swap
+
+This module replaces the whole contents of a table. `swap_into_table` fills
+an UNLOGGED staging table and renames it over the live one in a single
+short transaction on PostgreSQL, so readers never see the table empty;
+other engines delete and refill the rows in one transaction. `clear_table`
+empties a table (and, on PostgreSQL, the tables referencing it) for loaders
+that refill it in place. The ETL loader (`etl.py`) and the segment
+write-back (`writeback.replace_segments`) both go through here.
+"""
+
+import re
+import time
+
+from loguru import logger
+from sqlalchemy import text
+
+from database import engine
+from feature_cache import bump_data_version
+from models import Base
+
+STAGING_SUFFIX = "__staging"
+
+def is_postgres(connection) -> bool:
+    """
+    Tell whether a connection talks to PostgreSQL.
+    """
+    return connection.dialect.name == "postgresql"
+
+def _cascaded_tables(table_name: str, metadata=Base.metadata) -> set:
+    """
+    A table and every table whose foreign keys lead to it, which TRUNCATE ... CASCADE empties.
+    """
+    tables = {table_name}
+    pending = [table_name]
+    while pending:
+        target = pending.pop()
+        for table in metadata.tables.values():
+            if table.name not in tables and any(fk.column.table.name == target for fk in table.foreign_keys):
+                tables.add(table.name)
+                pending.append(table.name)
+    return tables
+
+def clear_table(connection, table_name: str) -> None:
+    """
+    Remove all rows from a table before a full reload.
+
+    On PostgreSQL the tables referencing it are emptied as well; the campaign
+    and dashboard rollups built from any emptied table are reset so they are
+    rebuilt on their next refresh instead of trusting watermarks the
+    restarted ids fall below.
+    """
+    table = connection.dialect.identifier_preparer.quote(table_name)
+    if is_postgres(connection):
+        connection.execute(text(f"TRUNCATE TABLE {table} RESTART IDENTITY CASCADE"))
+        emptied = _cascaded_tables(table_name)
+    else:
+        connection.execute(text(f"DELETE FROM {table}"))
+        emptied = {table_name}
+    for emptied_table in sorted(emptied):
+        bump_data_version(connection, emptied_table)
+    # The rollups read through modeling, which writes through writeback, which imports this module
+    from campaign_rollups import reset_sources
+    from dashboard_rollups import reset_dashboard_rollups
+
+    reset_sources(connection, emptied)
+    reset_dashboard_rollups(connection, emptied)
+
+def staging_name(name: str) -> str:
+    """
+    Name of the staging counterpart of a table, index or constraint.
+    """
+    return f"{name[:63 - len(STAGING_SUFFIX)]}{STAGING_SUFFIX}"
+
+def describe_table(connection, table_name: str) -> dict:
+    """
+    Read the indexes, foreign keys and owned sequences a swap has to carry over.
+    """
+    params = {"table": connection.dialect.identifier_preparer.quote(table_name)}
+    indexes = connection.execute(text("""
+        SELECT i.relname, pg_get_indexdef(i.oid), c.conname, c.contype
+        FROM pg_index x
+        JOIN pg_class i ON i.oid = x.indexrelid
+        LEFT JOIN pg_constraint c
+            ON c.conindid = x.indexrelid AND c.conrelid = x.indrelid AND c.contype IN ('p', 'u')
+        WHERE x.indrelid = CAST(:table AS regclass)
+    """), params).all()
+    outbound = connection.execute(text("""
+        SELECT conname, pg_get_constraintdef(oid)
+        FROM pg_constraint
+        WHERE conrelid = CAST(:table AS regclass) AND contype = 'f'
+    """), params).all()
+    # Constraints cloned onto partitions (conparentid <> 0) follow their parent's
+    inbound = connection.execute(text("""
+        SELECT CAST(CAST(c.conrelid AS regclass) AS text), c.conname, pg_get_constraintdef(c.oid),
+            r.relkind = 'p'
+        FROM pg_constraint c
+        JOIN pg_class r ON r.oid = c.conrelid
+        WHERE c.confrelid = CAST(:table AS regclass) AND c.conrelid <> c.confrelid AND c.contype = 'f'
+            AND c.conparentid = 0
+    """), params).all()
+    sequences = connection.execute(text("""
+        SELECT a.attname, pg_get_serial_sequence(:table, a.attname)
+        FROM pg_attribute a
+        WHERE a.attrelid = CAST(:table AS regclass) AND a.attnum > 0 AND NOT a.attisdropped
+            AND pg_get_serial_sequence(:table, a.attname) IS NOT NULL
+    """), params).all()
+    return {"indexes": indexes, "outbound": outbound, "inbound": inbound, "sequences": sequences}
+
+def swap_into_table(table_name: str, fill, bind=None) -> int:
+    """
+    Replace the contents of a table without readers ever seeing it empty.
+
+    `fill` writes the new rows into an UNLOGGED staging table, which then gets
+    the live table's indexes, constraints and outgoing foreign keys. It is
+    switched to LOGGED so the data survives a crash and swapped in with a
+    rename in a single short transaction. Foreign keys on other tables that
+    point at the live table are re-created against the new one, so dependent
+    tables such as `results`, `predictions` and `segments` keep their rows.
+    Non-Postgres engines replace the rows with DELETE and `fill` in one
+    transaction instead. Not for tables partitioned by month; see
+    `swap_csv_into_table`.
+
+    Args:
+        table_name (str): Name of the table to replace.
+        fill (callable): Called with a connection and the name of the table
+            to write to; returns the number of rows written.
+        bind (Engine, optional): Engine to load through. Defaults to `engine`.
+
+    Returns:
+        int: Number of rows loaded.
+    """
+    bind = bind or engine
+    start = time.perf_counter()
+    with bind.connect() as connection:
+        if not is_postgres(connection):
+            with connection.begin():
+                clear_table(connection, table_name)
+                rows = fill(connection, table_name)
+            logger.info(f"Replaced {table_name} with {rows} rows in {time.perf_counter() - start:.2f}s")
+            return rows
+        with connection.begin():
+            layout = describe_table(connection, table_name)
+
+    quote = bind.dialect.identifier_preparer.quote
+    table = quote(table_name)
+    staging = quote(staging_name(table_name))
+
+    # Build the staging table outside the swap so readers are never blocked by the load
+    try:
+        with bind.begin() as connection:
+            connection.execute(text(f"DROP TABLE IF EXISTS {staging}"))
+            connection.execute(text(
+                f"CREATE UNLOGGED TABLE {staging} (LIKE {table} INCLUDING ALL EXCLUDING INDEXES)"
+            ))
+            rows = fill(connection, staging_name(table_name))
+            for index_name, definition, constraint_name, constraint_type in layout["indexes"]:
+                definition = re.sub(
+                    r"^(CREATE (?:UNIQUE )?INDEX) \S+ ON (?:ONLY )?\S+ ",
+                    lambda match: f"{match.group(1)} {quote(staging_name(index_name))} ON {staging} ",
+                    definition,
+                )
+                connection.execute(text(definition))
+                if constraint_name:
+                    kind = "PRIMARY KEY" if constraint_type == "p" else "UNIQUE"
+                    connection.execute(text(
+                        f"ALTER TABLE {staging} ADD CONSTRAINT {quote(staging_name(constraint_name))} "
+                        f"{kind} USING INDEX {quote(staging_name(index_name))}"
+                    ))
+            for constraint_name, definition in layout["outbound"]:
+                connection.execute(text(
+                    f"ALTER TABLE {staging} ADD CONSTRAINT {quote(constraint_name)} {definition}"
+                ))
+            connection.execute(text(f"ALTER TABLE {staging} SET LOGGED"))
+            connection.execute(text(f"ANALYZE {staging}"))
+    except Exception:
+        with bind.begin() as connection:
+            connection.execute(text(f"DROP TABLE IF EXISTS {staging}"))
+        raise
+
+    # Swap the tables in one transaction; readers only wait for the renames
+    with bind.begin() as connection:
+        connection.execute(text(f"LOCK TABLE {table} IN ACCESS EXCLUSIVE MODE"))
+        for column, sequence in layout["sequences"]:
+            connection.execute(text(f"ALTER SEQUENCE {sequence} OWNED BY {staging}.{quote(column)}"))
+        connection.execute(text(f"DROP TABLE {table} CASCADE"))
+        connection.execute(text(f"ALTER TABLE {staging} RENAME TO {table}"))
+        for index_name, _, constraint_name, _ in layout["indexes"]:
+            if constraint_name:
+                connection.execute(text(
+                    f"ALTER TABLE {table} RENAME CONSTRAINT "
+                    f"{quote(staging_name(constraint_name))} TO {quote(constraint_name)}"
+                ))
+            else:
+                connection.execute(text(
+                    f"ALTER INDEX {quote(staging_name(index_name))} RENAME TO {quote(index_name)}"
+                ))
+        for dependent, constraint_name, definition, partitioned in layout["inbound"]:
+            # Partitioned tables do not accept NOT VALID foreign keys and are checked right away
+            connection.execute(text(
+                f"ALTER TABLE {dependent} ADD CONSTRAINT {quote(constraint_name)} {definition}"
+                f"{'' if partitioned else ' NOT VALID'}"
+            ))
+        for column, sequence in layout["sequences"]:
+            connection.execute(text(
+                f"SELECT setval('{sequence}', COALESCE(MAX({quote(column)}), 0) + 1, false) FROM {table}"
+            ))
+        bump_data_version(connection, table_name)
+
+    # Validating takes a lock that does not block readers or writers of the dependent table
+    for dependent, constraint_name, _, partitioned in layout["inbound"]:
+        if partitioned:
+            continue
+        try:
+            with bind.begin() as connection:
+                connection.execute(text(f"ALTER TABLE {dependent} VALIDATE CONSTRAINT {quote(constraint_name)}"))
+        except Exception as e:
+            logger.warning(f"Foreign key {constraint_name} on {dependent} left NOT VALID: {e}")
+
+    elapsed = time.perf_counter() - start
+    logger.info(
+        f"Swapped {rows} rows into {table_name} in {elapsed:.2f}s "
+        f"({rows / elapsed if elapsed else 0:,.0f} rows/sec)"
+    )
+    return rows
@@ -0,0 +1,178 @@
+"""
+Feedback Features
+
+This module turns `feedback.rating` into per-customer features for the
+churn model: feedback_count, mean_rating and negative_share (share of
+ratings at or below `NEGATIVE_RATING`).
+
+Feedback rows are streamed from a server-side cursor in batches of
+`FEEDBACK_BATCH_SIZE`, ordered by customer, and reduced on a process pool
+of `TEXT_WORKERS` with a bounded number of batches in flight. Each batch is
+reduced to one row of counts per customer before it comes back, so memory
+grows with the number of customers, never with the number of feedback rows.
+`join_text_features` lines the aggregates up with a per-customer feature
+frame; `modeling.build_feature_frame` joins them this way, and the churn
+model is trained on them.
+"""
+
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from itertools import chain
+
+import numpy as np
+import pandas as pd
+from loguru import logger
+from sqlalchemy import select
+
+from database import engine
+from models import Feedback
+
+TEXT_WORKERS = int(os.environ.get("TEXT_WORKERS", os.cpu_count() or 1))  # Processes reducing batches
+FEEDBACK_BATCH_SIZE = 50_000  # Feedback rows per batch
+NEGATIVE_RATING = 2  # Ratings at or below this count as negative
+AGGREGATE_COLUMNS = ["feedback_count", "mean_rating", "negative_share"]
+
+def _group_sum(keys, values):
+    """
+    Sum the rows of an array per key.
+
+    Returns:
+        tuple: (sorted unique keys, array with one row per key)
+    """
+    unique_keys, inverse = np.unique(keys, return_inverse=True)
+    sums = np.zeros((len(unique_keys), values.shape[1]))
+    np.add.at(sums, inverse, values)
+    return unique_keys, sums
+
+def reduce_batch(customer_ids, ratings):
+    """
+    Reduce one batch of feedback rows to one row of counts per customer.
+
+    Runs in the worker processes, so it takes and returns plain arrays.
+
+    Args:
+        customer_ids (ndarray): Customer of every feedback row.
+        ratings (ndarray): Ratings as floats, NaN when missing.
+
+    Returns:
+        tuple: (customer ids, per-customer matrix of feedback count, rating
+        sum, rating count and negative count)
+    """
+    rated = ~np.isnan(ratings)
+    return _group_sum(customer_ids, np.column_stack([
+        np.ones(len(ratings)),
+        np.where(rated, ratings, 0.0),
+        rated.astype(float),
+        (rated & (ratings <= NEGATIVE_RATING)).astype(float),
+    ]))
+
+def iter_feedback_batches(batch_size=FEEDBACK_BATCH_SIZE, bind=None, customer_ids=None):
+    """
+    Stream feedback rows from a server-side cursor, ordered by customer.
+
+    Args:
+        batch_size (int): Rows per batch.
+        bind (Engine, optional): Engine to read through. Defaults to `engine`.
+        customer_ids (Iterable[int], optional): Only the feedback of these customers.
+
+    Yields:
+        tuple: (customer ids, ratings) of up to `batch_size` rows.
+    """
+    query = select(Feedback.customer_id, Feedback.rating) \
+        .where(Feedback.customer_id.is_not(None)).order_by(Feedback.customer_id)
+    if customer_ids is not None:
+        query = query.where(Feedback.customer_id.in_(list(customer_ids)))
+    with (bind or engine).connect() as connection:
+        result = connection.execution_options(stream_results=True, yield_per=batch_size).execute(query)
+        for partition in result.partitions():
+            customer_ids, ratings = zip(*partition)
+            yield (
+                np.asarray(customer_ids, dtype=np.int64),
+                np.asarray([np.nan if rating is None else rating for rating in ratings], dtype=float),
+            )
+
+def build_text_features(batch_size=FEEDBACK_BATCH_SIZE, workers=TEXT_WORKERS, bind=None, customer_ids=None):
+    """
+    Build the feedback aggregates of every customer with feedback.
+
+    Args:
+        batch_size (int): Feedback rows per batch.
+        workers (int): Reducing processes; 1 reduces in this process.
+        bind (Engine, optional): Engine to read through. Defaults to `engine`.
+        customer_ids (Iterable[int], optional): Only build these customers.
+
+    Returns:
+        DataFrame: customer_id and `AGGREGATE_COLUMNS`, one row per customer sorted by id.
+    """
+    start = time.perf_counter()
+    parts = []
+    rows = 0
+    batches = iter_feedback_batches(batch_size, bind, customer_ids)
+    # A single batch is reduced here; starting the pool would cost more than it saves
+    head = [batch for batch in (next(batches, None), next(batches, None)) if batch is not None]
+    batches = chain(head, batches)
+    if workers <= 1 or len(head) < 2:
+        for customer_ids, ratings in batches:
+            rows += len(customer_ids)
+            parts.append(reduce_batch(customer_ids, ratings))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # Only a few batches wait at a time, so reading never runs far ahead of reducing
+            pending = set()
+            for customer_ids, ratings in batches:
+                rows += len(customer_ids)
+                pending.add(executor.submit(reduce_batch, customer_ids, ratings))
+                if len(pending) >= 2 * workers:
+                    finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        parts.append(future.result())
+            for future in pending:
+                parts.append(future.result())
+
+    if not parts:
+        return pd.DataFrame({"customer_id": np.empty(0, np.int64),
+                             **{column: np.empty(0) for column in AGGREGATE_COLUMNS}})
+
+    # Batches are cut by row count, so a customer can span two of them
+    customer_ids, combined = _group_sum(np.concatenate([part[0] for part in parts]),
+                                        np.vstack([part[1] for part in parts]))
+    count, rating_sum, rated, negative = combined.T
+    with np.errstate(invalid="ignore", divide="ignore"):
+        aggregates = pd.DataFrame({
+            "customer_id": customer_ids,
+            "feedback_count": count,
+            "mean_rating": np.where(rated > 0, rating_sum / rated, np.nan),
+            "negative_share": np.where(rated > 0, negative / rated, np.nan),
+        })
+    logger.info(
+        f"Reduced {rows} feedback rows of {len(customer_ids)} customers "
+        f"in {time.perf_counter() - start:.2f}s"
+    )
+    return aggregates
+
+def join_text_features(features, aggregates):
+    """
+    Join feedback aggregates to a per-customer feature frame.
+
+    Args:
+        features (DataFrame): One row per customer, with customer_id.
+        aggregates (DataFrame): Aggregates from `build_text_features`.
+
+    Returns:
+        DataFrame: The frame with `AGGREGATE_COLUMNS` added, customers
+        without feedback getting a count of 0 and NaN rating columns.
+    """
+    joined = features.merge(aggregates, on="customer_id", how="left")
+    joined["feedback_count"] = joined["feedback_count"].fillna(0)
+    return joined
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Build per-customer feedback aggregates.")
+    parser.add_argument("--workers", type=int, default=TEXT_WORKERS)
+    parser.add_argument("--batch-size", type=int, default=FEEDBACK_BATCH_SIZE)
+    args = parser.parse_args()
+
+    print(build_text_features(args.batch_size, args.workers).describe().to_string())
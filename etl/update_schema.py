@@ -1,22 +1,446 @@
+"""
+Schema Migrations
+
+This module brings an existing database up to date with `models.py`. Every
+migration is applied once, recorded in the `schema_migrations` table and is
+safe to re-run:
+
+- `0001_create_tables`: creates missing tables.
+- `0002_foreign_key_and_time_indexes`: adds the indexes declared in the
+  models (every `customer_id` foreign key and the `created_at` /
+  `payment_date` columns) to tables that already exist. On PostgreSQL they
+  are built with `CREATE INDEX CONCURRENTLY`, which does not block reads or
+  writes.
+- `0003_monthly_partitions`: on PostgreSQL, turns `results`, `predictions`
+  and `transactions` into tables range-partitioned by month. The rows are
+  copied into a new partitioned table while writers wait and readers keep
+  using the old one; the tables are then swapped with a rename.
+- `0004_campaign_rollups`: creates the rollup tables of `campaign_rollups`.
+- `0005_dashboard_rollups`: creates the tables of `dashboard_rollups`.
+- `0006_data_versions`: creates the write counters of `feature_cache`.
+
+`ensure_monthly_partitions` adds the partitions of upcoming months and
+should run before every load; rows outside the existing partitions land in
+a default partition and are moved out when their month is created.
+"""
+
+import datetime
+import os
+
+from loguru import logger
+from sqlalchemy import inspect, text
+
 from database import engine
 from models import Base
 
+MIGRATIONS_TABLE = "schema_migrations"
+
+PARTITIONED_TABLES = {
+    "results": "created_at",
+    "predictions": "created_at",
+    "transactions": "payment_date",
+}
+"""
+dict: Partition key column of every table partitioned by month on PostgreSQL.
+"""
+
+PARTITION_MONTHS_AHEAD = int(os.environ.get("PARTITION_MONTHS_AHEAD", 3))  # Future months created in advance
+
+def _is_postgres(bind) -> bool:
+    return bind.dialect.name == "postgresql"
+
+def _month_start(value) -> datetime.date:
+    return datetime.date(value.year, value.month, 1)
+
+def _next_month(month: datetime.date) -> datetime.date:
+    return datetime.date(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+def partition_name(table_name: str, month: datetime.date) -> str:
+    """
+    Name of the partition holding one month, e.g. `results_p202401`.
+    """
+    return f"{table_name}_p{month:%Y%m}"
+
+def declared_indexes(metadata=Base.metadata) -> list:
+    """
+    Indexes declared in the models.
+
+    Returns:
+        list[tuple]: (index name, table name, column names, unique) per index.
+    """
+    return [
+        (index.name, table.name, [column.name for column in index.columns], index.unique)
+        for table in metadata.sorted_tables
+        for index in sorted(table.indexes, key=lambda index: index.name)
+    ]
+
+def is_partitioned(connection, table_name: str) -> bool:
+    """
+    Whether a table is a partitioned table (PostgreSQL only).
+    """
+    if connection.dialect.name != "postgresql":
+        return False
+    return bool(connection.execute(text(
+        "SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass(:table)"
+    ), {"table": connection.dialect.identifier_preparer.quote(table_name)}).scalar())
+
+def _index_state(connection, index_name: str):
+    """
+    None if the index does not exist, otherwise whether it is valid.
+    """
+    return connection.execute(text(
+        "SELECT x.indisvalid FROM pg_index x WHERE x.indexrelid = to_regclass(:index)"
+    ), {"index": connection.dialect.identifier_preparer.quote(index_name)}).scalar()
+
+def _create_index_concurrently(connection, index_name, table_name, columns, unique):
+    """
+    Build an index without blocking reads or writes, on an autocommit connection.
+
+    An invalid index left behind by an interrupted concurrent build is dropped
+    and rebuilt. Partitioned tables cannot be indexed concurrently in one
+    statement: the index is created on the parent only, built concurrently on
+    every partition and then attached, which makes the parent index valid.
+    """
+    quote = connection.dialect.identifier_preparer.quote
+    state = _index_state(connection, index_name)
+    if state:
+        return False
+    partitioned = is_partitioned(connection, table_name)
+    if state is False and not partitioned:
+        connection.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {quote(index_name)}"))
+    column_list = ", ".join(quote(column) for column in columns)
+    kind = "UNIQUE INDEX" if unique else "INDEX"
+
+    if not partitioned:
+        connection.execute(text(
+            f"CREATE {kind} CONCURRENTLY IF NOT EXISTS {quote(index_name)} ON {quote(table_name)} ({column_list})"
+        ))
+        return True
+
+    connection.execute(text(
+        f"CREATE {kind} IF NOT EXISTS {quote(index_name)} ON ONLY {quote(table_name)} ({column_list})"
+    ))
+    partitions = connection.execute(text(
+        "SELECT CAST(inhrelid AS regclass)::text FROM pg_inherits WHERE inhparent = to_regclass(:table)"
+    ), {"table": quote(table_name)}).scalars().all()
+    for partition in partitions:
+        partition_index = f"{partition}_{'_'.join(columns)}_idx"[:63]
+        connection.execute(text(
+            f"CREATE {kind} CONCURRENTLY IF NOT EXISTS {quote(partition_index)} ON {partition} ({column_list})"
+        ))
+        attached = connection.execute(text(
+            "SELECT 1 FROM pg_inherits WHERE inhrelid = to_regclass(:child) AND inhparent = to_regclass(:parent)"
+        ), {"child": quote(partition_index), "parent": quote(index_name)}).scalar()
+        if not attached:
+            connection.execute(text(f"ALTER INDEX {quote(index_name)} ATTACH PARTITION {quote(partition_index)}"))
+    return True
+
+def create_indexes(bind=None) -> list:
+    """
+    Add the indexes declared in the models to existing tables.
+
+    Returns:
+        list[str]: Names of the indexes that were created.
+    """
+    bind = bind or engine
+    existing_tables = set(inspect(bind).get_table_names())
+    created = []
+    if _is_postgres(bind):
+        # CREATE INDEX CONCURRENTLY cannot run inside a transaction block
+        with bind.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+            for index_name, table_name, columns, unique in declared_indexes():
+                if table_name in existing_tables and \
+                        _create_index_concurrently(connection, index_name, table_name, columns, unique):
+                    created.append(index_name)
+    else:
+        with bind.begin() as connection:
+            quote = connection.dialect.identifier_preparer.quote
+            for index_name, table_name, columns, unique in declared_indexes():
+                if table_name not in existing_tables:
+                    continue
+                if index_name in {index["name"] for index in inspect(connection).get_indexes(table_name)}:
+                    continue
+                connection.execute(text(
+                    f"CREATE {'UNIQUE INDEX' if unique else 'INDEX'} IF NOT EXISTS {quote(index_name)} "
+                    f"ON {quote(table_name)} ({', '.join(quote(column) for column in columns)})"
+                ))
+                created.append(index_name)
+    for index_name in created:
+        logger.info(f"Created index {index_name}")
+    return created
+
+def _create_month_partition(connection, table_name, column, month):
+    """
+    Create the partition of one month, moving its rows out of the default partition.
+    """
+    quote = connection.dialect.identifier_preparer.quote
+    table = quote(table_name)
+    partition = quote(partition_name(table_name, month))
+    default = quote(f"{table_name}_default")
+    bounds = {"low": month, "high": _next_month(month)}
+    has_default = connection.execute(text("SELECT to_regclass(:default) IS NOT NULL"),
+                                     {"default": default}).scalar()
+    if has_default:
+        waiting = connection.execute(text(
+            f"SELECT EXISTS (SELECT 1 FROM {default} WHERE {quote(column)} >= :low AND {quote(column)} < :high)"
+        ), bounds).scalar()
+    else:
+        waiting = False
+
+    if not waiting:
+        connection.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {partition} PARTITION OF {table} "
+            f"FOR VALUES FROM ('{bounds['low']}') TO ('{bounds['high']}')"
+        ))
+        return
+    # Rows of this month sit in the default partition; attaching checks they moved
+    connection.execute(text(f"CREATE TABLE {partition} (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"))
+    connection.execute(text(
+        f"WITH moved AS (DELETE FROM {default} WHERE {quote(column)} >= :low AND {quote(column)} < :high "
+        f"RETURNING *) INSERT INTO {partition} SELECT * FROM moved"
+    ), bounds)
+    connection.execute(text(
+        f"ALTER TABLE {table} ATTACH PARTITION {partition} "
+        f"FOR VALUES FROM ('{bounds['low']}') TO ('{bounds['high']}')"
+    ))
+
+def ensure_monthly_partitions(table_name: str, months_ahead: int = PARTITION_MONTHS_AHEAD, bind=None,
+                              since=None, until=None) -> list:
+    """
+    Create the monthly partitions a partitioned table is missing.
+
+    Partitions are created from the oldest month with data (including rows
+    parked in the default partition) up to `months_ahead` months from now.
+    `since` and `until` widen that range to rows about to be loaded, so they
+    land in their own partitions instead of the default one. Does nothing if
+    the table is not partitioned.
+
+    Returns:
+        list[str]: Names of the partitions that were created.
+    """
+    bind = bind or engine
+    column = PARTITIONED_TABLES[table_name]
+    created = []
+    with bind.begin() as connection:
+        if not is_partitioned(connection, table_name):
+            return created
+        quote = connection.dialect.identifier_preparer.quote
+        existing = set(connection.execute(text(
+            "SELECT CAST(inhrelid AS regclass)::text FROM pg_inherits WHERE inhparent = to_regclass(:table)"
+        ), {"table": quote(table_name)}).scalars())
+        oldest = connection.execute(text(
+            f"SELECT MIN({quote(column)}) FROM {quote(table_name)}"
+        )).scalar()
+        today = datetime.date.today()
+        month = min(_month_start(value) for value in (oldest, since, today) if value)
+        last = _month_start(today)
+        for _ in range(months_ahead):
+            last = _next_month(last)
+        if until:
+            last = max(last, _month_start(until))
+        while month <= last:
+            if partition_name(table_name, month) not in existing:
+                _create_month_partition(connection, table_name, column, month)
+                created.append(partition_name(table_name, month))
+            month = _next_month(month)
+    if created:
+        logger.info(f"Created {len(created)} monthly partitions of {table_name}")
+    return created
+
+def partition_table_by_month(table_name: str, bind=None) -> bool:
+    """
+    Convert a plain table into one range-partitioned by month.
+
+    The rows are copied into a new partitioned table while the old table is
+    locked in SHARE mode, so readers continue and writers wait. The primary
+    key gains the partition column, as PostgreSQL requires. Rows without a
+    partition key get the time of the migration. The old table is then
+    dropped and the new one renamed in place.
+
+    Returns:
+        bool: True if the table was converted, False if it already was partitioned.
+    """
+    bind = bind or engine
+    column = PARTITIONED_TABLES[table_name]
+    table_model = Base.metadata.tables[table_name]
+    with bind.begin() as connection:
+        if is_partitioned(connection, table_name):
+            return False
+        quote = connection.dialect.identifier_preparer.quote
+        table = quote(table_name)
+        new_name = f"{table_name}__partitioned"
+        new_table = quote(new_name)
+        key = quote(column)
+        params = {"table": table}
+
+        connection.execute(text(f"LOCK TABLE {table} IN SHARE MODE"))
+        foreign_keys = connection.execute(text("""
+            SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint
+            WHERE conrelid = CAST(:table AS regclass) AND contype = 'f'
+        """), params).all()
+        primary_key = connection.execute(text("""
+            SELECT conname FROM pg_constraint
+            WHERE conrelid = CAST(:table AS regclass) AND contype = 'p'
+        """), params).scalar()
+        sequences = connection.execute(text("""
+            SELECT a.attname, pg_get_serial_sequence(:table, a.attname) FROM pg_attribute a
+            WHERE a.attrelid = CAST(:table AS regclass) AND a.attnum > 0 AND NOT a.attisdropped
+                AND pg_get_serial_sequence(:table, a.attname) IS NOT NULL
+        """), params).all()
+        bounds = connection.execute(text(f"SELECT MIN({key}), MAX({key}) FROM {table}")).one()
+
+        connection.execute(text(
+            f"CREATE TABLE {new_table} (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS) "
+            f"PARTITION BY RANGE ({key})"
+        ))
+        connection.execute(text(f"ALTER TABLE {new_table} ALTER COLUMN {key} SET DEFAULT now()"))
+        connection.execute(text(f"ALTER TABLE {new_table} ALTER COLUMN {key} SET NOT NULL"))
+        connection.execute(text(f"CREATE TABLE {quote(f'{table_name}_default')} PARTITION OF {new_table} DEFAULT"))
+        # Partitions get their final names now; only the parent is renamed in the swap
+        this_month = _month_start(datetime.date.today())
+        month = min(_month_start(bounds[0]), this_month) if bounds[0] else this_month
+        last = max(_month_start(bounds[1]), this_month) if bounds[1] else this_month
+        for _ in range(PARTITION_MONTHS_AHEAD):
+            last = _next_month(last)
+        while month <= last:
+            connection.execute(text(
+                f"CREATE TABLE {quote(partition_name(table_name, month))} PARTITION OF {new_table} "
+                f"FOR VALUES FROM ('{month}') TO ('{_next_month(month)}')"
+            ))
+            month = _next_month(month)
+
+        columns = ", ".join(
+            f"COALESCE({key}, now())" if name == column else quote(name)
+            for name in connection.execute(text("""
+                SELECT attname FROM pg_attribute
+                WHERE attrelid = CAST(:table AS regclass) AND attnum > 0 AND NOT attisdropped
+                ORDER BY attnum
+            """), params).scalars()
+        )
+        rows = connection.execute(text(f"INSERT INTO {new_table} SELECT {columns} FROM {table}")).rowcount
+
+        primary_key_columns = [c.name for c in table_model.primary_key.columns]
+        if column not in primary_key_columns:
+            primary_key_columns.append(column)
+        connection.execute(text(
+            f"ALTER TABLE {new_table} ADD CONSTRAINT {quote(new_name + '_pkey')} "
+            f"PRIMARY KEY ({', '.join(quote(name) for name in primary_key_columns)})"
+        ))
+        for constraint_name, definition in foreign_keys:
+            connection.execute(text(
+                f"ALTER TABLE {new_table} ADD CONSTRAINT {quote(constraint_name + '__new')} {definition}"
+            ))
+        for index_name, index_table, index_columns, unique in declared_indexes():
+            if index_table == table_name:
+                connection.execute(text(
+                    f"CREATE {'UNIQUE INDEX' if unique else 'INDEX'} {quote(index_name + '__new')} ON {new_table} "
+                    f"({', '.join(quote(name) for name in index_columns)})"
+                ))
+
+        # Readers only wait from here to the commit
+        connection.execute(text(f"LOCK TABLE {table} IN ACCESS EXCLUSIVE MODE"))
+        for sequence_column, sequence in sequences:
+            connection.execute(text(f"ALTER SEQUENCE {sequence} OWNED BY {new_table}.{quote(sequence_column)}"))
+        connection.execute(text(f"DROP TABLE {table}"))
+        connection.execute(text(f"ALTER TABLE {new_table} RENAME TO {table}"))
+        connection.execute(text(
+            f"ALTER TABLE {table} RENAME CONSTRAINT {quote(new_name + '_pkey')} "
+            f"TO {quote(primary_key or table_name + '_pkey')}"
+        ))
+        for constraint_name, _ in foreign_keys:
+            connection.execute(text(
+                f"ALTER TABLE {table} RENAME CONSTRAINT {quote(constraint_name + '__new')} TO {quote(constraint_name)}"
+            ))
+        for index_name, index_table, _, _ in declared_indexes():
+            if index_table == table_name:
+                connection.execute(text(f"ALTER INDEX {quote(index_name + '__new')} RENAME TO {quote(index_name)}"))
+    logger.info(f"Partitioned {table_name} by month on {column} ({rows} rows copied)")
+    return True
+
+def create_tables(bind=None):
+    """
+    Create the tables of the models that do not exist yet.
+    """
+    Base.metadata.create_all(bind or engine)
+
+def partition_tables(bind=None):
+    """
+    Partition the fast-growing tables by month (PostgreSQL only).
+    """
+    bind = bind or engine
+    if not _is_postgres(bind):
+        logger.info("Skipping monthly partitioning: only supported on PostgreSQL")
+        return
+    existing_tables = set(inspect(bind).get_table_names())
+    for table_name in PARTITIONED_TABLES:
+        if table_name in existing_tables:
+            partition_table_by_month(table_name, bind)
+
+MIGRATIONS = [
+    ("0001_create_tables", create_tables),
+    ("0002_foreign_key_and_time_indexes", create_indexes),
+    ("0003_monthly_partitions", partition_tables),
+    ("0004_campaign_rollups", create_tables),
+    ("0005_dashboard_rollups", create_tables),
+    ("0006_data_versions", create_tables),
+]
+"""
+list: Migrations in the order they are applied, as (migration id, function).
+Append new migrations; never rename or reorder applied ones.
+"""
+
+def applied_migrations(bind=None) -> set:
+    """
+    Ids of the migrations already recorded in `schema_migrations`.
+    """
+    bind = bind or engine
+    with bind.begin() as connection:
+        connection.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {MIGRATIONS_TABLE} "
+            f"(migration_id VARCHAR PRIMARY KEY, applied_at TIMESTAMP NOT NULL)"
+        ))
+        return set(connection.execute(text(f"SELECT migration_id FROM {MIGRATIONS_TABLE}")).scalars())
+
+def migrate(bind=None) -> list:
+    """
+    Apply the migrations that have not been applied yet, in order.
+
+    Returns:
+        list[str]: Ids of the migrations applied by this call.
+    """
+    bind = bind or engine
+    done = applied_migrations(bind)
+    applied = []
+    for migration_id, apply in MIGRATIONS:
+        if migration_id in done:
+            continue
+        logger.info(f"Applying migration {migration_id}")
+        apply(bind)
+        with bind.begin() as connection:
+            connection.execute(
+                text(f"INSERT INTO {MIGRATIONS_TABLE} (migration_id, applied_at) VALUES (:id, :at)"),
+                {"id": migration_id, "at": datetime.datetime.now()},
+            )
+        applied.append(migration_id)
+    if _is_postgres(bind):
+        for table_name in PARTITIONED_TABLES:
+            ensure_monthly_partitions(table_name, bind=bind)
+    return applied
+
 def update_database_schema():
     """
     Updates the database schema to match the current models.
 
-    This function ensures that all tables defined in `models.py` are created
-    in the database. If a table already exists, it will not be recreated, 
-    preventing data loss.
+    Missing tables are created and pending migrations applied (see
+    `migrate`). Existing tables and their data are kept.
 
     Raises:
-        Exception: If there is an error connecting to the database 
+        Exception: If there is an error connecting to the database
         or applying the schema changes.
     """
     try:
-        # Create or update all tables in the database
-        Base.metadata.create_all(engine)
-        print("Database schema updated successfully!")
+        applied = migrate()
+        print(f"Database schema updated successfully! Applied migrations: {applied or 'none'}")
     except Exception as e:
         print(f"Error updating the database schema: {e}")
 
@@ -0,0 +1,204 @@
+"""
+Bulk Write-Back
+
+This module writes model predictions back to the database with set-based
+statements instead of one query or ORM object per row. On PostgreSQL each
+batch is sent with `COPY ... FROM STDIN`, into a temporary table that is then
+merged with `UPDATE ... FROM`, or straight into the target table for
+inserts. Other engines use batched `executemany`. Batches keep memory bounded.
+"""
+
+import io
+import time
+
+import pandas as pd
+from loguru import logger
+from sqlalchemy import insert, text
+
+from database import engine
+from models import Result, Segment
+from table_swap import swap_into_table
+
+WRITEBACK_BATCH_SIZE = 100_000  # Rows serialized and sent per batch
+
+def dedupe_predictions(data):
+    """
+    Reduce prediction rows to one row per customer.
+
+    Frames built by merging usage and transactions have one row per
+    usage/transaction pair, so a customer can appear many times with
+    different predictions. The probabilities of a customer are averaged and
+    the prediction is taken from the averaged probability.
+
+    Args:
+        data (DataFrame): Rows with customer_id, predicted_churn and churn_probability.
+
+    Returns:
+        DataFrame: One row per customer with the same three columns.
+    """
+    predictions = data[["customer_id", "predicted_churn", "churn_probability"]]
+    if predictions["customer_id"].is_unique:
+        return predictions.reset_index(drop=True)
+    probabilities = predictions.groupby("customer_id", sort=True)["churn_probability"].mean()
+    return pd.DataFrame({
+        "customer_id": probabilities.index,
+        "predicted_churn": (probabilities.to_numpy() > 0.5).astype(int),
+        "churn_probability": probabilities.to_numpy(),
+    })
+
+def _batches(frame, batch_size):
+    """
+    Yield consecutive slices of a frame with at most `batch_size` rows.
+    """
+    for start in range(0, len(frame), batch_size):
+        yield frame.iloc[start:start + batch_size]
+
+def _copy_frame(connection, table_name, frame):
+    """
+    Send a frame to a PostgreSQL table with COPY.
+    """
+    preparer = connection.dialect.identifier_preparer
+    buffer = io.StringIO()
+    frame.to_csv(buffer, index=False, header=False)
+    buffer.seek(0)
+    columns = ", ".join(preparer.quote(column) for column in frame.columns)
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert(
+            f"COPY {preparer.quote(table_name)} ({columns}) FROM STDIN WITH (FORMAT csv)", buffer
+        )
+    finally:
+        cursor.close()
+
+def bulk_update_churn_predictions(data, bind=None, batch_size=WRITEBACK_BATCH_SIZE) -> int:
+    """
+    Set `customers.churn_prediction` for every customer in a prediction frame.
+
+    Args:
+        data (DataFrame): Rows with customer_id, predicted_churn and
+            churn_probability; repeated customers are deduplicated.
+        bind (Engine, optional): Engine to write through. Defaults to `engine`.
+        batch_size (int): Rows sent per batch.
+
+    Returns:
+        int: Number of prediction rows that matched an existing customer.
+    """
+    bind = bind or engine
+    start = time.perf_counter()
+    predictions = dedupe_predictions(data)[["customer_id", "predicted_churn"]].astype(int)
+    with bind.begin() as connection:
+        if connection.dialect.name == "postgresql":
+            connection.execute(text(
+                "CREATE TEMP TABLE churn_writeback (customer_id integer, predicted_churn integer) "
+                "ON COMMIT DROP"
+            ))
+            for batch in _batches(predictions, batch_size):
+                _copy_frame(connection, "churn_writeback", batch)
+            matched = connection.execute(text(
+                "SELECT COUNT(*) FROM churn_writeback w "
+                "JOIN customers c ON c.customer_id = w.customer_id"
+            )).scalar()
+            connection.execute(text(
+                "UPDATE customers c SET churn_prediction = w.predicted_churn "
+                "FROM churn_writeback w "
+                "WHERE c.customer_id = w.customer_id "
+                "AND c.churn_prediction IS DISTINCT FROM w.predicted_churn"
+            ))
+        else:
+            update = text("UPDATE customers SET churn_prediction = :predicted_churn WHERE customer_id = :customer_id")
+            matched = 0
+            for batch in _batches(predictions, batch_size):
+                matched += connection.execute(update, batch.to_dict("records")).rowcount
+    missing = len(predictions) - matched
+    if missing:
+        logger.warning(f"{missing} predicted customers were not found in the database")
+    logger.info(f"Updated churn predictions of {matched} customers in {time.perf_counter() - start:.2f}s")
+    return matched
+
+def bulk_insert_results(data, created_at=None, bind=None, batch_size=WRITEBACK_BATCH_SIZE) -> int:
+    """
+    Append one `results` row per customer of a prediction frame.
+
+    Args:
+        data (DataFrame): Rows with customer_id, predicted_churn and
+            churn_probability; repeated customers are deduplicated.
+        created_at (Timestamp, optional): Timestamp stored on every row.
+            Defaults to now.
+        bind (Engine, optional): Engine to write through. Defaults to `engine`.
+        batch_size (int): Rows sent per batch.
+
+    Returns:
+        int: Number of rows inserted.
+    """
+    bind = bind or engine
+    start = time.perf_counter()
+    predictions = dedupe_predictions(data)
+    results = pd.DataFrame({
+        "customer_id": predictions["customer_id"].astype(int),
+        "prediction": predictions["predicted_churn"].map(lambda churn: "Churn" if churn == 1 else "No Churn"),
+        "probability": predictions["churn_probability"].astype(float),
+        "created_at": pd.Timestamp(created_at or pd.Timestamp.now()).to_pydatetime(),
+    })
+    with bind.begin() as connection:
+        for batch in _batches(results, batch_size):
+            if connection.dialect.name == "postgresql":
+                _copy_frame(connection, Result.__tablename__, batch)
+            else:
+                connection.execute(insert(Result.__table__), batch.to_dict("records"))
+    logger.info(f"Inserted {len(results)} results rows in {time.perf_counter() - start:.2f}s")
+    return len(results)
+
+def _write_segments(connection, table_name, segments, batch_size) -> int:
+    """
+    Append a segments frame to `segments` or its staging table.
+    """
+    for batch in _batches(segments, batch_size):
+        if connection.dialect.name == "postgresql":
+            _copy_frame(connection, table_name, batch)
+        else:
+            connection.execute(insert(Segment.__table__), batch.to_dict("records"))
+    return len(segments)
+
+def replace_segments(segments, full=False, bind=None, batch_size=WRITEBACK_BATCH_SIZE) -> int:
+    """
+    Replace the `segments` rows of the customers in a frame, in one transaction.
+
+    Args:
+        segments (DataFrame): One row per customer with customer_id,
+            segment_label, engagement_score and spending_score.
+        full (bool): Replace the whole table with the frame, through a
+            staging table swapped in with `table_swap.swap_into_table` so readers
+            keep seeing the old segments until the swap; otherwise only the
+            segments of the customers in the frame are replaced.
+        bind (Engine, optional): Engine to write through. Defaults to `engine`.
+        batch_size (int): Rows sent per batch.
+
+    Returns:
+        int: Number of rows written.
+    """
+    bind = bind or engine
+    start = time.perf_counter()
+    segments = segments[["customer_id", "segment_label", "engagement_score", "spending_score"]]
+    if full:
+        swap_into_table(
+            Segment.__tablename__,
+            lambda connection, table_name: _write_segments(connection, table_name, segments, batch_size),
+            bind=bind,
+        )
+        logger.info(f"Wrote {len(segments)} segments rows in {time.perf_counter() - start:.2f}s")
+        return len(segments)
+    with bind.begin() as connection:
+        if connection.dialect.name == "postgresql":
+            connection.execute(text("CREATE TEMP TABLE segment_writeback (customer_id integer) ON COMMIT DROP"))
+            for batch in _batches(segments[["customer_id"]], batch_size):
+                _copy_frame(connection, "segment_writeback", batch)
+            connection.execute(text(
+                "DELETE FROM segments s USING segment_writeback w WHERE s.customer_id = w.customer_id"
+            ))
+        else:
+            delete = text("DELETE FROM segments WHERE customer_id = :customer_id")
+            for batch in _batches(segments[["customer_id"]], batch_size):
+                connection.execute(delete, batch.to_dict("records"))
+        _write_segments(connection, Segment.__tablename__, segments, batch_size)
+    logger.info(f"Wrote {len(segments)} segments rows in {time.perf_counter() - start:.2f}s")
+    return len(segments)